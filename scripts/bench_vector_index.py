@@ -0,0 +1,139 @@
+"""
+向量库基准测试：NumPy 暴力检索（float16 / int8） vs Chroma HNSW
+用随机生成的聚簇向量模拟题库，对比建库时间、单条/批量查询延迟、recall@k 和内存占用。
+
+用法：
+    python scripts/bench_vector_index.py --n 20000 --dim 512
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from numpy_index import NumpyVectorIndex
+
+
+def make_data(n, dim, n_queries, seed=0):
+    """围绕若干中心生成向量，比纯随机更接近真实题库（同类题扎堆）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(n // 50, 1), dim)).astype(np.float32)
+    data = centers[rng.integers(len(centers), size=n)] + 0.3 * rng.normal(size=(n, dim)).astype(np.float32)
+    queries = data[rng.integers(n, size=n_queries)] + 0.1 * rng.normal(size=(n_queries, dim)).astype(np.float32)
+    return data, queries
+
+
+def exact_topk(data, queries, k):
+    """float32 精确暴力检索，作为 recall 的标准答案"""
+    data = data / np.linalg.norm(data, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = queries @ data.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return float("nan")
+
+
+def dir_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total / 2 ** 20
+
+
+def run(name, collection, data, queries, truth, k, batch, write_batch):
+    ids = [str(i) for i in range(len(data))]
+    rss_before = rss_mb()
+
+    start = time.perf_counter()
+    for i in range(0, len(data), write_batch):
+        collection.upsert(ids=ids[i:i + write_batch], embeddings=data[i:i + write_batch],
+                          metadatas=[{"user_id": j % 10} for j in range(i, min(i + write_batch, len(data)))])
+    build = time.perf_counter() - start
+
+    latencies = []
+    found = []
+    for q in queries:
+        start = time.perf_counter()
+        result = collection.query(query_embeddings=[q.tolist()], n_results=k)
+        latencies.append(time.perf_counter() - start)
+        found.append([int(x) for x in result["ids"][0]])
+
+    start = time.perf_counter()
+    for i in range(0, len(queries), batch):
+        collection.query(query_embeddings=queries[i:i + batch].tolist(), n_results=k)
+    batched = (time.perf_counter() - start) / len(queries)
+
+    recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth.tolist())])
+    latencies = np.array(latencies) * 1000
+    return {
+        "backend": name,
+        "build_s": build,
+        "p50_ms": np.percentile(latencies, 50),
+        "p95_ms": np.percentile(latencies, 95),
+        "batched_ms": batched * 1000,
+        "recall": recall,
+        "rss_mb": rss_mb() - rss_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量库基准测试")
+    parser.add_argument("--n", type=int, default=20000, help="向量条数")
+    parser.add_argument("--dim", type=int, default=512, help="向量维度（clip-ViT-B-32 是 512）")
+    parser.add_argument("--queries", type=int, default=200, help="查询条数")
+    parser.add_argument("--k", type=int, default=10, help="recall@k")
+    parser.add_argument("--batch", type=int, default=32, help="批量查询时每批条数")
+    parser.add_argument("--skip-chroma", action="store_true", help="不测 Chroma")
+    args = parser.parse_args()
+
+    print(f"🎲 生成 {args.n} 条 {args.dim} 维向量、{args.queries} 条查询...")
+    data, queries = make_data(args.n, args.dim, args.queries)
+    truth = exact_topk(data, queries, args.k)
+
+    workdir = tempfile.mkdtemp(prefix="bench_vector_")
+    results = []
+    try:
+        for dtype in ("float16", "int8"):
+            path = os.path.join(workdir, dtype)
+            index = NumpyVectorIndex(path, dtype)
+            row = run(f"numpy-{dtype}", index, data, queries, truth, args.k, args.batch, 5000)
+            row["disk_mb"] = dir_mb(path)
+            results.append(row)
+            print(f"✅ numpy-{dtype} 完成")
+
+        if not args.skip_chroma:
+            try:
+                import chromadb
+            except ImportError:
+                print("⚠️ 没有安装 chromadb，跳过 Chroma")
+            else:
+                path = os.path.join(workdir, "chroma")
+                client = chromadb.PersistentClient(path=path)
+                collection = client.get_or_create_collection(name="bench", metadata={"hnsw:space": "cosine"})
+                write_batch = min(5000, client.get_max_batch_size())
+                row = run("chroma", collection, data, queries, truth, args.k, args.batch, write_batch)
+                row["disk_mb"] = dir_mb(path)
+                results.append(row)
+                print("✅ chroma 完成")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print(f"{'后端':<14}{'建库(s)':>9}{'p50(ms)':>9}{'p95(ms)':>9}{'批量/条(ms)':>13}"
+          f"{'recall@' + str(args.k):>11}{'RSS增量(MB)':>13}{'磁盘(MB)':>10}")
+    for r in results:
+        print(f"{r['backend']:<14}{r['build_s']:>9.2f}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['batched_ms']:>13.3f}"
+              f"{r['recall']:>11.3f}{r['rss_mb']:>13.1f}{r['disk_mb']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+exam_cutter 回归检查
+用随机生成的试卷页面，对比当前 exam_cutter 和最初逐像素循环版本的切题结果，必须逐字节一致。
+再把随机页面做成 PDF，换几种 CUTTER_RENDER_ZOOM / CUTTER_CROP_COLORSPACE 切一遍，
+每页切出的题数必须和最初的实现切原图时一样，小题图片的尺寸按倍数缩放。
+
+用法：
+    python scripts/check_cutter.py            # 默认 20 页
+    python scripts/check_cutter.py --pages 50
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import cv2
+import fitz
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import exam_cutter
+
+
+# ================= 最初的实现（参照答案，不要改） =================
+def legacy_find_left_anchor(binary_img):
+    h, w = binary_img.shape
+    roi = binary_img[:, 0:int(w*0.2)]
+    v_proj = cv2.reduce(roi, 0, cv2.REDUCE_AVG)
+    best_x = 0
+    max_val = 0
+    for x in range(len(v_proj[0])):
+        val = v_proj[0][x]
+        if val > max_val:
+            max_val = val
+            best_x = x
+    if max_val < 50:
+        return int(w * 0.08)
+    return best_x + 20
+
+
+def legacy_row_cuts(h_proj):
+    cuts = [0]
+    is_gap = False
+    gap_start = 0
+    for y in range(len(h_proj)):
+        if h_proj[y][0] < 5:
+            if not is_gap:
+                is_gap = True
+                gap_start = y
+        else:
+            if is_gap:
+                if (y - gap_start) > 20:
+                    mid = gap_start + (y - gap_start)//2
+                    cuts.append(mid)
+                is_gap = False
+    cuts.append(len(h_proj))
+    return cuts
+
+
+def legacy_process_page(img, base_filename, page_num=0):
+    """返回 [(文件名, 小题图片)]，切法和最初的 process_page 一模一样"""
+    h, w = img.shape[:2]
+    if len(img.shape) == 3:
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = img
+    _, binary = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY_INV)
+    y_top = int(h * 0.14)
+    y_bottom = int(h * (1 - 0.05))
+    x_start = legacy_find_left_anchor(binary)
+    content_width = w - x_start
+    col_width = content_width // 3
+
+    crops = []
+    for i in range(3):
+        cx1 = x_start + i * col_width
+        cx2 = x_start + (i + 1) * col_width
+        if i == 3 - 1: cx2 = w
+        col_img = img[y_top:y_bottom, cx1:cx2]
+        col_gray = cv2.cvtColor(col_img, cv2.COLOR_BGR2GRAY)
+        _, col_bin = cv2.threshold(col_gray, 200, 255, cv2.THRESH_BINARY_INV)
+        kernel_h = np.ones((1, 15), np.uint8)
+        clean_bin = cv2.erode(col_bin, kernel_h, iterations=1)
+        clean_bin = cv2.dilate(clean_bin, kernel_h, iterations=1)
+        h_proj = cv2.reduce(clean_bin, 1, cv2.REDUCE_AVG)
+        cuts = legacy_row_cuts(h_proj)
+        for k in range(len(cuts)-1):
+            y1 = cuts[k]
+            y2 = cuts[k+1]
+            if (y2 - y1) > 40:
+                q_sub = col_img[y1:y2, :]
+                if cv2.mean(q_sub)[0] < 250:
+                    crops.append((f"{base_filename}_p{page_num+1}_c{i+1}_q{len(crops)+1}.jpg", q_sub))
+    return crops
+
+
+# ================= 随机试卷 =================
+def synthetic_page(seed, height=2382, width=1684):
+    """三栏排版的白底试卷：装订线（有时没有）、标题、成块的文字、横线、大小不一的题间空白"""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 255, np.uint8)
+    x_line = None
+    if rng.random() < 0.8:
+        x_line = int(rng.integers(int(width * 0.03), int(width * 0.15)))
+        cv2.line(img, (x_line, 0), (x_line, height - 1), (0, 0, 0), int(rng.integers(2, 6)))
+    cv2.putText(img, f"EXAM {seed}", (width // 3, int(height * 0.07)), cv2.FONT_HERSHEY_SIMPLEX, 3, (0, 0, 0), 5)
+
+    x0 = (x_line or int(width * 0.08)) + 20
+    col_w = (width - x0) // 3
+    for c in range(3):
+        y = int(height * 0.14) + int(rng.integers(0, 40))
+        while y < height * 0.93:
+            block_h = int(rng.integers(20, 220))
+            for line_y in range(y, min(y + block_h, height - 1), 28):
+                text = "".join(rng.choice(list("0123456789+-=xyABC ()"), int(rng.integers(5, 20))))
+                cv2.putText(img, text, (x0 + c * col_w + 10, line_y + 20), cv2.FONT_HERSHEY_SIMPLEX,
+                            0.7, (int(rng.integers(0, 120)),) * 3, 2)
+            if rng.random() < 0.3:
+                # 填空横线：细长，会被横向腐蚀/膨胀保留下来
+                yy = y + block_h + 3
+                cv2.line(img, (x0 + c * col_w + 30, yy), (x0 + c * col_w + col_w - 40, yy), (0, 0, 0), 1)
+            y += block_h + int(rng.integers(4, 90))
+    if rng.random() < 0.5:
+        # 扫描件常见的灰色噪点
+        noise = rng.integers(0, 256, size=(height, width), dtype=np.uint8) < 2
+        img[noise] = 150
+    return img
+
+
+# ================= 检查 =================
+def check_row_cuts(trials=2000):
+    rng = np.random.default_rng(0)
+    for t in range(trials):
+        n = int(rng.integers(0, 400))
+        h_proj = np.where(rng.random((n, 1)) < rng.random(), 0, rng.integers(0, 255, (n, 1))).astype(np.uint8)
+        if t % 5 == 0:
+            h_proj[:] = 0 if t % 10 == 0 else 200
+        assert exam_cutter.find_row_cuts(h_proj) == legacy_row_cuts(h_proj), f"切点不一致 (trial {t})"
+    print(f"✅ find_row_cuts 和逐行扫描结果一致（{trials} 组随机投影）")
+
+
+def time_hot_loops(img, timings):
+    """只计时找装订线和找切点这两段（整页做一次，每栏的投影各做一次）"""
+    binary = cv2.threshold(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), 200, 255, cv2.THRESH_BINARY_INV)[1]
+    cols = np.array_split(binary[int(binary.shape[0] * 0.14):], 3, axis=1)
+    projections = [cv2.reduce(np.ascontiguousarray(c), 1, cv2.REDUCE_AVG) for c in cols]
+    for key, anchor, cuts in (("legacy", legacy_find_left_anchor, legacy_row_cuts),
+                              ("current", exam_cutter.find_left_anchor, exam_cutter.find_row_cuts)):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            anchor(binary)
+            for h_proj in projections:
+                cuts(h_proj)
+            timings[key] += time.perf_counter() - start
+
+
+def synthetic_pdf(pages):
+    """随机页面做成 PDF：页面尺寸取图片的一半，按 2 倍渲染正好是原图的分辨率"""
+    doc = fitz.open()
+    for seed in range(pages):
+        img = synthetic_page(seed)
+        h, w = img.shape[:2]
+        page = doc.new_page(width=w / 2, height=h / 2)
+        page.insert_image(page.rect, stream=cv2.imencode(".png", img)[1].tobytes())
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def cut_pdf(data, zoom, colorspace):
+    """按给定的渲染倍数和颜色切 PDF，返回 {(页, 栏, 题号): 小题图片}"""
+    saved = exam_cutter.RENDER_ZOOM, exam_cutter.CROP_COLORSPACE
+    exam_cutter.RENDER_ZOOM, exam_cutter.CROP_COLORSPACE = zoom, colorspace
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            return {(q["page"], q["column"], q["index"]): q["image"]
+                    for q in exam_cutter.iter_questions(data, "synthetic.pdf")}
+    finally:
+        exam_cutter.RENDER_ZOOM, exam_cutter.CROP_COLORSPACE = saved
+
+
+def check_render_zoom(pages=6):
+    """
+    渲染倍数只影响小题图片的分辨率，不能影响切法：
+    每页题数和最初的实现切原图时一样，小题尺寸是原图上的尺寸按倍数缩放
+    """
+    data = synthetic_pdf(pages)
+    expected = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for seed in range(pages):
+            for fname, crop in legacy_process_page(synthetic_page(seed), "synthetic", seed):
+                _, p, c, q = os.path.splitext(fname)[0].rsplit("_", 3)
+                expected[(int(p[1:]), int(c[1:]), int(q[1:]))] = crop
+    per_page = [sum(1 for key in expected if key[0] == p + 1) for p in range(pages)]
+    for zoom, colorspace in ((2, "rgb"), (2, "gray"), (1.5, "rgb"), (1, "rgb"), (1, "gray"), (3, "rgb")):
+        actual = cut_pdf(data, zoom, colorspace)
+        counts = [sum(1 for key in actual if key[0] == p + 1) for p in range(pages)]
+        if counts != per_page:
+            print(f"❌ 渲染倍数 {zoom} ({colorspace}) 每页题数 {counts}，应该是 {per_page}")
+            sys.exit(1)
+        for key, crop in actual.items():
+            ref = expected[key]
+            ok = (crop.ndim == (2 if colorspace == "gray" else 3)
+                  and all(abs(a - b * zoom / 2) <= 2 for a, b in zip(crop.shape[:2], ref.shape[:2])))
+            if not ok:
+                print(f"❌ 渲染倍数 {zoom} ({colorspace}) 第 {key} 题尺寸 {crop.shape}，原图上是 {ref.shape}")
+                sys.exit(1)
+    print(f"✅ {pages} 页随机 PDF 在各种渲染倍数下每页题数一致 {per_page}，共 {sum(per_page)} 道")
+
+
+def run_current(img, name, out_dir):
+    """跑当前的 process_page，返回 {文件名: 文件字节}"""
+    os.makedirs(out_dir)
+    exam_cutter.OUTPUT_FOLDER = out_dir
+    exam_cutter.DEBUG_FOLDER = out_dir + "_debug"
+    os.makedirs(exam_cutter.DEBUG_FOLDER, exist_ok=True)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        exam_cutter.process_page(img, name)
+    result = {}
+    for fname in os.listdir(out_dir):
+        with open(os.path.join(out_dir, fname), "rb") as f:
+            result[fname] = f.read()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="exam_cutter 回归检查")
+    parser.add_argument("--pages", type=int, default=20, help="随机试卷页数")
+    args = parser.parse_args()
+
+    check_row_cuts()
+    check_render_zoom()
+    workdir = tempfile.mkdtemp(prefix="check_cutter_")
+    total = 0
+    timings = {"legacy": 0.0, "current": 0.0}
+    try:
+        for seed in range(args.pages):
+            img = synthetic_page(seed)
+            name = f"synthetic{seed}"
+            time_hot_loops(img, timings)
+
+            expected = {fname: cv2.imencode(".jpg", crop)[1].tobytes()
+                        for fname, crop in legacy_process_page(img, name)}
+            actual = run_current(img, name, os.path.join(workdir, name))
+
+            if actual != expected:
+                print(f"❌ 第 {seed} 页不一致: 期望 {sorted(expected)}，实际 {sorted(actual)}")
+                sys.exit(1)
+            total += len(expected)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"✅ {args.pages} 页随机试卷切出的 {total} 道题逐字节一致")
+    print(f"⏱️ 找装订线 + 找切点：最初实现 {timings['legacy'] / args.pages * 1000:.2f} ms/页，"
+          f"当前实现 {timings['current'] / args.pages * 1000:.2f} ms/页")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+similar_graph 增量更新检查
+随机生成一串存/改/删操作，每一步都把增量更新后的相似题图和从头全量重建的结果对比，
+节点表和每道题的邻居列表（顺序、分数）必须一致。和页面进程一样，先跑轻量的 prune
+（删节点、改标签）再做增量更新。
+
+另外检查只读打开的图：related_many 不会返回已删除的题，也不会建出图文件。
+
+向量库用内存里的假实现代替（只实现 question_vectors），不需要 CLIP 模型和 Chroma。
+
+用法：
+    python scripts/check_similar_graph.py                 # 默认 200 步
+    python scripts/check_similar_graph.py --steps 1000 --seed 7
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from similar_graph import SimilarQuestionGraph
+
+
+class MemoryKnowledgeBase:
+    """和 MathKnowledgeBase.question_vectors 返回格式一样的内存向量库"""
+
+    def __init__(self, rng, image_dim=16, text_dim=12):
+        self.rng = rng
+        self.image_dim = image_dim
+        self.text_dim = text_dim
+        self.docs = {}   # question_id -> {"metadata", "image", "text"}
+
+    def _unit(self, dim):
+        v = self.rng.standard_normal(dim).astype(np.float32)
+        return v / np.linalg.norm(v)
+
+    def save(self, question_id, user_id):
+        # 一部分题没有讲解的文本向量，覆盖只用图片相似度的分支
+        self.docs[question_id] = {
+            "metadata": {"question_id": question_id, "user_id": user_id,
+                         "image_path": f"User{user_id}_{question_id}.jpg", "tags": "t"},
+            "image": self._unit(self.image_dim),
+            "text": self._unit(self.text_dim) if self.rng.random() < 0.8 else None,
+        }
+
+    def update(self, question_id):
+        doc = self.docs[question_id]
+        doc["text"] = self._unit(self.text_dim)
+        doc["metadata"] = dict(doc["metadata"], tags=f"t{self.rng.integers(100)}")
+
+    def delete(self, question_id):
+        del self.docs[question_id]
+
+    @staticmethod
+    def _match(metadata, where):
+        if where is None:
+            return True
+        (key, cond), = where.items()
+        if isinstance(cond, dict):
+            return metadata.get(key) in cond["$in"]
+        return metadata.get(key) == cond
+
+    def question_vectors(self, where=None):
+        docs = [d for _, d in sorted(self.docs.items()) if self._match(d["metadata"], where)]
+        has_text = np.array([d["text"] is not None for d in docs], dtype=bool)
+        text = np.zeros((len(docs), self.text_dim), dtype=np.float32)
+        for i, d in enumerate(docs):
+            if d["text"] is not None:
+                text[i] = d["text"]
+        return {
+            "question_ids": [d["metadata"]["question_id"] for d in docs],
+            "metadatas": [d["metadata"] for d in docs],
+            "image": np.array([d["image"] for d in docs], dtype=np.float32).reshape(len(docs), self.image_dim),
+            "text": text,
+            "has_text": has_text,
+        }
+
+
+def dump(graph):
+    """图的全部内容：(节点表, {题目 ID: [(邻居, 分数)]})"""
+    nodes = graph._db.execute("SELECT * FROM nodes ORDER BY question_id").fetchall()
+    edges = {}
+    for qid, _, neighbor_id, score in graph._db.execute("SELECT * FROM neighbors ORDER BY question_id, rank"):
+        edges.setdefault(qid, []).append((neighbor_id, score))
+    return nodes, edges
+
+
+def compare(incremental, rebuilt):
+    """返回第一处差异的描述，一致返回 None"""
+    nodes, edges = dump(incremental)
+    expected_nodes, expected_edges = dump(rebuilt)
+    if nodes != expected_nodes:
+        return f"节点表不一致: {sorted(set(nodes) ^ set(expected_nodes))[:5]}"
+    for qid in sorted(set(edges) | set(expected_edges)):
+        got, want = edges.get(qid, []), expected_edges.get(qid, [])
+        if ([n for n, _ in got] != [n for n, _ in want]
+                or not np.allclose([s for _, s in got], [s for _, s in want], atol=1e-5)):
+            return f"题目 {qid} 的邻居不一致: 增量 {got}，全量 {want}"
+    return None
+
+
+def random_step(rng, kb, users, next_id):
+    """随机一步存/改/删，返回 (事件, 监听器收到的 payload, 新的 next_id)"""
+    ids = list(kb.docs)
+    kind = rng.choice(["save", "update", "delete"], p=[0.5, 0.25, 0.25]) if ids else "save"
+    if kind == "save":
+        payload = []
+        for _ in range(int(rng.integers(1, 4))):
+            user_id = int(rng.choice(users))
+            kb.save(next_id, user_id)
+            payload.append({"question_id": next_id, "user_id": user_id})
+            next_id += 1
+        return "save", payload, next_id
+    chosen = [int(q) for q in rng.choice(ids, size=min(len(ids), int(rng.integers(1, 4))), replace=False)]
+    if kind == "update":
+        for qid in chosen:
+            kb.update(qid)
+        return "update", [(qid, "", "") for qid in chosen], next_id
+    for qid in chosen:
+        kb.delete(qid)
+    return "delete", chosen, next_id
+
+
+def check_pruned(reader, deleted):
+    """prune 之后、增量重算之前，只读查询不能返回刚删除的题"""
+    deleted = set(deleted)
+    neighbors = reader._reader().execute("SELECT DISTINCT question_id FROM neighbors").fetchall()
+    for qid, matches in reader.related_many([q for (q,) in neighbors]).items():
+        if qid in deleted:
+            return f"已删除的题 {qid} 还能查到邻居"
+        if deleted & {m["id"] for m in matches}:
+            return f"题目 {qid} 的相似题里还有已删除的题"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="similar_graph 增量更新检查")
+    parser.add_argument("--steps", type=int, default=200, help="随机操作步数")
+    parser.add_argument("--users", type=int, default=3, help="用户数")
+    parser.add_argument("--k", type=int, default=4, help="每道题存多少个相似题")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    kb = MemoryKnowledgeBase(rng)
+    users = list(range(1, args.users + 1))
+    workdir = tempfile.mkdtemp(prefix="check_similar_graph_")
+    try:
+        missing = os.path.join(workdir, "missing.db")
+        if SimilarQuestionGraph(path=missing, readonly=True).related_many([1]) or os.path.exists(missing):
+            print("❌ 只读打开不存在的图文件时应该返回空结果，并且不创建文件")
+            sys.exit(1)
+        incremental = SimilarQuestionGraph(kb, path=os.path.join(workdir, "incremental.db"), k=args.k)
+        reader = SimilarQuestionGraph(path=incremental.path, k=args.k, readonly=True)
+        rebuilt = SimilarQuestionGraph(kb, path=os.path.join(workdir, "rebuilt.db"), k=args.k)
+        next_id = 1
+        for step in range(args.steps):
+            event, payload, next_id = random_step(rng, kb, users, next_id)
+            incremental.prune(event, payload)
+            if event == "delete":
+                problem = check_pruned(reader, payload)
+                if problem:
+                    print(f"❌ 第 {step} 步（{event} {payload}）之后: {problem}")
+                    sys.exit(1)
+            incremental.sync_db_write(event, payload)
+            rebuilt.rebuild(report=False)
+            problem = compare(incremental, rebuilt)
+            if problem:
+                print(f"❌ 第 {step} 步（{event} {payload}）之后不一致: {problem}")
+                sys.exit(1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"✅ {args.steps} 步随机存/改/删之后，增量更新的相似题图和全量重建一致"
+          f"（{len(kb.docs)} 道题, {args.users} 个用户, k={args.k}）")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,7 @@ import google.generativeai as genai
 
 # 导入工具函数和视图
 from utils import load_css
-from db_manager import DBManager
+from db_manager import create_db_manager
 from views.dashboard import render_dashboard_page
 from views.tutor import render_tutor_page
 from views.progress import render_progress_page
@@ -37,6 +37,19 @@ if GOOGLE_API_KEY:
     except Exception as e:
         print(f"⚠️ AI 模型初始化失败: {e}")
 
+# 向量库：还没打开时，数据库的存/改/删先记进同步队列，打开时补上
+from vector_store import register_vector_sync
+register_vector_sync()
+
+# 相似题图：删题/改标签直接同步到图里，不用打开向量库（重算邻居由 Tutor 页面的增量更新负责）
+from similar_graph import register_graph_pruner
+register_graph_pruner()
+
+# 可选：后台预热 CLIP 视觉模型，第一次查相似题时不用再等模型加载
+if os.getenv('CLIP_WARMUP', '0') == '1':
+    from vector_store import warm_up
+    warm_up()
+
 # ================= 3. 页面配置 =================
 st.set_page_config(
     page_title="MathMaster Edu", 
@@ -65,7 +78,7 @@ def show_login_page():
             username = st.text_input("Username", placeholder="Student ID")
             password = st.text_input("Password", type="password", placeholder="Password")
             if st.form_submit_button("🎈 Login", use_container_width=True):
-                db = DBManager()
+                db = create_db_manager()
                 user = db.login(username, password)
                 if user:
                     st.session_state['user_info'] = {
@@ -1,157 +1,1270 @@
 import pymssql
 import datetime
 import os
-import streamlit as st
+import time
+import threading
+import functools
+from collections import deque, Counter
 from dotenv import load_dotenv
+from search_index import SqlServerFullTextIndex
+from query_cache import VersionedQueryCache
+from fallback_store import FallbackStore, DEMO_USER_ID
+from utils import split_tags
 
 # 加载环境变量
 load_dotenv()
 
+# ================= 存储后端 =================
+# mssql: SQL Server（默认，连不上时退回演示模式）；sqlite: 本地嵌入式数据库，单机部署/本地测试用
+DB_BACKEND = os.getenv('DB_BACKEND', 'mssql').lower()
+
+# ================= 连接池配置 =================
+POOL_MAX_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))                       # 最多同时持有多少条连接
+POOL_IDLE_TIMEOUT = float(os.getenv('DB_POOL_IDLE_TIMEOUT', '300'))       # 空闲超过这么多秒就断开
+POOL_PING_AFTER = float(os.getenv('DB_POOL_PING_AFTER', '30'))            # 空闲超过这么多秒，借出前先 SELECT 1 体检
+POOL_CHECKOUT_TIMEOUT = float(os.getenv('DB_POOL_CHECKOUT_TIMEOUT', '10'))  # 池满时最多等多久
+
+# ================= 熔断器配置 =================
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '3'))                  # 单次建连最多等几秒
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('DB_BREAKER_FAILURES', '2'))          # 连续失败几次就熔断
+BREAKER_PROBE_INTERVAL = float(os.getenv('DB_BREAKER_PROBE_INTERVAL', '15'))    # 熔断后每隔几秒后台探测一次
+REPLAY_RETRY_INTERVAL = BREAKER_PROBE_INTERVAL                                  # 离线写操作回放失败后隔几秒再试
+
+# ================= 查询缓存配置 =================
+CACHE_MAX_ENTRIES = int(os.getenv('DB_CACHE_SIZE', '512'))   # 最多缓存多少个查询结果
+CACHE_TTL = float(os.getenv('DB_CACHE_TTL', '60'))            # 结果最多缓存几秒（兜底，正常靠写操作失效）
+
+# ================= 分页 / 搜索 / 批量配置 =================
+HISTORY_PAGE_SIZE = 20
+SEARCH_LIMIT = 50
+MAX_SQL_PARAMS = 2000   # SQL Server 单条语句参数上限是 2100，留点余量
+TAG_MAX_LEN = 100       # QuestionTags.Tag 列宽
+GLOBAL_STATS_USER = 0   # 统计表里 UserID=0 这一行是全站汇总（管理员看这一行）
+
+# ================= 表结构迁移 =================
+# 每条都是幂等的 (IF NOT EXISTS)，进程第一次连上数据库时按顺序执行一遍
+SCHEMA_MIGRATIONS = [
+    # 学生查自己的错题：按 (UserID, CreatedDate, QuestionID) 做键集分页
+    """
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_Questions_User_Created')
+        CREATE INDEX IX_Questions_User_Created
+        ON Questions (UserID, CreatedDate DESC, QuestionID DESC)
+    """,
+    # 管理员看全部错题
+    """
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_Questions_Created')
+        CREATE INDEX IX_Questions_Created
+        ON Questions (CreatedDate DESC, QuestionID DESC)
+    """,
+    # 标签拆成一行一个，按标签筛选/统计时走索引，不用再解析逗号字符串
+    f"""
+    IF OBJECT_ID('QuestionTags') IS NULL
+        CREATE TABLE QuestionTags (
+            QuestionID INT NOT NULL
+                CONSTRAINT FK_QuestionTags_Questions REFERENCES Questions (QuestionID) ON DELETE CASCADE,
+            UserID INT NOT NULL,
+            Tag NVARCHAR({TAG_MAX_LEN}) NOT NULL,
+            CONSTRAINT PK_QuestionTags PRIMARY KEY (QuestionID, Tag)
+        )
+    """,
+    # 按标签找题 (管理员跨用户 / 学生自己)
+    """
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_QuestionTags_Tag_User')
+        CREATE INDEX IX_QuestionTags_Tag_User ON QuestionTags (Tag, UserID)
+    """,
+    # 统计某个用户的标签分布
+    """
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_QuestionTags_User_Tag')
+        CREATE INDEX IX_QuestionTags_User_Tag ON QuestionTags (UserID, Tag)
+    """,
+    # Dashboard 计数器：写题/改题/删题时增量维护，读的时候一条查询
+    """
+    IF OBJECT_ID('UserStats') IS NULL
+        CREATE TABLE UserStats (
+            UserID INT NOT NULL CONSTRAINT PK_UserStats PRIMARY KEY,
+            TotalQuestions INT NOT NULL
+        )
+    """,
+    f"""
+    IF OBJECT_ID('UserTagStats') IS NULL
+        CREATE TABLE UserTagStats (
+            UserID INT NOT NULL,
+            Tag NVARCHAR({TAG_MAX_LEN}) NOT NULL,
+            Cnt INT NOT NULL,
+            CONSTRAINT PK_UserTagStats PRIMARY KEY (UserID, Tag)
+        )
+    """,
+]
+
+# 从明细表重算全部计数器（迁移后第一次、或者怀疑计数不准时执行）
+REBUILD_STATS_SQL = [
+    "DELETE FROM UserTagStats",
+    "DELETE FROM UserStats",
+    "INSERT INTO UserStats (UserID, TotalQuestions) SELECT UserID, COUNT(*) FROM Questions GROUP BY UserID",
+    f"INSERT INTO UserStats (UserID, TotalQuestions) SELECT {GLOBAL_STATS_USER}, COUNT(*) FROM Questions",
+    "INSERT INTO UserTagStats (UserID, Tag, Cnt) SELECT UserID, MIN(Tag), COUNT(*) FROM QuestionTags GROUP BY UserID, Tag",
+    f"INSERT INTO UserTagStats (UserID, Tag, Cnt) SELECT {GLOBAL_STATS_USER}, MIN(Tag), COUNT(*) FROM QuestionTags GROUP BY Tag",
+]
+
+
+class PoolExhaustedError(TimeoutError):
+    """连接池满了、等待超时：是本进程并发太高，不是数据库出了问题，不计入熔断"""
+
+
+class PooledConnection:
+    """
+    借出去的连接：用法和 pymssql 连接一样，
+    只是 close() 不会真正断开，而是还回连接池。
+    推荐写成 `with db.get_connection() as conn:`，出错时会自动回滚。
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._closed = False
+
+    def cursor(self, *args, **kwargs):
+        return self._raw.cursor(*args, **kwargs)
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def autocommit(self, status):
+        self._raw.autocommit(status)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._pool.release(self._raw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._closed:
+            return False
+        if exc_type is None:
+            self.close()
+            return False
+        # 出错了：能回滚说明连接还健康，放回池子；回滚都失败就直接丢掉
+        self._closed = True
+        try:
+            self._raw.rollback()
+            self._pool.release(self._raw)
+        except Exception:
+            self._pool.discard(self._raw)
+        return False
+
+
+class CallStats:
+    """记录每个 DBManager 方法的调用次数和耗时（连接池和 SQLite 后端共用）"""
+
+    def __init__(self):
+        self._timings = {}        # {方法名: {"count", "errors", "total_ms", "max_ms"}}
+        self._timings_lock = threading.Lock()
+
+    def record_call(self, name, elapsed, ok=True):
+        ms = elapsed * 1000
+        with self._timings_lock:
+            t = self._timings.setdefault(name, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            t["count"] += 1
+            t["total_ms"] += ms
+            t["max_ms"] = max(t["max_ms"], ms)
+            if not ok:
+                t["errors"] += 1
+
+    def call_stats(self):
+        with self._timings_lock:
+            return {
+                name: dict(t, avg_ms=round(t["total_ms"] / t["count"], 2) if t["count"] else 0.0)
+                for name, t in self._timings.items()
+            }
+
+
+class ConnectionPool(CallStats):
+    """
+    进程级连接池：所有 Streamlit 会话共用，rerun 时借一条热连接，而不是重新握手。
+    - 有上限 (max_size)，池满时等待 checkout_timeout 秒
+    - 借出前体检：空闲太久的连接先跑一次 SELECT 1
+    - 空闲淘汰：超过 idle_timeout 没人用的连接会被关掉
+    - 记录每个 DBManager 方法的调用耗时
+    """
+
+    def __init__(self, factory, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                 ping_after=POOL_PING_AFTER, checkout_timeout=POOL_CHECKOUT_TIMEOUT):
+        super().__init__()
+        self._factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self.checkout_timeout = checkout_timeout
+
+        self._idle = deque()      # [(raw_conn, 上次归还时间)]，右端是最近归还的
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._counters = {"created": 0, "reused": 0, "discarded": 0, "evicted": 0, "waits": 0}
+
+    # ---------- 借 / 还 ----------
+    def acquire(self):
+        while True:
+            raw, idle_since = self._checkout()
+            if raw is None:
+                # 池里没有空闲连接，但还有名额：在锁外面建新连接，避免卡住别人
+                try:
+                    raw = self._factory()
+                except Exception:
+                    with self._cond:
+                        self._in_use -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._counters["created"] += 1
+                return PooledConnection(self, raw)
+
+            if time.monotonic() - idle_since < self.ping_after or self._ping(raw):
+                with self._cond:
+                    self._counters["reused"] += 1
+                return PooledConnection(self, raw)
+            # 体检没通过：丢掉，再借一次
+            self.discard(raw)
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._cond:
+            self._evict_idle_locked()
+            while True:
+                if self._idle:
+                    raw, idle_since = self._idle.pop()   # LIFO：优先用最热的连接
+                    self._in_use += 1
+                    return raw, idle_since
+                if self._in_use < self.max_size:
+                    self._in_use += 1
+                    return None, None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhaustedError(f"数据库连接池已满 ({self.max_size})，等待超时")
+                self._counters["waits"] += 1
+                self._cond.wait(remaining)
+
+    def release(self, raw):
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append((raw, time.monotonic()))
+            self._evict_idle_locked()
+            self._cond.notify()
+
+    def discard(self, raw):
+        with self._cond:
+            self._in_use -= 1
+            self._counters["discarded"] += 1
+            self._cond.notify()
+        self._close_quietly(raw)
+
+    def _evict_idle_locked(self):
+        # 左端是最久没用的，从左往右踢
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            raw, _ = self._idle.popleft()
+            self._counters["evicted"] += 1
+            self._close_quietly(raw)
+
+    @staticmethod
+    def _ping(raw):
+        try:
+            cursor = raw.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close_quietly(raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def close_all(self):
+        with self._cond:
+            while self._idle:
+                raw, _ = self._idle.popleft()
+                self._close_quietly(raw)
+
+    # ---------- 统计 ----------
+    def stats(self):
+        with self._cond:
+            return {
+                "max_size": self.max_size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                **self._counters,
+                "calls": self.call_stats(),
+            }
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态：数据库已知不可用，直接走演示模式"""
+
+
+# 写操作只在这些"数据库连不上"的错误时转存降级存储（恢复后回放）；
+# SQL 本身的错误（约束冲突、语法等）照常抛出，不能排进队列，否则会让整批回放一直失败
+DB_UNAVAILABLE_ERRORS = (CircuitOpenError, pymssql.OperationalError, pymssql.InterfaceError)
+
+
+class CircuitBreaker:
+    """
+    数据库熔断器：
+    - closed：正常访问数据库
+    - open：连续失败达到阈值，所有调用直接抛 CircuitOpenError（立即走演示模式），
+      同时后台线程每隔 probe_interval 秒探测一次
+    - half_open：探测成功，放一个真实请求过去试试，成功就恢复 closed，失败重新 open
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, probe, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 probe_interval=BREAKER_PROBE_INTERVAL):
+        self._probe = probe
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = ""
+        self._trial_in_flight = False
+        self._probe_thread = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """这次调用能不能去碰数据库"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                print("✅ 数据库已恢复，熔断器关闭")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """放行的请求没碰到数据库就结束了（比如连接池满）：不算成功也不算失败，让下一个请求再试"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"⚡ 数据库不可用，熔断器打开: {error}")
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                self._start_probe_locked()
+
+    def _start_probe_locked(self):
+        if self._probe_thread and self._probe_thread.is_alive():
+            return
+        self._probe_thread = threading.Thread(target=self._probe_loop, name="db-breaker-probe", daemon=True)
+        self._probe_thread.start()
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            with self._lock:
+                if self.state != self.OPEN:
+                    return
+            try:
+                self._probe()
+            except Exception as e:
+                with self._lock:
+                    self.last_error = str(e)
+                continue
+            with self._lock:
+                if self.state == self.OPEN:
+                    self.state = self.HALF_OPEN
+                    self._trial_in_flight = False
+            return
+
+    def status(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "opened_at": self.opened_at,
+                "last_error": self.last_error,
+                "connect_timeout": DB_CONNECT_TIMEOUT,
+                "probe_interval": self.probe_interval,
+            }
+
+
+def _probe_connect(db_settings):
+    pymssql.connect(**db_settings).close()
+
+
+_pool = None
+_breaker = None
+_cache = None
+_fallback = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(db_settings):
+    """获取进程级共享连接池（第一次调用时创建）"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(lambda: pymssql.connect(**db_settings))
+    return _pool
+
+
+def get_breaker(db_settings):
+    """获取进程级共享熔断器（第一次调用时创建）"""
+    global _breaker
+    if _breaker is None:
+        with _pool_lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker(lambda: _probe_connect(db_settings))
+    return _breaker
+
+
+def get_query_cache():
+    """获取进程级共享查询缓存（第一次调用时创建）"""
+    global _cache
+    if _cache is None:
+        with _pool_lock:
+            if _cache is None:
+                _cache = VersionedQueryCache(CACHE_MAX_ENTRIES, CACHE_TTL)
+    return _cache
+
+
+def get_fallback_store():
+    """获取进程级共享的降级存储（第一次调用时创建，配置了快照就从磁盘恢复）"""
+    global _fallback
+    if _fallback is None:
+        with _pool_lock:
+            if _fallback is None:
+                _fallback = FallbackStore()
+    return _fallback
+
+
+_replay_lock = threading.Lock()
+_replay_running = False
+_replay_retry_at = 0.0
+
+
+def _schedule_replay():
+    """
+    降级存储里有待回放的写操作、数据库又连上了：在后台线程里回放。
+    不管熔断器有没有打开过都会触发（单次建连失败、熔断器还是 closed 时排队的写操作也要补进去），
+    同一时间只跑一个，回放失败后隔 REPLAY_RETRY_INTERVAL 秒再试
+    """
+    global _replay_running
+    with _replay_lock:
+        if _replay_running or time.monotonic() < _replay_retry_at:
+            return
+        _replay_running = True
+
+    def run():
+        global _replay_running
+        try:
+            DBManager().replay_fallback_writes()
+        finally:
+            with _replay_lock:
+                _replay_running = False
+
+    threading.Thread(target=run, name="db-fallback-replay", daemon=True).start()
+
+
+_schema_ready = False
+_fulltext_ready = False
+_write_listeners = []
+
+
+def add_write_listener(callback):
+    """
+    注册写操作监听器（向量库同步等）：写入提交成功后调用 callback(event, payload)
+    - ("save", [{"question_id", "user_id", "content", "image_path", "tags"}])
+    - ("update", [(question_id, new_content, new_tags)])
+    - ("delete", [question_id, ...])
+    降级存储里的写操作不通知，等回放进数据库时再通知。监听器出错不影响写操作本身。
+    """
+    if callback not in _write_listeners:
+        _write_listeners.append(callback)
+
+
+def _notify_write(event, payload):
+    for callback in list(_write_listeners):
+        try:
+            callback(event, payload)
+        except Exception as e:
+            print(f"⚠️ 写操作监听器出错 ({event}): {e}")
+
+
+def _escape_like(text):
+    """转义 LIKE 通配符，让用户输入的 % _ [ 按字面匹配"""
+    return text.replace('[', '[[]').replace('%', '[%]').replace('_', '[_]')
+
+
+def _chunks(items, size):
+    """按 size 切片；SQL Server 单条语句最多 2100 个参数，大批量要分几段（仍在同一个事务里）"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _tag_rows(tags):
+    """拆标签并截断到列宽；数据库比较不区分大小写，截断/大小写不同的重复标签再去一次重"""
+    rows = {}
+    for t in split_tags(tags):
+        rows.setdefault(t[:TAG_MAX_LEN].lower(), t[:TAG_MAX_LEN])
+    return list(rows.values())
+
+
+def _row_to_item(row):
+    """把 (QuestionID, Username, Content, ImagePath, Tags, CreatedDate) 转成页面用的字典"""
+    created = row[5]
+    return {
+        "id": row[0],
+        "username": row[1],
+        "ai_content": row[2],
+        "image_path": row[3],
+        "tags": row[4],
+        # SQL Server 返回 datetime，SQLite 返回 'YYYY-MM-DD HH:MM:SS' 字符串
+        "date": created[:10] if isinstance(created, str) else created.strftime("%Y-%m-%d")
+    }
+
+
+class _StatsDelta:
+    """攒一批写操作对统计表的增量，最后用两条 MERGE 一次写进去"""
+
+    def __init__(self):
+        self.totals = Counter()   # {UserID: 题数增量}
+        self.tags = {}            # {(UserID, 小写标签): [标签原文, 增量]}，数据库比较不区分大小写
+
+    def add(self, user_id, tags, sign, count_question=True):
+        for uid in (user_id, GLOBAL_STATS_USER):
+            if count_question:
+                self.totals[uid] += sign
+            for tag in _tag_rows(tags):
+                entry = self.tags.setdefault((uid, tag.lower()), [tag, 0])
+                entry[1] += sign
+
+    def total_rows(self):
+        """[(UserID, 题数增量)]"""
+        return [(uid, d) for uid, d in self.totals.items() if d]
+
+    def tag_rows(self):
+        """[(UserID, 标签, 增量)]"""
+        return [(uid, tag, d) for (uid, _), (tag, d) in self.tags.items() if d]
+
+    def apply(self, cursor):
+        # HOLDLOCK：MERGE 默认不对"不存在的行"加范围锁，两个事务同时插同一个新 (UserID, Tag)
+        # 都会走 NOT MATCHED 分支，后提交的那个主键冲突
+        totals = self.total_rows()
+        for chunk in _chunks(totals, MAX_SQL_PARAMS // 2):
+            values = ", ".join(["(%s, %s)"] * len(chunk))
+            cursor.execute(f"""
+                MERGE UserStats WITH (HOLDLOCK) AS s
+                USING (VALUES {values}) AS v (UserID, Delta)
+                ON s.UserID = v.UserID
+                WHEN MATCHED THEN UPDATE SET TotalQuestions = s.TotalQuestions + v.Delta
+                WHEN NOT MATCHED THEN INSERT (UserID, TotalQuestions) VALUES (v.UserID, v.Delta);
+            """, tuple(p for row in chunk for p in row))
+
+        tags = self.tag_rows()
+        for chunk in _chunks(tags, MAX_SQL_PARAMS // 3):
+            values = ", ".join(["(%s, %s, %s)"] * len(chunk))
+            cursor.execute(f"""
+                MERGE UserTagStats WITH (HOLDLOCK) AS s
+                USING (VALUES {values}) AS v (UserID, Tag, Delta)
+                ON s.UserID = v.UserID AND s.Tag = v.Tag
+                WHEN MATCHED AND s.Cnt + v.Delta <= 0 THEN DELETE
+                WHEN MATCHED THEN UPDATE SET Cnt = s.Cnt + v.Delta
+                WHEN NOT MATCHED AND v.Delta > 0 THEN INSERT (UserID, Tag, Cnt) VALUES (v.UserID, v.Tag, v.Delta);
+            """, tuple(p for row in chunk for p in row))
+
+
+def _cached(method):
+    """
+    读接口的进程级缓存：键是 (用户/管理员, 版本号, 方法名, 查询参数)。
+    降级存储的写操作不会更新版本号，所以演示模式的结果不进缓存。
+    """
+    @functools.wraps(method)
+    def wrapper(self, user_id, role, *args, **kwargs):
+        try:
+            key = self.cache.make_key(user_id, role, method.__name__, (args, tuple(sorted(kwargs.items()))))
+            hash(key)
+        except TypeError:
+            return method(self, user_id, role, *args, **kwargs)
+        hit, value = self.cache.get(key)
+        if hit:
+            return value
+        self._fallback_used = False
+        value = method(self, user_id, role, *args, **kwargs)
+        if not self._fallback_used:
+            self.cache.put(key, value)
+        return value
+    return wrapper
+
+
+def _timed(method):
+    """记录 DBManager 方法的耗时，汇总到连接池的统计里"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = method(self, *args, **kwargs)
+            ok = True
+            return result
+        finally:
+            self.pool.record_call(method.__name__, time.perf_counter() - start, ok)
+    return wrapper
+
+
+def create_db_manager():
+    """按 DB_BACKEND 环境变量创建对应的 DBManager（接口完全一样）"""
+    if DB_BACKEND == 'sqlite':
+        from sqlite_backend import SqliteDBManager
+        return SqliteDBManager()
+    return DBManager()
+
+
 class DBManager:
+    backend = "mssql"
+
     def __init__(self):
         # ================= 数据库配置 =================
         self.db_settings = {
             'server': os.getenv('DB_SERVER', 'localhost'),
             'user': os.getenv('DB_USER', 'sa'),
             'password': os.getenv('DB_PASSWORD', ''),
-            'database': os.getenv('DB_DATABASE', 'MathTutorDB')
+            'database': os.getenv('DB_DATABASE', 'MathTutorDB'),
+            'login_timeout': DB_CONNECT_TIMEOUT
         }
-        
-        # ================= 演示模式内存初始化 =================
-        # 如果连不上数据库，我们就把题目暂时存在这里
-        if 'demo_questions' not in st.session_state:
-            st.session_state.demo_questions = [
-                # 预置一条演示数据，让你打开历史记录不为空
-                {
-                    "id": 1, 
-                    "username": "admin (Demo)", 
-                    "ai_content": "这是一个演示题目。\n知识点：导数\n解析：这是手动添加的演示数据。", 
-                    "image_path": "demo.jpg", 
-                    "tags": "演示, 导数", 
-                    "date": datetime.datetime.now().strftime("%Y-%m-%d")
-                }
-            ]
+        # 连接池和熔断器都是进程级的，每次 rerun 新建 DBManager 也只是拿到同一份
+        self.pool = get_pool(self.db_settings)
+        self.breaker = get_breaker(self.db_settings)
+        self.search_index = SqlServerFullTextIndex(self.get_connection)
+        self.cache = get_query_cache()
+        # 如果连不上数据库，我们就把题目暂时存在这里（进程内共享，恢复后回放）
+        self.fallback = get_fallback_store()
+        self._fallback_used = False
+        self.ensure_schema()
 
     def get_connection(self):
-        return pymssql.connect(**self.db_settings)
+        """
+        从连接池借一条连接，close() 或退出 with 块时自动归还。
+        熔断器打开时直接抛 CircuitOpenError，不再傻等建连超时。
+        只有建连/体检失败才计入熔断；连接池满抛 PoolExhaustedError，不影响熔断器。
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError("数据库熔断中，使用演示模式")
+        try:
+            conn = self.pool.acquire()
+        except PoolExhaustedError:
+            self.breaker.release_trial()
+            raise
+        except Exception as e:
+            self.breaker.record_failure(e)
+            raise
+        self.breaker.record_success()
+        # 表结构迁移之前不回放（ensure_schema 迁移完会自己回放一次）
+        if _schema_ready and self.fallback.has_pending():
+            _schedule_replay()
+        return conn
+
+    def pool_stats(self):
+        """连接池状态 + 各方法调用耗时"""
+        return self.pool.stats()
+
+    def breaker_status(self):
+        """熔断器状态（管理员在设置页查看）"""
+        return self.breaker.status()
+
+    def cache_stats(self):
+        """查询缓存命中率等统计"""
+        return self.cache.stats()
+
+    def fallback_stats(self):
+        """降级存储里的记录数、待回放的写操作数"""
+        return self.fallback.stats()
+
+    def ensure_schema(self):
+        """每个进程执行一次 SCHEMA_MIGRATIONS（建索引等），连不上库就下次再试"""
+        global _schema_ready, _fulltext_ready
+        if _schema_ready:
+            return
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                for ddl in SCHEMA_MIGRATIONS:
+                    cursor.execute(ddl)
+                conn.commit()
+            self.migrate_question_tags()
+            self._ensure_stats()
+            _schema_ready = True
+        except CircuitOpenError:
+            return
+        except Exception as e:
+            print(f"⚠️ 表结构迁移未执行: {e}")
+            return
+
+        # 进程启动时就连上了库：把快照里恢复出来的离线写操作补进去
+        if self.fallback.has_pending():
+            self.replay_fallback_writes()
+
+        # 全文索引是可选组件（Express 版可能没装），建不起来就退回 LIKE 搜索
+        try:
+            self.search_index.setup()
+            _fulltext_ready = True
+        except Exception as e:
+            print(f"⚠️ 全文索引不可用，搜索将使用 LIKE: {e}")
+
+    def migrate_question_tags(self):
+        """
+        把还没拆过的 Questions.Tags 回填到 QuestionTags（幂等，可以重复执行）。
+        只处理 QuestionTags 里一行都没有的题目，所以新库/已迁移过的库几乎不花时间。
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT q.QuestionID, q.UserID, q.Tags
+                FROM Questions q
+                WHERE q.Tags IS NOT NULL AND q.Tags <> ''
+                  AND NOT EXISTS (SELECT 1 FROM QuestionTags t WHERE t.QuestionID = q.QuestionID)
+            """)
+            rows = [(qid, uid, tag) for qid, uid, tags in cursor.fetchall() for tag in _tag_rows(tags)]
+            for chunk in _chunks(rows, MAX_SQL_PARAMS // 3):
+                values = ", ".join(["(%s, %s, %s)"] * len(chunk))
+                cursor.execute(f"INSERT INTO QuestionTags (QuestionID, UserID, Tag) VALUES {values}",
+                               tuple(p for row in chunk for p in row))
+            conn.commit()
+        if rows:
+            print(f"🏷️ 已回填 {len(rows)} 条标签记录到 QuestionTags")
+
+    def _ensure_stats(self):
+        """统计表刚建好（还没有全站汇总行）时，从明细表算一遍"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM UserStats WHERE UserID=%s", (GLOBAL_STATS_USER,))
+            missing = cursor.fetchone() is None
+        if missing:
+            self.rebuild_stats()
+
+    def rebuild_stats(self):
+        """从 Questions / QuestionTags 重算全部 Dashboard 计数器（一个事务）"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            for sql in REBUILD_STATS_SQL:
+                cursor.execute(sql)
+            conn.commit()
+        self.cache.clear()
+        print("📊 Dashboard 统计已重算")
+        return True
+
+    def replay_fallback_writes(self):
+        """
+        把降级存储里积压的离线写操作回放进数据库：先插新题（保留原来的创建时间），
+        再按顺序执行排队的删改，全部放在一个事务里；失败整批回滚，下次恢复时再试。
+        """
+        owners, saved, replayed_ops = set(), [], []
+
+        def apply(inserts, ops):
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                delta = _StatsDelta()
+                saved.clear()
+                for q in inserts:
+                    question_id = self._insert_question(
+                        cursor, delta, q['user_id'], q['ai_content'], q['image_path'], q['tags'],
+                        created=datetime.datetime.fromisoformat(q['created']))
+                    saved.append({"question_id": question_id, "user_id": q['user_id'], "content": q['ai_content'],
+                                  "image_path": q['image_path'], "tags": q['tags']})
+                    owners.add(q['user_id'])
+                for kind, payload in ops:
+                    if kind == "delete":
+                        self._delete_rows(cursor, delta, owners, payload)
+                    else:
+                        self._update_rows(cursor, delta, owners, payload)
+                delta.apply(cursor)
+                conn.commit()
+            replayed_ops[:] = ops
+
+        global _replay_retry_at
+        try:
+            replayed = self.fallback.replay(apply)
+        except Exception as e:
+            print(f"⚠️ 离线写操作回放失败，{REPLAY_RETRY_INTERVAL:.0f} 秒后再试: {e}")
+            with _replay_lock:
+                _replay_retry_at = time.monotonic() + REPLAY_RETRY_INTERVAL
+            return 0
+        if replayed:
+            self.cache.invalidate(owners)
+            print(f"🔁 已把离线期间的 {replayed} 条写操作回放到数据库")
+            if saved:
+                _notify_write("save", saved)
+            for kind, payload in replayed_ops:
+                _notify_write(kind, payload)
+        return replayed
+
+    def _drain_fallback(self):
+        """
+        写之前先把积压的离线写操作同步回放完：只靠后台回放的话，新的在线修改会先提交，
+        排队的旧删改后落库，把它覆盖掉。
+        返回 False 表示还有没回放完的（回放失败，或者另一个线程正在回放），这次写入也得排队，保持先后顺序
+        """
+        if not self.fallback.has_pending():
+            return True
+        if time.monotonic() >= _replay_retry_at:
+            self.replay_fallback_writes()
+        if self.fallback.has_pending():
+            print("⏳ 还有离线写操作没回放完，这次写入先排队")
+            return False
+        return True
 
     # 1. 登录功能（已修复，保持原样）
+    @_timed
     def login(self, username, password):
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor(as_dict=True)
-            cursor.execute(
-                "SELECT id, username, role FROM users WHERE username=%s AND password=%s",
-                (username, password)
-            )
-            user = cursor.fetchone()
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor(as_dict=True)
+                cursor.execute(
+                    "SELECT id, username, role FROM users WHERE username=%s AND password=%s",
+                    (username, password)
+                )
+                user = cursor.fetchone()
             return user
         except Exception:
             # 演示模式：只要密码对就放行
             if username == "admin" and password == "123456":
-                return {"id": 999, "username": "admin (Demo)", "role": "student"}
+                return {"id": DEMO_USER_ID, "username": "admin (Demo)", "role": "student"}
             return None
 
     # 2. 存题功能（新增防崩坏逻辑）
+    @_timed
     def save_question(self, user_id, filename, ai_content, image_path, tags):
         """尝试保存：优先存库，失败则存入临时列表"""
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            sql = """
-                INSERT INTO Questions (UserID, Content, ImagePath, Tags, CreatedDate)
-                VALUES (%s, %s, %s, %s, GETDATE())
-            """
-            cursor.execute(sql, (user_id, ai_content, image_path, tags))
-            conn.commit()
-            conn.close()
+        if not self._drain_fallback():
+            self.fallback.add(user_id, "我", ai_content, image_path, tags)
             return True
-        except Exception as e:
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                delta = _StatsDelta()
+                question_id = self._insert_question(cursor, delta, user_id, ai_content, image_path, tags)
+                delta.apply(cursor)
+                conn.commit()
+            self.cache.invalidate([user_id])
+        except DB_UNAVAILABLE_ERRORS as e:
             print(f"❌ Database unavailable, saving to Demo Memory: {e}")
-            # === 演示模式：存入 session_state ===
-            new_id = len(st.session_state.demo_questions) + 1
-            st.session_state.demo_questions.insert(0, { # 插到最前面
-                "id": new_id,
-                "username": "Me",
-                "ai_content": ai_content,
-                "image_path": image_path, # 注意：云端并没有真实保存图片文件，但不影响文字演示
-                "tags": tags,
-                "date": datetime.datetime.now().strftime("%Y-%m-%d")
-            })
+            # === 演示模式：存入降级存储，数据库恢复后自动回放 ===
+            # 注意：云端并没有真实保存图片文件，但不影响文字演示
+            self.fallback.add(user_id, "我", ai_content, image_path, tags)
             return True
+        _notify_write("save", [{"question_id": question_id, "user_id": user_id, "content": ai_content,
+                                "image_path": image_path, "tags": tags}])
+        return True
+
+    @staticmethod
+    def _insert_question(cursor, delta, user_id, ai_content, image_path, tags, created=None):
+        """插入一道题和它的标签行，统计增量记到 delta 里；created 为空时用数据库当前时间"""
+        cursor.execute("""
+            INSERT INTO Questions (UserID, Content, ImagePath, Tags, CreatedDate)
+            OUTPUT INSERTED.QuestionID
+            VALUES (%s, %s, %s, %s, COALESCE(%s, GETDATE()))
+        """, (user_id, ai_content, image_path, tags, created))
+        question_id = cursor.fetchone()[0]
+        tag_list = _tag_rows(tags)
+        if tag_list:
+            values = ", ".join(["(%s, %s, %s)"] * len(tag_list))
+            cursor.execute(f"INSERT INTO QuestionTags (QuestionID, UserID, Tag) VALUES {values}",
+                           tuple(p for tag in tag_list for p in (question_id, user_id, tag)))
+        delta.add(user_id, tags, +1)
+        return question_id
 
     # 3. 删除功能（新增防崩坏逻辑）
     def delete_question(self, question_id):
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            sql = "DELETE FROM Questions WHERE QuestionID=%s"
-            cursor.execute(sql, (question_id,))
-            conn.commit()
-            conn.close()
+        return self.delete_questions([question_id])
+
+    # 3.1 批量删除：一条 DELETE ... IN (...)，一个事务，失败整批回滚
+    @_timed
+    def delete_questions(self, question_ids):
+        question_ids = list(question_ids)
+        if not question_ids:
             return True
-        except Exception:
-            # === 演示模式：从内存列表删除 ===
-            st.session_state.demo_questions = [
-                q for q in st.session_state.demo_questions if q['id'] != question_id
-            ]
+        if not self._drain_fallback():
+            self.fallback.delete(question_ids)
             return True
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                delta, owners = _StatsDelta(), set()
+                self._delete_rows(cursor, delta, owners, question_ids)
+                delta.apply(cursor)
+                conn.commit()
+            self.cache.invalidate(owners)
+        except DB_UNAVAILABLE_ERRORS:
+            # === 演示模式：按 ID 直接删；库里的题排队，恢复后再删 ===
+            self.fallback.delete(question_ids)
+            return True
+        _notify_write("delete", question_ids)
+        return True
+
+    @staticmethod
+    def _delete_rows(cursor, delta, owners, question_ids):
+        for chunk in _chunks(question_ids, MAX_SQL_PARAMS):
+            sql = f"""
+                DELETE FROM Questions
+                OUTPUT DELETED.UserID, DELETED.Tags
+                WHERE QuestionID IN ({', '.join(['%s'] * len(chunk))})
+            """
+            cursor.execute(sql, tuple(chunk))
+            for user_id, tags in cursor.fetchall():
+                delta.add(user_id, tags, -1)
+                owners.add(user_id)
 
     # 4. 获取历史记录（新增防崩坏逻辑）
+    @_timed
+    @_cached
     def get_history(self, user_id, role):
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            # ... 原有的数据库查询逻辑 ...
-            if role == 'admin':
-                sql = """
-                    SELECT q.QuestionID, u.Username, q.Content, q.ImagePath, q.Tags, q.CreatedDate
-                    FROM Questions q
-                    JOIN Users u ON q.UserID = u.UserID
-                    ORDER BY q.CreatedDate DESC
-                """
-                cursor.execute(sql)
-            else:
-                sql = """
-                    SELECT QuestionID, '我' as Username, Content, ImagePath, Tags, CreatedDate
-                    FROM Questions
-                    WHERE UserID=%s
-                    ORDER BY CreatedDate DESC
-                """
-                cursor.execute(sql, (user_id,))
-            
-            results = []
-            for row in cursor:
-                results.append({
-                    "id": row[0],
-                    "username": row[1],
-                    "ai_content": row[2],
-                    "image_path": row[3],
-                    "tags": row[4],
-                    "date": row[5].strftime("%Y-%m-%d")
-                })
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                # ... 原有的数据库查询逻辑 ...
+                if role == 'admin':
+                    sql = """
+                        SELECT q.QuestionID, u.Username, q.Content, q.ImagePath, q.Tags, q.CreatedDate
+                        FROM Questions q
+                        JOIN Users u ON q.UserID = u.UserID
+                        ORDER BY q.CreatedDate DESC
+                    """
+                    cursor.execute(sql)
+                else:
+                    sql = """
+                        SELECT QuestionID, '我' as Username, Content, ImagePath, Tags, CreatedDate
+                        FROM Questions
+                        WHERE UserID=%s
+                        ORDER BY CreatedDate DESC
+                    """
+                    cursor.execute(sql, (user_id,))
+
+                results = [_row_to_item(row) for row in cursor]
             return results
         except Exception:
-            # === 演示模式：返回内存里的数据 ===
-            return st.session_state.demo_questions
+            # === 演示模式：返回降级存储里的数据 ===
+            self._fallback_used = True
+            return self.fallback.history(user_id, role)
+
+    # 4.1 分页 + 筛选的历史记录（筛选条件全部下推到 SQL）
+    @_timed
+    @_cached
+    def get_history_page(self, user_id, role, search="", tag="", date_from=None, date_to=None,
+                         after=None, page_size=HISTORY_PAGE_SIZE, with_total=True):
+        """
+        按 (CreatedDate, QuestionID) 倒序做键集分页，只取一页数据。
+
+        Args:
+            search: 在题目内容和标签里模糊搜索
+            tag: 只看带这个标签的题
+            date_from / date_to: 日期范围 (datetime.date，含首尾两天)
+            after: 上一页返回的 next_cursor，None 表示第一页
+            with_total: 是否顺带统计符合条件的总数
+
+        Returns:
+            {"items": [...], "total": 总数或 None, "next_cursor": 下一页游标或 None}
+        """
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                where, params = self._history_filters(user_id, role, search, tag, date_from, date_to)
+
+                total = None
+                if with_total:
+                    cursor.execute(f"SELECT COUNT(*) FROM Questions q WHERE {' AND '.join(where)}", tuple(params))
+                    total = cursor.fetchone()[0]
+
+                if after is not None:
+                    where.append("(q.CreatedDate < %s OR (q.CreatedDate = %s AND q.QuestionID < %s))")
+                    params += [after[0], after[0], after[1]]
+
+                if role == 'admin':
+                    select = "q.QuestionID, u.Username, q.Content, q.ImagePath, q.Tags, q.CreatedDate"
+                    source = "Questions q JOIN Users u ON q.UserID = u.UserID"
+                else:
+                    select = "q.QuestionID, '我' as Username, q.Content, q.ImagePath, q.Tags, q.CreatedDate"
+                    source = "Questions q"
+                # 多取一条，用来判断还有没有下一页
+                sql = f"""
+                    SELECT TOP ({int(page_size) + 1}) {select}
+                    FROM {source}
+                    WHERE {' AND '.join(where)}
+                    ORDER BY q.CreatedDate DESC, q.QuestionID DESC
+                """
+                cursor.execute(sql, tuple(params))
+
+                # 逐行从游标里读，读够一页就停，不把结果集整个搬进内存
+                items, next_cursor, last_key = [], None, None
+                for row in cursor:
+                    if len(items) == page_size:
+                        next_cursor = last_key
+                        break
+                    items.append(_row_to_item(row))
+                    last_key = (row[5], row[0])
+            return {"items": items, "total": total, "next_cursor": next_cursor}
+        except Exception:
+            # === 演示模式：在降级存储里做同样的筛选和分页 ===
+            self._fallback_used = True
+            return self.fallback.page(user_id, role, search, tag, date_from, date_to,
+                                      after, page_size, with_total)
+
+    def iter_history(self, user_id, role, search="", tag="", date_from=None, date_to=None,
+                     page_size=100):
+        """逐页遍历所有符合条件的记录（导出试卷用），一次只在内存里放一页"""
+        after = None
+        while True:
+            page = self.get_history_page(user_id, role, search, tag, date_from, date_to,
+                                         after=after, page_size=page_size, with_total=False)
+            yield from page['items']
+            after = page['next_cursor']
+            if after is None:
+                return
+
+    def iter_questions(self, batch_size=500):
+        """
+        按 QuestionID 顺序遍历全部题目（向量库对账/重建索引用），一次只取一批。
+        返回 {"question_id", "user_id", "content", "image_path", "tags"}；连不上数据库直接抛异常，不走演示模式。
+        """
+        last_id = 0
+        while True:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f"""
+                    SELECT TOP ({int(batch_size)}) QuestionID, UserID, Content, ImagePath, Tags
+                    FROM Questions WHERE QuestionID > %s ORDER BY QuestionID
+                """, (last_id,))
+                rows = cursor.fetchall()
+            for qid, uid, content, image_path, tags in rows:
+                yield {"question_id": qid, "user_id": uid, "content": content,
+                       "image_path": image_path, "tags": tags or ""}
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    @_timed
+    def existing_question_ids(self, question_ids):
+        """这些题目 ID 里数据库中还在的（相似题图查询时过滤已删除的题用）；连不上数据库直接抛异常"""
+        found = set()
+        question_ids = list(question_ids)
+        if not question_ids:
+            return found
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            for chunk in _chunks(question_ids, MAX_SQL_PARAMS):
+                cursor.execute(f"SELECT QuestionID FROM Questions WHERE QuestionID IN ({', '.join(['%s'] * len(chunk))})",
+                               tuple(chunk))
+                found.update(qid for (qid,) in cursor.fetchall())
+        return found
+
+    # 4.2 全文搜索（按相关度排序）
+    @_timed
+    @_cached
+    def search(self, user_id, role, query, tag="", date_from=None, date_to=None, limit=SEARCH_LIMIT):
+        """
+        在题目内容和标签里全文搜索，返回按相关度排序的题目列表（最多 limit 条）。
+        标签/日期条件在相关度最高的结果里再筛一遍。
+        """
+        try:
+            if not _fulltext_ready:
+                # 没有全文索引：退回 LIKE 筛选，按时间排序
+                return self.get_history_page(user_id, role, query, tag, date_from, date_to,
+                                             page_size=limit, with_total=False)['items']
+
+            has_filters = bool(tag or date_from or date_to)
+            ranked = self.search_index.search(query, None if role == 'admin' else user_id,
+                                              limit * 5 if has_filters else limit)
+            if not ranked:
+                return []
+
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                where, params = self._history_filters(user_id, role, "", tag, date_from, date_to)
+                ids = [qid for qid, _ in ranked]
+                where.append(f"q.QuestionID IN ({', '.join(['%s'] * len(ids))})")
+                params += ids
+                if role == 'admin':
+                    select = "q.QuestionID, u.Username, q.Content, q.ImagePath, q.Tags, q.CreatedDate"
+                    source = "Questions q JOIN Users u ON q.UserID = u.UserID"
+                else:
+                    select = "q.QuestionID, '我' as Username, q.Content, q.ImagePath, q.Tags, q.CreatedDate"
+                    source = "Questions q"
+                cursor.execute(f"SELECT {select} FROM {source} WHERE {' AND '.join(where)}", tuple(params))
+                found = {row[0]: _row_to_item(row) for row in cursor}
+            return [found[qid] for qid, _ in ranked if qid in found][:limit]
+        except Exception:
+            # === 演示模式：用降级存储自带的 SQLite FTS5 索引搜 ===
+            self._fallback_used = True
+            return self.fallback.search(user_id, role, query, tag, date_from, date_to, limit)
+
+    @staticmethod
+    def _history_filters(user_id, role, search, tag, date_from, date_to):
+        where, params = ["1=1"], []
+        if role != 'admin':
+            where.append("q.UserID=%s")
+            params.append(user_id)
+        if search:
+            like = f"%{_escape_like(search)}%"
+            where.append("(q.Content LIKE %s OR q.Tags LIKE %s)")
+            params += [like, like]
+        if tag:
+            # 走 IX_QuestionTags_Tag_User 索引，精确匹配单个标签
+            where.append("EXISTS (SELECT 1 FROM QuestionTags t WHERE t.QuestionID = q.QuestionID AND t.Tag = %s)")
+            params.append(tag.strip())
+        if date_from:
+            where.append("q.CreatedDate >= %s")
+            params.append(datetime.datetime.combine(date_from, datetime.time.min))
+        if date_to:
+            where.append("q.CreatedDate < %s")
+            params.append(datetime.datetime.combine(date_to + datetime.timedelta(days=1), datetime.time.min))
+        return where, params
+
+    # 4.3 标签统计（读增量维护的 UserTagStats 计数器）
+    @_timed
+    @_cached
+    def get_tag_counts(self, user_id, role, limit=None):
+        """返回 [(标签, 题目数)]，按题目数从多到少排序；管理员看全站汇总"""
+        stats_user = GLOBAL_STATS_USER if role == 'admin' else user_id
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                top = f"TOP ({int(limit)})" if limit else ""
+                cursor.execute(f"SELECT {top} Tag, Cnt FROM UserTagStats WHERE UserID=%s "
+                               "ORDER BY Cnt DESC, Tag", (stats_user,))
+                return [(row[0], row[1]) for row in cursor]
+        except Exception:
+            # === 演示模式：现场数一遍降级存储 ===
+            self._fallback_used = True
+            return self.fallback.tag_counts(user_id, role, limit)
+
+    @_timed
+    @_cached
+    def get_dashboard_stats(self, user_id, role, top_n=5):
+        """
+        Dashboard 卡片用：总题数、覆盖知识点数、热门标签 top_n。
+        一条查询读计数器表，耗时和错题本大小无关。
+        """
+        stats_user = GLOBAL_STATS_USER if role == 'admin' else user_id
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f"""
+                    SELECT s.TotalQuestions,
+                           (SELECT COUNT(*) FROM UserTagStats x WHERE x.UserID = s.UserID) AS Topics,
+                           t.Tag, t.Cnt
+                    FROM UserStats s
+                    OUTER APPLY (
+                        SELECT TOP ({int(top_n)}) Tag, Cnt FROM UserTagStats
+                        WHERE UserID = s.UserID ORDER BY Cnt DESC, Tag
+                    ) t
+                    WHERE s.UserID = %s
+                """, (stats_user,))
+                rows = cursor.fetchall()
+            total = rows[0][0] if rows else 0
+            unique_topics = rows[0][1] if rows else 0
+            top_tags = [(row[2], row[3]) for row in rows if row[2] is not None]
+        except Exception:
+            # === 演示模式 ===
+            self._fallback_used = True
+            return self.fallback.dashboard_stats(user_id, role, top_n)
+        return {"total_questions": total, "unique_topics": unique_topics, "top_tags": top_tags}
 
     # 5. 修改功能（新增防崩坏逻辑）
     def update_question(self, question_id, new_content, new_tags):
+        return self.update_questions([(question_id, new_content, new_tags)])
+
+    # 5.1 批量修改：UPDATE ... FROM (VALUES ...)，一个事务，失败整批回滚
+    @_timed
+    def update_questions(self, changes):
+        """changes: [(question_id, new_content, new_tags), ...]"""
+        changes = list(changes)
+        if not changes:
+            return True
+        if not self._drain_fallback():
+            self.fallback.update(changes)
+            return True
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            sql = "UPDATE Questions SET Content=%s, Tags=%s WHERE QuestionID=%s"
-            cursor.execute(sql, (new_content, new_tags, question_id))
-            conn.commit()
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                delta, owners = _StatsDelta(), set()
+                self._update_rows(cursor, delta, owners, changes)
+                delta.apply(cursor)
+                conn.commit()
+            self.cache.invalidate(owners)
+        except DB_UNAVAILABLE_ERRORS:
+            # === 演示模式：按 ID 直接改；库里的题排队，恢复后再改 ===
+            self.fallback.update(changes)
             return True
-        except Exception:
-            # === 演示模式：修改内存里的数据 ===
-            for q in st.session_state.demo_questions:
-                if q['id'] == question_id:
-                    q['ai_content'] = new_content
-                    q['tags'] = new_tags
-                    break
-            return True
\ No newline at end of file
+        _notify_write("update", changes)
+        return True
+
+    @staticmethod
+    def _update_rows(cursor, delta, owners, changes):
+        for chunk in _chunks(changes, MAX_SQL_PARAMS // 3):
+            values = ", ".join(["(%s, %s, %s)"] * len(chunk))
+            sql = f"""
+                UPDATE q SET q.Content = v.Content, q.Tags = v.Tags
+                OUTPUT DELETED.UserID, DELETED.Tags, INSERTED.Tags
+                FROM Questions q
+                JOIN (VALUES {values}) AS v (QuestionID, Content, Tags)
+                  ON q.QuestionID = v.QuestionID
+            """
+            cursor.execute(sql, tuple(p for change in chunk for p in change))
+            for user_id, old_tags, new_tags in cursor.fetchall():
+                delta.add(user_id, old_tags, -1, count_question=False)
+                delta.add(user_id, new_tags, +1, count_question=False)
+                owners.add(user_id)
+
+        # 标签表：先整批删掉旧标签，再整批插入新标签（UserID 从 Questions 取）
+        ids = [qid for qid, _, _ in changes]
+        for chunk in _chunks(ids, MAX_SQL_PARAMS):
+            cursor.execute(f"DELETE FROM QuestionTags WHERE QuestionID IN ({', '.join(['%s'] * len(chunk))})",
+                           tuple(chunk))
+        tag_rows = [(qid, tag) for qid, _, tags in changes for tag in _tag_rows(tags)]
+        for chunk in _chunks(tag_rows, MAX_SQL_PARAMS // 2):
+            values = ", ".join(["(%s, %s)"] * len(chunk))
+            cursor.execute(f"""
+                INSERT INTO QuestionTags (QuestionID, UserID, Tag)
+                SELECT v.QuestionID, q.UserID, v.Tag
+                FROM (VALUES {values}) AS v (QuestionID, Tag)
+                JOIN Questions q ON q.QuestionID = v.QuestionID
+            """, tuple(p for row in chunk for p in row))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="MathMaster 数据库维护工具")
+    parser.add_argument("--rebuild-stats", action="store_true", help="从明细表重算 Dashboard 统计计数器")
+    args = parser.parse_args()
+
+    if args.rebuild_stats:
+        create_db_manager().rebuild_stats()
+    else:
+        parser.print_help()
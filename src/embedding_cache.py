@@ -0,0 +1,194 @@
+"""
+图片向量缓存模块
+同一张图片（字节完全相同）在同一个模型下只算一次向量，重复上传、重复查询都不再跑模型。
+
+- 键：sha256(模型名 + 图片字节)
+- 向量存成 float16，放在预分配的内存映射文件里，每条只占 dim * 2 字节
+- 条数有上限，满了按 LRU 淘汰最久没用过的
+- 槽位表 (index.json) 每次写入后落盘，进程重启后缓存依然有效
+- 多个进程可以共用一个缓存目录：每次读写都拿目录里的 lock 文件，只拿一次操作的时间；
+  index.json 被别的进程换过就先重新加载。等锁超时报 StoreLockedError
+"""
+import os
+import re
+import json
+import atexit
+import hashlib
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+import numpy as np
+from filelock import FileLock, Timeout
+
+
+def cache_key(model_name, image_bytes):
+    """缓存键：sha256(模型名 + 图片字节)，不用打开缓存也能算（比如在子进程里）"""
+    h = hashlib.sha256(model_name.encode("utf-8"))
+    h.update(b"\0")
+    h.update(image_bytes)
+    return h.hexdigest()
+
+
+class StoreLockedError(RuntimeError):
+    """向量缓存或向量库正被另一个进程使用"""
+
+
+class EmbeddingCache:
+    INDEX_FILE = "index.json"
+    VECTORS_FILE = "vectors.f16"
+    LOCK_FILE = "lock"
+
+    def __init__(self, cache_dir, model_name, max_entries=50000, lock_timeout=60.0):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.lock_timeout = lock_timeout
+        # 不同模型的向量维度不同，各用一个子目录
+        self.dir = os.path.join(cache_dir, re.sub(r"[^\w.-]", "_", model_name))
+        os.makedirs(self.dir, exist_ok=True)
+        # 槽位表在每个进程内存里各有一份：读写都要拿文件锁，别的进程淘汰、复用过的槽位才不会读错
+        self._file_lock = FileLock(os.path.join(self.dir, self.LOCK_FILE), timeout=lock_timeout)
+
+        self._slots = OrderedDict()   # key -> 槽位（向量文件里的行号），右端是最近用过的
+        self._dim = None
+        self._vectors = None          # np.memmap，形状 (max_entries, dim)
+        self._dirty = False
+        self._index_stamp = None      # 上次加载/写入时 index.json 的 (inode, 修改时间, 大小)
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+        with self._synced():
+            pass
+        atexit.register(self.flush)
+
+    def key_for(self, image_bytes):
+        return cache_key(self.model_name, image_bytes)
+
+    @contextmanager
+    def _synced(self):
+        """
+        拿着线程锁和文件锁做一次操作。index.json 被别的进程换过就先重新加载
+        （本进程还没落盘的 LRU 顺序直接丢掉，淘汰顺序本来就是近似的）
+        """
+        with self._lock:
+            try:
+                self._file_lock.acquire()
+            except Timeout:
+                raise StoreLockedError(f"向量缓存 {self.dir} 被另一个进程占用超过 {self.lock_timeout:g} 秒") from None
+            try:
+                if self._stamp() != self._index_stamp:
+                    self._load()
+                yield
+            finally:
+                self._file_lock.release()
+
+    # ================= 读写 =================
+    def get(self, key):
+        """命中返回 float32 向量，没命中返回 None"""
+        with self._synced():
+            slot = self._slots.get(key)
+            if slot is None:
+                self._counters["misses"] += 1
+                return None
+            self._slots.move_to_end(key)
+            self._counters["hits"] += 1
+            self._dirty = True
+            return np.asarray(self._vectors[slot], dtype=np.float32)
+
+    def put(self, key, vector):
+        self.put_many([(key, vector)])
+
+    def put_many(self, pairs):
+        """[(key, 向量)]，一次加锁写完并落盘，别的进程马上能用上"""
+        with self._synced():
+            for key, vector in pairs:
+                vector = np.asarray(vector, dtype=np.float16)
+                if self._vectors is None:
+                    self._open_vectors(vector.shape[0])
+                if vector.shape[0] != self._dim:
+                    continue
+                slot = self._slots.get(key)
+                if slot is None:
+                    slot = self._allocate_locked()
+                self._slots[key] = slot
+                self._slots.move_to_end(key)
+                self._vectors[slot] = vector
+            self._dirty = True
+            self._flush_locked()
+
+    def _allocate_locked(self):
+        if len(self._slots) < self.max_entries:
+            return len(self._slots)
+        # 满了：淘汰最久没用过的，复用它的槽位
+        _, slot = self._slots.popitem(last=False)
+        self._counters["evictions"] += 1
+        return slot
+
+    # ================= 落盘 =================
+    def _open_vectors(self, dim):
+        path = os.path.join(self.dir, self.VECTORS_FILE)
+        expected = self.max_entries * dim * np.dtype(np.float16).itemsize
+        mode = "r+" if os.path.exists(path) and os.path.getsize(path) == expected else "w+"
+        self._vectors = np.memmap(path, dtype=np.float16, mode=mode, shape=(self.max_entries, dim))
+        self._dim = dim
+
+    def _stamp(self):
+        try:
+            st = os.stat(os.path.join(self.dir, self.INDEX_FILE))
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _load(self):
+        path = os.path.join(self.dir, self.INDEX_FILE)
+        self._slots = OrderedDict()
+        self._dirty = False
+        self._index_stamp = self._stamp()
+        if self._index_stamp is None:
+            return
+        try:
+            with open(path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["model"] != self.model_name or meta["max_entries"] != self.max_entries:
+                # 容量改过：槽位对不上了，整个缓存作废重来
+                return
+            self._open_vectors(meta["dim"])
+            self._slots = OrderedDict((key, slot) for key, slot in meta["entries"])
+        except Exception as e:
+            print(f"⚠️ 向量缓存索引读取失败，将重新建立: {e}")
+            self._slots = OrderedDict()
+            self._vectors = None
+            self._dim = None
+
+    def flush(self):
+        with self._synced():
+            self._flush_locked()
+
+    def _flush_locked(self):
+        """调用方拿着文件锁"""
+        if not self._dirty or self._vectors is None:
+            return
+        self._vectors.flush()
+        meta = {
+            "model": self.model_name,
+            "dim": self._dim,
+            "max_entries": self.max_entries,
+            "entries": list(self._slots.items()),   # 按 LRU 顺序保存
+        }
+        path = os.path.join(self.dir, self.INDEX_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+        self._index_stamp = self._stamp()
+        self._dirty = False
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                "model": self.model_name,
+                "entries": len(self._slots),
+                "max_entries": self.max_entries,
+                "dim": self._dim,
+                **self._counters,
+                "hit_rate": round(self._counters["hits"] / lookups, 3) if lookups else 0.0,
+            }
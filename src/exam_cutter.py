@@ -1,19 +1,38 @@
 import cv2
 import numpy as np
 import os
+import time
+import json
 import shutil
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import fitz  # PyMuPDF
 
 # ================= 配置区域 =================
 INPUT_FOLDER = "../data/raw_exams"       
 OUTPUT_FOLDER = "../data/cut_questions"
 DEBUG_FOLDER = "../data/debug_view"  # 🟢 新增：生成的调试图放这里，方便你看哪里切歪了
+# 调试图模式：off（什么都不写）/ failure（默认，只画可疑的页：整页或某一栏一道题都没切出来）
+#            / sampled（可疑的页 + 每个文件每隔 N 页画一张）/ all（每页都画）
+# 除了 off，每页都会写一个 layout_*.json 版面记录，需要时用 --render-debug 补画任意一页
+DEBUG_MODE = os.getenv('CUTTER_DEBUG', 'failure').lower()
+DEBUG_SAMPLE_EVERY = int(os.getenv('CUTTER_DEBUG_SAMPLE', '10'))
 
-# 🟢 布局参数
+# 🟢 PDF 渲染参数 (1 倍 = 72 DPI)：版面总是用 BASE_ZOOM 的灰度图分析（单通道，比整页 RGB 省三分之二内存），
+# 小题图片再按题目区域用 RENDER_ZOOM 和 CROP_COLORSPACE 单独渲染；灰度小题、倍数一样时直接在分析图上切片
+RENDER_ZOOM = float(os.getenv('CUTTER_RENDER_ZOOM', '2'))       # 小题图片的渲染倍数
+CROP_COLORSPACE = os.getenv('CUTTER_CROP_COLORSPACE', 'rgb').lower()  # 小题图片的颜色：rgb / gray
+
+# 🟢 布局参数 (像素值都是按 2 倍渲染标定的)
+# 横向开运算之后留下的只有横向笔画和横线，切点取决于笔画细节，换个分辨率按比例缩放参数也对不上
+# (1 倍时多切出六成)，所以分析的分辨率固定，不做成可配置的
+BASE_ZOOM = 2
 FORCE_COLS = 3          # 还是按 3 栏切
 HEADER_RATIO = 0.14     # 顶部标题占大概 14% (根据你的截图目测)
 FOOTER_RATIO = 0.05     # 底部页码占 5%
 MIN_QUESTION_H = 40     # 题目最小高度
+BLANK_ROW_THRESH = 5    # 水平投影低于它算空白行，稍微调小点适应紧凑试卷
+MIN_GAP_H = 20          # 缝隙高度 > 20像素才算题与题之间的分界
+KERNEL_H = np.ones((1, 15), np.uint8)  # 横向开运算的核：腐蚀掉横线干扰，再膨胀回来
 # ===========================================
 
 def ensure_dirs():
@@ -38,18 +57,13 @@ def find_left_anchor(binary_img):
     # 这里的 binary_img 假设已经是(黑底白字)了，所以线应该是亮的竖条？
     # 不，通常二值化 threshold 之后，字和线是 255(白)，背景是 0(黑)。
     
-    v_proj = cv2.reduce(roi, 0, cv2.REDUCE_AVG)
+    v_proj = cv2.reduce(roi, 0, cv2.REDUCE_AVG)[0]
     
     # 寻找峰值：这一列像素平均值很高（说明大部分都是白色/墨水）
     # 竖线是一条贯穿上下的线，所以它的投影值应该很大
-    best_x = 0
-    max_val = 0
-    
-    for x in range(len(v_proj[0])):
-        val = v_proj[0][x]
-        if val > max_val:
-            max_val = val
-            best_x = x
+    # argmax 在并列时取最左边的一列，和逐列扫描取第一个最大值一样
+    best_x = int(np.argmax(v_proj))
+    max_val = v_proj[best_x]
             
     # 如果峰值太低，说明没线，返回默认
     if max_val < 50: 
@@ -59,11 +73,29 @@ def find_left_anchor(binary_img):
     print(f"      ⚓ 锁定装订线位置: x={best_x}")
     return best_x + 20 # 线本身有宽度，往右挪 20 像素开始切
 
-def process_page(img, base_filename, page_num=0):
-    print(f"   ...正在处理第 {page_num+1} 页...")
+def find_row_cuts(h_proj):
+    """
+    🟢 由水平投影找切点：连续空白行组成缝隙，缝隙高度 > MIN_GAP_H 就在缝隙中间切一刀
+    返回 [0, 切点..., 总行数]。延伸到底部的缝隙后面没有内容，不切。
+    """
+    blank = h_proj.ravel() < BLANK_ROW_THRESH
+    # 前后各补一个非空白行，差分后 +1 是缝隙起点，-1 是缝隙后第一个有内容的行
+    edges = np.diff(np.concatenate(([0], blank.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    keep = (ends < len(blank)) & (ends - starts > MIN_GAP_H)
+    mids = starts[keep] + (ends[keep] - starts[keep]) // 2
+    return [0, *mids.tolist(), len(blank)]
+
+def analyze_page(img):
+    """
+    只分析不写盘：找装订线、分栏、按空白行切题
+    返回版面记录 {"width", "height", "y_top", "y_bottom", "x_start", "columns": [{"x1", "x2", "questions": [[y1, y2], ...]}]}，
+    坐标都是整页坐标，每道题就是 img[y1:y2, x1:x2]
+    """
     h, w = img.shape[:2]
     
-    # 1. 预处理
+    # 1. 预处理：灰度、二值化整页只做一次，后面每一栏都直接取切片（不拷贝）
     if len(img.shape) == 3:
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     else:
@@ -83,21 +115,11 @@ def process_page(img, base_filename, page_num=0):
     content_width = w - x_start
     col_width = content_width // FORCE_COLS
     
-    # ================= 调试绘图 (画出我们打算怎么切) =================
-    debug_img = img.copy()
-    # 画出有效区域框 (绿色)
-    cv2.rectangle(debug_img, (x_start, y_top), (w, y_bottom), (0, 255, 0), 2)
-    # 画出每一栏的分界线 (蓝色)
-    for i in range(1, FORCE_COLS):
-        cx = x_start + i * col_width
-        cv2.line(debug_img, (cx, 0), (cx, h), (255, 0, 0), 2)
-    
-    # 保存调试图
-    debug_path = os.path.join(DEBUG_FOLDER, f"debug_{base_filename}_p{page_num+1}.jpg")
-    cv2.imwrite(debug_path, debug_img)
-    # ===========================================================
-
-    total_q = 0
+    layout = {"width": w, "height": h, "y_top": y_top, "y_bottom": y_bottom, "x_start": x_start, "columns": []}
+    body = binary[y_top:y_bottom]
+    # 开运算的结果整页共用两块缓冲区，每一栏写进自己那几列（dst=），不再每栏新分配
+    eroded = np.empty_like(body)
+    opened = np.empty_like(body)
     
     # 3. 开始循环切栏
     for i in range(FORCE_COLS):
@@ -109,50 +131,155 @@ def process_page(img, base_filename, page_num=0):
         col_img = img[y_top:y_bottom, cx1:cx2]
         
         # 4. 横向切题
-        # 重新二值化这一栏
-        col_gray = cv2.cvtColor(col_img, cv2.COLOR_BGR2GRAY)
-        _, col_bin = cv2.threshold(col_gray, 200, 255, cv2.THRESH_BINARY_INV)
-        
         # 腐蚀掉横线干扰 (把横线变没)
-        kernel_h = np.ones((1, 15), np.uint8) 
-        clean_bin = cv2.erode(col_bin, kernel_h, iterations=1)
-        clean_bin = cv2.dilate(clean_bin, kernel_h, iterations=1)
+        # 注意要按栏分别做：整页一起做的话，栏边上的像素会被隔壁栏影响，切点就变了
+        clean_bin = opened[:, cx1:cx2]
+        cv2.erode(body[:, cx1:cx2], KERNEL_H, dst=eroded[:, cx1:cx2])
+        cv2.dilate(eroded[:, cx1:cx2], KERNEL_H, dst=clean_bin)
         
         # 水平投影
         h_proj = cv2.reduce(clean_bin, 1, cv2.REDUCE_AVG)
         
         # 找切点
-        cuts = [0]
-        is_gap = False
-        gap_start = 0
+        cuts = find_row_cuts(h_proj)
         
-        # 这里的 5 是横向缝隙的判断阈值，稍微调小点适应紧凑试卷
-        for y in range(len(h_proj)):
-            if h_proj[y][0] < 5: # 空白
-                if not is_gap:
-                    is_gap = True
-                    gap_start = y
-            else:
-                if is_gap:
-                    if (y - gap_start) > 20: # 缝隙高度 > 20像素才算
-                        mid = gap_start + (y - gap_start)//2
-                        cuts.append(mid)
-                    is_gap = False
-        cuts.append(len(h_proj))
-        
-        # 保存小题
+        questions = []
         for k in range(len(cuts)-1):
             y1 = cuts[k]
             y2 = cuts[k+1]
             if (y2 - y1) > MIN_QUESTION_H:
-                q_sub = col_img[y1:y2, :]
                 # 检查是不是全白
-                if cv2.mean(q_sub)[0] < 250:
-                    save_name = f"{base_filename}_p{page_num+1}_c{i+1}_q{total_q+1}.jpg"
-                    cv2.imwrite(os.path.join(OUTPUT_FOLDER, save_name), q_sub)
-                    total_q += 1
+                if cv2.mean(col_img[y1:y2, :])[0] < 250:
+                    questions.append([y_top + y1, y_top + y2])
+        layout["columns"].append({"x1": cx1, "x2": cx2, "questions": questions})
+    return layout
+
+def process_page(img, base_filename, page_num=0, source=None, pdf_page=None):
+    """
+    切一页并把小题存进 OUTPUT_FOLDER，版面记录存进 DEBUG_FOLDER，返回切出几道题
+    source: (文件路径, PDF 页号或 None)，记在版面记录里，之后 render_debug 重新生成调试图时用
+    pdf_page: PDF 的页时传 fitz 的 page，img 是 render_analysis_image 渲染的图，
+              彩色小题或 RENDER_ZOOM 和 BASE_ZOOM 不一样时，小题按区域从 PDF 重新渲染
+    """
+    print(f"   ...正在处理第 {page_num+1} 页...")
+    layout = analyze_layout(img, pdf_page)
+
+    # 保存小题
+    total_q = 0
+    for i, q, crop in iter_crops(img, layout, pdf_page):
+        save_name = f"{base_filename}_p{page_num+1}_c{i}_q{q}.jpg"
+        cv2.imwrite(os.path.join(OUTPUT_FOLDER, save_name), crop)
+        total_q += 1
+
+    # ================= 调试记录 =================
+    # 每页只写一个很小的 JSON 版面记录；画线的调试图按 DEBUG_MODE 决定要不要现在画，其余的以后用 render_debug 补
+    name = f"{base_filename}_p{page_num+1}"
+    layout["source"], layout["page"] = source or (None, None)
+    layout["name"] = name
+    layout["suspicious"] = total_q == 0 or any(not col["questions"] for col in layout["columns"])
+    if DEBUG_MODE != "off":
+        with open(os.path.join(DEBUG_FOLDER, f"layout_{name}.json"), "w", encoding="utf-8") as f:
+            json.dump(layout, f, ensure_ascii=False)
+        if (DEBUG_MODE == "all"
+                or (DEBUG_MODE == "sampled" and page_num % DEBUG_SAMPLE_EVERY == 0)
+                or layout["suspicious"]):
+            cv2.imwrite(os.path.join(DEBUG_FOLDER, f"debug_{name}.jpg"), draw_layout(img, layout))
+    # ===========================================
 
     print(f"      ✅ 页面处理完毕，切出 {total_q} 道题")
+    return total_q
+
+def analyze_layout(img, pdf_page=None):
+    """分析版面；PDF 页的 img 是按 BASE_ZOOM 渲染的，渲染倍数记进版面记录"""
+    layout = analyze_page(img)
+    layout["zoom"] = None if pdf_page is None else BASE_ZOOM
+    return layout
+
+def iter_crops(img, layout, pdf_page=None):
+    """
+    按版面记录逐道题取图：(栏号, 题号, 图片)，都从 1 开始，题号整页连续编号
+    图片（以及灰度小题、RENDER_ZOOM 等于分析倍数的 PDF 页）直接在原图上切片；其余 PDF 页，每一栏按题目所在区域
+    用 RENDER_ZOOM 重新渲染一条（clip），再从里面切出每道题。扫描件每次渲染都要重新解码整页图片，所以按栏渲染而不是按题渲染
+    """
+    rerender = pdf_page is not None and (layout["zoom"] != RENDER_ZOOM or CROP_COLORSPACE != "gray")
+    total_q = 0
+    for i, col in enumerate(layout["columns"]):
+        if not col["questions"]:
+            continue
+        if rerender:
+            zoom = layout["zoom"]
+            top, bottom = col["questions"][0][0], col["questions"][-1][1]
+            clip = fitz.Rect(col["x1"] / zoom, top / zoom, col["x2"] / zoom, bottom / zoom)
+            pix = pdf_page.get_pixmap(matrix=fitz.Matrix(RENDER_ZOOM, RENDER_ZOOM), clip=clip,
+                                      colorspace=fitz.csGRAY if CROP_COLORSPACE == "gray" else fitz.csRGB)
+            strip = pixmap_to_image(pix)
+            scale = RENDER_ZOOM / zoom
+        for y1, y2 in col["questions"]:
+            total_q += 1
+            if not rerender:
+                crop = img[y1:y2, col["x1"]:col["x2"]]
+            else:
+                # pix.y 是这一条在整页里的起始行 (RENDER_ZOOM 分辨率)
+                crop = strip[round(y1 * scale) - pix.y:round(y2 * scale) - pix.y]
+            yield i + 1, total_q, crop
+
+def draw_layout(img, layout):
+    """在页面的副本上画出怎么切的：有效区域 (绿色)、栏分界线 (蓝色)、每道题 (红色)"""
+    debug_img = img.copy() if img.ndim == 3 else cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    h, w = debug_img.shape[:2]
+    cv2.rectangle(debug_img, (layout["x_start"], layout["y_top"]), (w, layout["y_bottom"]), (0, 255, 0), 2)
+    for col in layout["columns"]:
+        if col["x1"] != layout["x_start"]:
+            cv2.line(debug_img, (col["x1"], 0), (col["x1"], h), (255, 0, 0), 2)
+        for y1, y2 in col["questions"]:
+            cv2.rectangle(debug_img, (col["x1"] + 4, y1), (col["x2"] - 4, y2 - 1), (0, 0, 255), 1)
+    return debug_img
+
+def render_debug(names):
+    """
+    按版面记录重新生成调试图（会重新读原始试卷，不用重新切题）
+    names: 页面名（如 "期中卷_p3"）或版面记录文件路径；返回生成了几张
+    """
+    count = 0
+    for name in names:
+        path = name if name.endswith(".json") else os.path.join(DEBUG_FOLDER, f"layout_{name}.json")
+        try:
+            with open(path, encoding="utf-8") as f:
+                layout = json.load(f)
+            if not layout.get("source"):
+                print(f"⚠️ {layout['name']} 没有记录原始文件，无法重画")
+                continue
+            if layout["page"] is None:
+                img = cv2.imread(layout["source"])
+            else:
+                with fitz.open(layout["source"]) as doc:
+                    # 按分析时的分辨率渲染，版面记录里的坐标才对得上（早期的记录没有 zoom，都是 2 倍）
+                    img = render_pdf_page(doc.load_page(layout["page"]), layout.get("zoom") or BASE_ZOOM)
+            out = os.path.join(DEBUG_FOLDER, f"debug_{layout['name']}.jpg")
+            cv2.imwrite(out, draw_layout(img, layout))
+            print(f"🖍️ 已生成 {out}")
+            count += 1
+        except Exception as e:
+            print(f"❌ 调试图生成失败 {name}: {e}")
+    return count
+
+def pixmap_to_image(pix):
+    """fitz 的 Pixmap 转成 OpenCV 图片：灰度 Pixmap 是单通道，彩色的转成 BGR"""
+    img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    if pix.n == 1: return img[:, :, 0]
+    return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+
+def render_pdf_page(page, zoom=RENDER_ZOOM, gray=False):
+    """把 PDF 的一页渲染成图片：gray=True 是单通道灰度图，否则是 BGR 图片"""
+    return pixmap_to_image(page.get_pixmap(matrix=fitz.Matrix(zoom, zoom),
+                                           colorspace=fitz.csGRAY if gray else fitz.csRGB))
+
+def render_analysis_image(page):
+    """
+    分析版面用的图：BASE_ZOOM 倍的灰度图。彩色小题由 iter_crops 按栏重新渲染，
+    整页不再渲染一份 RGB（以前 2 倍 RGB 整页图占的内存是它的三倍）
+    """
+    return render_pdf_page(page, BASE_ZOOM, gray=True)
 
 def process_pdf(path, fname):
     print(f"📄 读取 PDF: {fname}")
@@ -160,22 +287,137 @@ def process_pdf(path, fname):
     base = os.path.splitext(fname)[0]
     for i in range(len(doc)):
         page = doc.load_page(i)
-        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-        img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
-        if pix.n >= 3: img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-        process_page(img, base, i)
+        process_page(render_analysis_image(page), base, i, (path, i), page)
+
+# ================= 内存接口 =================
+def iter_questions(data, filename="upload.pdf", encode=None):
+    """
+    不读写磁盘的切题接口：传入 PDF 或图片的字节，边切边逐道题返回
+    
+    Args:
+        data: 文件内容 (bytes)
+        filename: 原文件名，用来判断类型、拼小题文件名
+        encode: None 返回 numpy 图片（整页图或按栏渲染的图上的切片）；".jpg" / ".png" 返回编码好的字节
+        
+    Yields:
+        {"name": 小题文件名（和批量切出来的一样）, "page", "column", "index": 从 1 开始, "image": 图片或字节}
+    """
+    base = os.path.splitext(os.path.basename(filename))[0]
+    if data[:5] == b"%PDF-" or filename.lower().endswith(".pdf"):
+        with fitz.open(stream=data, filetype="pdf") as doc:
+            for i in range(len(doc)):
+                page = doc.load_page(i)
+                yield from _page_questions(render_analysis_image(page), base, i, encode, page)
+    else:
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"无法解码图片: {filename}")
+        yield from _page_questions(img, base, 0, encode)
+
+def _page_questions(img, base_filename, page_num, encode, pdf_page=None):
+    for i, q, crop in iter_crops(img, analyze_layout(img, pdf_page), pdf_page):
+        if encode:
+            crop = cv2.imencode(encode, crop)[1].tobytes()
+        yield {"name": f"{base_filename}_p{page_num+1}_c{i}_q{q}.jpg",
+               "page": page_num + 1, "column": i, "index": q, "image": crop}
+
+# ================= 批量流水线 =================
+# 主进程只负责列出 (文件, 页号) 任务，渲染和切题都在子进程里做，整页图片不用在进程间传递。
+# 同时在跑或排队的任务最多 workers * 2 个，内存里最多也就这么多页。
+_open_pdfs = {}   # 每个子进程自己缓存打开的 PDF，连续几页落在同一个进程时不用重新打开
+
+def _open_pdf(path):
+    doc = _open_pdfs.get(path)
+    if doc is None:
+        while len(_open_pdfs) >= 2:
+            _open_pdfs.pop(next(iter(_open_pdfs))).close()
+        doc = _open_pdfs[path] = fitz.open(path)
+    return doc
+
+def iter_jobs(paths):
+    """按文件顺序逐个列出任务：PDF 每页一个 (路径, 页号)，图片是 (路径, None)；用到时才打开 PDF 数页数"""
+    for path in paths:
+        if path.lower().endswith('.pdf'):
+            with fitz.open(path) as doc:
+                pages = len(doc)
+            for i in range(pages):
+                yield path, i
+        else:
+            yield path, None
+
+def cut_job(job):
+    """
+    渲染（或读取）一页并切题，可以在子进程里跑
+    返回 (文件名, 页号, 切出几道题, 渲染秒数, 切题秒数)
+    """
+    path, page_index = job
+    fname = os.path.basename(path)
+    start = time.perf_counter()
+    page = None
+    if page_index is None:
+        img = cv2.imread(path)
+    else:
+        page = _open_pdf(path).load_page(page_index)
+        img = render_analysis_image(page)
+    rendered = time.perf_counter()
+    count = process_page(img, os.path.splitext(fname)[0], page_index or 0, (path, page_index), page)
+    return fname, page_index or 0, count, rendered - start, time.perf_counter() - rendered
+
+def run_batch(paths, workers=1):
+    """切一批试卷：workers > 1 时用进程池并行处理多个文件的多页，返回切出的题目总数"""
+    start = time.perf_counter()
+    pages = questions = 0
+
+    def report(fname, page_num, count, render_s, cut_s):
+        nonlocal pages, questions
+        pages += 1
+        questions += count
+        print(f"   ⏱️ {fname} 第 {page_num+1} 页: 渲染 {render_s*1000:.0f} ms, 切题 {cut_s*1000:.0f} ms, {count} 道题")
+
+    if workers <= 1:
+        for job in iter_jobs(paths):
+            report(*cut_job(job))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            running = {}
+
+            def collect(done):
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        report(*future.result())
+                    except Exception as e:
+                        print(f"❌ {os.path.basename(job[0])} 第 {(job[1] or 0)+1} 页处理失败: {e}")
+
+            for job in iter_jobs(paths):
+                if len(running) >= workers * 2:
+                    # 队列满了：等至少一页做完再派发，控制内存峰值
+                    collect(wait(running, return_when=FIRST_COMPLETED).done)
+                running[pool.submit(cut_job, job)] = job
+            collect(wait(running).done)
+
+    seconds = time.perf_counter() - start
+    print(f"📊 共 {pages} 页, {questions} 道题, 用时 {seconds:.1f}s ({pages / seconds if seconds else 0:.1f} 页/秒)")
+    return questions
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="试卷自动切题")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="并行处理的进程数，1 表示在当前进程里逐页处理")
+    parser.add_argument("--render-debug", nargs="+", metavar="PAGE",
+                        help="不切题，按版面记录重新画这几页的调试图（页面名如 期中卷_p3，或 layout_*.json 路径）")
+    args = parser.parse_args()
+
     ensure_dirs()
+    if args.render_debug:
+        render_debug(args.render_debug)
+        raise SystemExit
     files = [f for f in os.listdir(INPUT_FOLDER) if f.lower().endswith(('.pdf','.jpg','.png'))]
     if not files:
         print("请放入试卷文件")
     else:
         print("🚀 启动锚点自动定位切割...")
-        for f in files:
-            path = os.path.join(INPUT_FOLDER, f)
-            if f.endswith('.pdf'): process_pdf(path, f)
-            else: 
-                img = cv2.imread(path)
-                process_page(img, os.path.splitext(f)[0])
-        print(f"\n🏁 完成！如果还是切歪了，请务必去 {DEBUG_FOLDER} 看看那张画线的图！")
\ No newline at end of file
+        run_batch([os.path.join(INPUT_FOLDER, f) for f in sorted(files)], args.workers)
+        print(f"\n🏁 完成！如果还是切歪了，请务必去 {DEBUG_FOLDER} 看看那张画线的图！"
+              f"（没画的页可以用 --render-debug 页面名 补画）")
\ No newline at end of file
@@ -0,0 +1,284 @@
+"""
+降级存储模块
+SQL Server 不可用时，DBManager 的读写都转到这里：一个进程内共享的内存存储。
+
+- 按 ID 建字典，另外每个用户一份按时间排好的序号列表，删/改/分页都不用扫全表
+- ID 从 -1 开始递减，永远不会和数据库的自增 ID 撞上，删除后也不会重复
+- 离线期间的写操作（新存的题、对库里已有题目的删改）会排队，数据库恢复后一次性回放
+- 配置了快照路径时，定期把内容写到磁盘，进程重启后排队的写操作不会丢
+"""
+import os
+import json
+import time
+import bisect
+import datetime
+import threading
+from collections import Counter
+from search_index import SqliteFtsIndex
+from utils import split_tags
+
+SNAPSHOT_PATH = os.getenv('FALLBACK_SNAPSHOT_PATH', '')                   # 为空表示不落盘
+SNAPSHOT_INTERVAL = float(os.getenv('FALLBACK_SNAPSHOT_INTERVAL', '30'))  # 有改动时每隔几秒写一次快照
+DEMO_USER_ID = 999   # 演示账号，它的题目只存在内存里，不回放到数据库
+
+
+class FallbackStore:
+    """
+    记录的格式和 DBManager 返回给页面的一样（id/username/ai_content/image_path/tags/date），
+    另外带 user_id、created（精确时间）和 pending（是否还要回放进数据库）。
+    内部用序号 seq = -id 排序：seq 越大越新。
+    """
+
+    def __init__(self, snapshot_path=SNAPSHOT_PATH, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+
+        self._items = {}      # id -> 记录
+        self._all = []        # 全部记录的 seq，升序
+        self._by_user = {}    # user_id -> 该用户记录的 seq，升序
+        self._next_seq = 1
+        self._ops = []        # 排队的删改：[("delete", [id, ...]) / ("update", [(id, content, tags), ...])]
+        self._pending = 0     # 还要回放进数据库的新题数（DBManager 每次借连接都会看一眼，不能扫全表）
+        self._dirty = False
+        self._lock = threading.RLock()
+        self._replay_lock = threading.Lock()
+        self._index = SqliteFtsIndex()
+        self._snapshot_thread = None
+
+        if not (snapshot_path and self.load_snapshot()):
+            # 预置一条演示数据，让你打开历史记录不为空
+            self.add(DEMO_USER_ID, "admin (Demo)",
+                     "这是一个演示题目。\n知识点：导数\n解析：这是手动添加的演示数据。",
+                     "demo.jpg", "演示, 导数")
+        if snapshot_path:
+            self._snapshot_thread = threading.Thread(target=self._snapshot_loop,
+                                                     name="fallback-snapshot", daemon=True)
+            self._snapshot_thread.start()
+
+    # ================= 写操作 =================
+    def add(self, user_id, username, ai_content, image_path, tags):
+        """存一道新题，返回它的（负数）ID"""
+        now = datetime.datetime.now()
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._insert_locked(seq, {
+                "id": -seq,
+                "user_id": user_id,
+                "username": username,
+                "ai_content": ai_content,
+                "image_path": image_path,
+                "tags": tags,
+                "date": now.strftime("%Y-%m-%d"),
+                "created": now.isoformat(sep=' ', timespec='seconds'),
+                "pending": user_id != DEMO_USER_ID,
+            })
+            self._dirty = True
+        return -seq
+
+    def delete(self, question_ids):
+        """删内存里的题；正数 ID 是数据库里的题，排队等恢复后再删"""
+        with self._lock:
+            local = [qid for qid in question_ids if qid in self._items]
+            for qid in local:
+                self._remove_locked(qid)
+            remote = [qid for qid in question_ids if qid > 0]
+            if remote:
+                self._ops.append(("delete", remote))
+            self._dirty = True
+        self._index.delete(local)
+
+    def update(self, changes):
+        """changes: [(id, new_content, new_tags)]；数据库里的题同样排队"""
+        with self._lock:
+            local = []
+            for qid, content, tags in changes:
+                if qid in self._items:
+                    self._items[qid] = dict(self._items[qid], ai_content=content, tags=tags)
+                    local.append((qid, self._items[qid]['user_id'], content, tags))
+            remote = [c for c in changes if c[0] > 0]
+            if remote:
+                self._ops.append(("update", remote))
+            self._dirty = True
+        for row in local:
+            self._index.upsert(*row)
+
+    def _insert_locked(self, seq, record):
+        self._items[record['id']] = record
+        # seq 单调递增，直接 append 就是有序的
+        self._all.append(seq)
+        self._by_user.setdefault(record['user_id'], []).append(seq)
+        self._pending += record['pending']
+        self._index.upsert(record['id'], record['user_id'], record['ai_content'], record['tags'])
+
+    def _remove_locked(self, qid):
+        record = self._items.pop(qid)
+        self._pending -= record['pending']
+        for seqs in (self._all, self._by_user.get(record['user_id'], [])):
+            i = bisect.bisect_left(seqs, -qid)
+            if i < len(seqs) and seqs[i] == -qid:
+                del seqs[i]
+
+    # ================= 读操作 =================
+    def _seqs(self, user_id, role):
+        return self._all if role == 'admin' else self._by_user.get(user_id, [])
+
+    @staticmethod
+    def _matcher(search, tag, date_from, date_to):
+        search, tag = (search or "").lower(), (tag or "").strip().lower()
+        date_from = date_from.strftime("%Y-%m-%d") if date_from else None
+        date_to = date_to.strftime("%Y-%m-%d") if date_to else None
+        if not (search or tag or date_from or date_to):
+            return None
+
+        def match(q):
+            return ((not search or search in q['tags'].lower() or search in q['ai_content'].lower())
+                    and (not tag or tag in [t.lower() for t in split_tags(q['tags'])])
+                    and (not date_from or q['date'] >= date_from)
+                    and (not date_to or q['date'] <= date_to))
+        return match
+
+    def get(self, question_id):
+        with self._lock:
+            record = self._items.get(question_id)
+            return dict(record) if record else None
+
+    def history(self, user_id, role):
+        """全部记录，最新的在前"""
+        with self._lock:
+            return [dict(self._items[-seq]) for seq in reversed(self._seqs(user_id, role))]
+
+    def page(self, user_id, role, search="", tag="", date_from=None, date_to=None,
+             after=None, page_size=20, with_total=True):
+        """和 DBManager.get_history_page 一样的返回格式，游标是上一页最后一条的 ID"""
+        match = self._matcher(search, tag, date_from, date_to)
+        with self._lock:
+            seqs = self._seqs(user_id, role)
+            # 数据库那边的游标是 (时间, ID) 元组，切到降级存储时从第一页重新开始
+            end = bisect.bisect_left(seqs, -after) if isinstance(after, int) else len(seqs)
+
+            items, next_cursor = [], None
+            for i in range(end - 1, -1, -1):
+                record = self._items[-seqs[i]]
+                if match and not match(record):
+                    continue
+                if len(items) == page_size:
+                    next_cursor = items[-1]['id']
+                    break
+                items.append(dict(record))
+
+            total = None
+            if with_total:
+                total = sum(1 for seq in seqs if match(self._items[-seq])) if match else len(seqs)
+        return {"items": items, "total": total, "next_cursor": next_cursor}
+
+    def search(self, user_id, role, query, tag="", date_from=None, date_to=None, limit=50):
+        """FTS5 按相关度排序，再用标签/日期条件筛一遍"""
+        match = self._matcher("", tag, date_from, date_to)
+        ranked = self._index.search(query, None if role == 'admin' else user_id, limit * 5 if match else limit)
+        results = []
+        with self._lock:
+            for qid, _ in ranked:
+                record = self._items.get(qid)
+                if record and (not match or match(record)):
+                    results.append(dict(record))
+                    if len(results) == limit:
+                        break
+        return results
+
+    def tag_counts(self, user_id, role, limit=None):
+        with self._lock:
+            counts = Counter(t for seq in self._seqs(user_id, role) for t in split_tags(self._items[-seq]['tags']))
+        return counts.most_common(limit)
+
+    def dashboard_stats(self, user_id, role, top_n=5):
+        with self._lock:
+            seqs = self._seqs(user_id, role)
+            counts = Counter(t for seq in seqs for t in split_tags(self._items[-seq]['tags']))
+            total = len(seqs)
+        return {"total_questions": total, "unique_topics": len(counts), "top_tags": counts.most_common(top_n)}
+
+    # ================= 恢复后回放 =================
+    def has_pending(self):
+        with self._lock:
+            return bool(self._ops) or self._pending > 0
+
+    def replay(self, apply):
+        """
+        把排队的写操作交给 apply(inserts, ops) 写进数据库（调用方负责放在一个事务里）。
+        apply 成功后，回放过的题目从内存里移除；抛异常则什么都不动，下次再试。
+        同一时间只允许一个线程回放，返回回放的条数。
+        """
+        if not self._replay_lock.acquire(blocking=False):
+            return 0
+        try:
+            with self._lock:
+                inserts = [dict(self._items[-seq]) for seq in self._all if self._items[-seq]['pending']]
+                ops = list(self._ops)
+            if not inserts and not ops:
+                return 0
+            apply(inserts, ops)
+            with self._lock:
+                for record in inserts:
+                    if record['id'] in self._items:
+                        self._remove_locked(record['id'])
+                del self._ops[:len(ops)]
+                self._dirty = True
+            self._index.delete([r['id'] for r in inserts])
+            return len(inserts) + len(ops)
+        finally:
+            self._replay_lock.release()
+
+    # ================= 快照 =================
+    def save_snapshot(self):
+        """先写临时文件再改名，写到一半崩溃也不会留下损坏的快照"""
+        with self._lock:
+            data = {
+                "next_seq": self._next_seq,
+                "items": [self._items[-seq] for seq in self._all],
+                "ops": self._ops,
+            }
+            payload = json.dumps(data, ensure_ascii=False)
+            self._dirty = False
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def load_snapshot(self):
+        """读取快照，成功返回 True"""
+        if not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"⚠️ 降级存储快照读取失败: {e}")
+            return False
+        with self._lock:
+            for record in data["items"]:
+                self._insert_locked(-record['id'], record)
+            self._next_seq = data["next_seq"]
+            self._ops = [(kind, [tuple(x) if isinstance(x, list) else x for x in payload])
+                         for kind, payload in data["ops"]]
+        print(f"💾 已从快照恢复 {len(data['items'])} 条降级存储记录")
+        return True
+
+    def _snapshot_loop(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            if not self._dirty:
+                continue
+            try:
+                self.save_snapshot()
+            except Exception as e:
+                print(f"⚠️ 降级存储快照写入失败: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "records": len(self._items),
+                "pending_inserts": self._pending,
+                "queued_ops": len(self._ops),
+                "snapshot_path": self.snapshot_path or None,
+            }
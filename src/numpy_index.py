@@ -0,0 +1,313 @@
+"""
+NumPy 暴力检索向量库
+几万条向量的规模下，精确的矩阵乘法比 HNSW 图更省内存、启动更快，召回率还是 100%（float16）。
+
+- 向量先归一化，存成 float16（或 int8 量化，每行一个缩放系数）的内存映射矩阵，余弦相似度就是点积
+- 一次矩阵乘法处理一批查询，argpartition 取 top-k
+- 文档和元数据存在旁边的 SQLite 文件里，元数据在内存里建倒排表，where 条件先过滤再打分
+- 接口和 Chroma 的 collection 一样（upsert/get/update/delete/query/count），MathKnowledgeBase 可以直接替换
+"""
+import os
+import json
+import sqlite3
+import threading
+import numpy as np
+
+INT8_MAX = 127.0     # int8 量化时每行最大的分量映射到 ±127
+SCORE_BLOCK = 8192   # 打分时每次转成 float32 的行数，临时内存 = SCORE_BLOCK * dim * 4 字节
+
+
+def _grow_file(path, dtype, old_shape, new_shape):
+    old = np.memmap(path, dtype=dtype, mode="r", shape=old_shape)
+    grown = np.memmap(path + ".tmp", dtype=dtype, mode="w+", shape=new_shape)
+    grown[:old_shape[0]] = old
+    grown.flush()
+    del grown, old
+    os.replace(path + ".tmp", path)
+
+
+class NumpyVectorIndex:
+    VECTORS_FILE = "vectors.{dtype}"
+    SCALES_FILE = "scales.f32"
+    SIDECAR_FILE = "sidecar.db"
+
+    def __init__(self, path, dtype="float16", initial_capacity=1024):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"不支持的向量类型: {dtype}")
+        self.path = path
+        self.dtype = dtype
+        os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(os.path.join(path, self.SIDECAR_FILE), check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (
+                slot INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                document TEXT,
+                metadata TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+
+        settings = dict(self._db.execute("SELECT key, value FROM settings"))
+        if settings and settings["dtype"] != dtype:
+            raise ValueError(f"{path} 里的向量是 {settings['dtype']}，不能按 {dtype} 打开")
+        self._dim = int(settings["dim"]) if settings else None
+        self._capacity = int(settings.get("capacity", initial_capacity))
+        self._vectors = self._scales = None
+        if self._dim:
+            self._open_vectors()
+
+        # 内存里的索引：id <-> 槽位、每个槽位的元数据、元数据倒排表
+        self._slot_of = {}
+        self._ids = {}
+        self._metadatas = {}
+        self._postings = {}     # 字段 -> 值 -> 槽位集合
+        self._free = []
+        for slot, doc_id, metadata in self._db.execute("SELECT slot, id, metadata FROM docs"):
+            self._index_locked(slot, doc_id, json.loads(metadata))
+        used = set(self._ids)
+        self._free = [s for s in range(self._capacity) if s not in used][::-1]
+
+    # ================= 存储 =================
+    def _vectors_path(self):
+        return os.path.join(self.path, self.VECTORS_FILE.format(dtype=self.dtype))
+
+    def _open_vectors(self):
+        path = self._vectors_path()
+        mode = "r+" if os.path.exists(path) else "w+"
+        self._vectors = np.memmap(path, dtype=self.dtype, mode=mode, shape=(self._capacity, self._dim))
+        if self.dtype == "int8":
+            path = os.path.join(self.path, self.SCALES_FILE)
+            mode = "r+" if os.path.exists(path) else "w+"
+            self._scales = np.memmap(path, dtype=np.float32, mode=mode, shape=(self._capacity,))
+
+    def _flush_vectors(self):
+        self._vectors.flush()
+        if self._scales is not None:
+            self._scales.flush()
+
+    def _save_settings(self):
+        self._db.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", [
+            ("dim", str(self._dim)), ("dtype", self.dtype), ("capacity", str(self._capacity))
+        ])
+
+    def _grow_locked(self, needed):
+        """容量不够时翻倍：新建更大的映射文件，把旧数据拷过去"""
+        capacity = self._capacity
+        while capacity < needed:
+            capacity *= 2
+        self._flush_vectors()
+        # 先放掉旧的映射，Windows 上文件被映射着不能替换
+        self._vectors = self._scales = None
+        _grow_file(self._vectors_path(), self.dtype, (self._capacity, self._dim), (capacity, self._dim))
+        if self.dtype == "int8":
+            _grow_file(os.path.join(self.path, self.SCALES_FILE), np.float32, (self._capacity,), (capacity,))
+        self._free = list(range(capacity - 1, self._capacity - 1, -1)) + self._free
+        self._capacity = capacity
+        self._open_vectors()
+
+    def _encode(self, embeddings):
+        """归一化，再转成存储类型；int8 时另外返回每行的缩放系数"""
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.maximum(norms, 1e-12)
+        if self.dtype == "int8":
+            # 高维向量归一化后分量都很小，全局比例只用得上几个量化级别，所以按行缩放
+            scales = np.maximum(np.abs(matrix).max(axis=1), 1e-12) / INT8_MAX
+            return np.round(matrix / scales[:, None]).astype(np.int8), scales
+        return matrix.astype(np.float16), None
+
+    # ================= 元数据倒排表 =================
+    def _index_locked(self, slot, doc_id, metadata):
+        self._slot_of[doc_id] = slot
+        self._ids[slot] = doc_id
+        self._metadatas[slot] = metadata
+        for field, value in metadata.items():
+            self._postings.setdefault(field, {}).setdefault(value, set()).add(slot)
+
+    def _unindex_locked(self, slot):
+        doc_id = self._ids.pop(slot)
+        del self._slot_of[doc_id]
+        for field, value in self._metadatas.pop(slot).items():
+            slots = self._postings[field][value]
+            slots.discard(slot)
+            if not slots:
+                del self._postings[field][value]
+
+    def _filter_locked(self, where):
+        """where 条件 -> 满足条件的槽位集合（支持 $eq/$ne/$in/$nin/$and/$or，和 Chroma 写法一样）"""
+        if not where:
+            return set(self._ids)
+        result = None
+        for key, cond in where.items():
+            if key == "$and":
+                matched = set.intersection(*[self._filter_locked(c) for c in cond])
+            elif key == "$or":
+                matched = set.union(*[self._filter_locked(c) for c in cond])
+            else:
+                postings = self._postings.get(key, {})
+                if not isinstance(cond, dict):
+                    cond = {"$eq": cond}
+                (op, value), = cond.items()
+                if op == "$eq":
+                    matched = set(postings.get(value, ()))
+                elif op == "$in":
+                    matched = set().union(*[postings.get(v, ()) for v in value])
+                elif op == "$ne":
+                    matched = set(self._ids) - postings.get(value, set())
+                elif op == "$nin":
+                    matched = set(self._ids) - set().union(*[postings.get(v, ()) for v in value])
+                else:
+                    raise ValueError(f"不支持的过滤条件: {op}")
+            result = matched if result is None else result & matched
+        return result
+
+    # ================= Chroma 兼容接口 =================
+    def count(self):
+        with self._lock:
+            return len(self._ids)
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        encoded, scales = self._encode(embeddings)
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [{}] * len(ids)
+        with self._lock:
+            if self._dim is None:
+                self._dim = encoded.shape[1]
+                self._open_vectors()
+            new = sum(1 for doc_id in set(ids) if doc_id not in self._slot_of)
+            if new > len(self._free):
+                self._grow_locked(len(self._ids) + new)
+
+            rows = []
+            for n, (doc_id, document, metadata) in enumerate(zip(ids, documents, metadatas)):
+                slot = self._slot_of.get(doc_id)
+                if slot is None:
+                    slot = self._free.pop()
+                else:
+                    self._unindex_locked(slot)
+                self._vectors[slot] = encoded[n]
+                if scales is not None:
+                    self._scales[slot] = scales[n]
+                self._index_locked(slot, doc_id, metadata)
+                rows.append((slot, doc_id, document, json.dumps(metadata, ensure_ascii=False)))
+            self._flush_vectors()
+            self._db.executemany("INSERT OR REPLACE INTO docs (slot, id, document, metadata) VALUES (?, ?, ?, ?)",
+                                 rows)
+            self._save_settings()
+            self._db.commit()
+
+    def add(self, ids, embeddings, documents=None, metadatas=None):
+        self.upsert(ids, embeddings, documents, metadatas)
+
+    def update(self, ids, documents=None, metadatas=None):
+        """只改文档/元数据，不动向量"""
+        with self._lock:
+            rows = []
+            for n, doc_id in enumerate(ids):
+                slot = self._slot_of.get(doc_id)
+                if slot is None:
+                    continue
+                metadata = metadatas[n] if metadatas else self._metadatas[slot]
+                self._unindex_locked(slot)
+                self._index_locked(slot, doc_id, metadata)
+                if documents:
+                    self._db.execute("UPDATE docs SET document=? WHERE slot=?", (documents[n], slot))
+                rows.append((json.dumps(metadata, ensure_ascii=False), slot))
+            self._db.executemany("UPDATE docs SET metadata=? WHERE slot=?", rows)
+            self._db.commit()
+
+    def delete(self, ids=None, where=None):
+        with self._lock:
+            slots = self._filter_locked(where) if where else set()
+            if ids is not None:
+                slots |= {self._slot_of[i] for i in ids if i in self._slot_of}
+            for slot in slots:
+                self._unindex_locked(slot)
+                self._free.append(slot)
+            self._db.executemany("DELETE FROM docs WHERE slot=?", [(s,) for s in slots])
+            self._db.commit()
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=None):
+        with self._lock:
+            slots = self._filter_locked(where)
+            if ids is not None:
+                slots &= {self._slot_of[i] for i in ids if i in self._slot_of}
+            slots = sorted(slots)[(offset or 0):]
+            if limit is not None:
+                slots = slots[:limit]
+            result = {"ids": [self._ids[s] for s in slots]}
+            if "metadatas" in include:
+                result["metadatas"] = [self._metadatas[s] for s in slots]
+            if "documents" in include:
+                result["documents"] = self._documents_locked(slots)
+            if "embeddings" in include:
+                result["embeddings"] = self._decode(self._vectors[slots], slots) if slots else []
+            return result
+
+    def query(self, query_embeddings, n_results=10, where=None,
+              include=("documents", "metadatas", "distances")):
+        """
+        一批查询一次矩阵乘法：(候选数 × dim) @ (dim × 查询数)。
+        distances 和 Chroma 的 cosine 空间一致：1 - 余弦相似度。
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            slots = np.fromiter(sorted(self._filter_locked(where)), dtype=np.int64)
+            result = {"ids": [], "distances": [], "metadatas": [], "documents": []}
+            if len(slots) == 0 or self._vectors is None:
+                for values in result.values():
+                    values.extend([] for _ in range(len(queries)))
+                return result
+
+            scores = self._score_locked(slots, queries)    # (候选数, 查询数)
+            k = min(int(n_results), len(slots))
+            if k < len(slots):
+                top = np.argpartition(-scores, k - 1, axis=0)[:k]
+            else:
+                top = np.tile(np.arange(len(slots))[:, None], (1, len(queries)))
+            for q in range(len(queries)):
+                order = top[np.argsort(-scores[top[:, q], q]), q]
+                hits = slots[order].tolist()
+                result["ids"].append([self._ids[s] for s in hits])
+                result["distances"].append((1.0 - scores[order, q]).tolist())
+                result["metadatas"].append([self._metadatas[s] for s in hits])
+                result["documents"].append(self._documents_locked(hits) if "documents" in include else None)
+            return result
+
+    def _score_locked(self, slots, queries):
+        """分块打分，不把整个矩阵一次性转成 float32"""
+        scores = np.empty((len(slots), len(queries)), dtype=np.float32)
+        for i in range(0, len(slots), SCORE_BLOCK):
+            block = slots[i:i + SCORE_BLOCK]
+            if block[-1] - block[0] == len(block) - 1:
+                rows = self._vectors[block[0]:block[-1] + 1]    # 连续槽位直接切片，不用拷贝
+            else:
+                rows = self._vectors[block]
+            scores[i:i + len(block)] = self._decode(rows, block) @ queries.T
+        return scores
+
+    def _decode(self, stored, slots):
+        matrix = np.asarray(stored, dtype=np.float32)
+        if self._scales is not None:
+            matrix *= self._scales[slots][:, None]
+        return matrix
+
+    def _documents_locked(self, slots):
+        if not slots:
+            return []
+        docs = {}
+        for i in range(0, len(slots), 900):
+            chunk = slots[i:i + 900]
+            marks = ", ".join("?" * len(chunk))
+            docs.update(self._db.execute(f"SELECT slot, document FROM docs WHERE slot IN ({marks})", chunk))
+        return [docs.get(s) for s in slots]
+
+    def memory_bytes(self):
+        """向量矩阵占用的字节数（元数据另算）"""
+        with self._lock:
+            row = (self._dim or 0) * np.dtype(self.dtype).itemsize + (4 if self._scales is not None else 0)
+            return len(self._ids) * row
@@ -0,0 +1,83 @@
+"""
+查询缓存模块
+给 DBManager 的读接口加一层进程级缓存：LRU 上限 + TTL + 按用户的版本号失效。
+
+每个用户有一个版本号，任何写操作都会把相关用户的版本号 +1；
+缓存键里带着版本号，所以旧结果会自然失效，不需要逐条去删。
+管理员看的是全站数据，用一个全局版本号，任何人写都会让它 +1。
+"""
+import time
+import threading
+from collections import OrderedDict, Counter
+
+
+class VersionedQueryCache:
+    def __init__(self, max_entries=512, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._data = OrderedDict()      # key -> (过期时间, 结果)，右端是最近用过的
+        self._versions = Counter()      # user_id -> 版本号
+        self._global_version = 0        # 任何写操作都 +1，管理员视图用
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0}
+
+    def make_key(self, user_id, role, name, params):
+        """
+        在查询开始前生成缓存键（带当时的版本号）。
+        查询期间如果有写操作，结果会存在旧版本的键下面，不会被后续读到。
+        """
+        with self._lock:
+            if role == 'admin':
+                return ('admin', self._global_version, name, params)
+            return (user_id, self._versions[user_id], name, params)
+
+    def get(self, key):
+        """返回 (是否命中, 结果)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return False, None
+            expires_at, value = entry
+            if expires_at < now:
+                del self._data[key]
+                self._counters["expired"] += 1
+                self._counters["misses"] += 1
+                return False, None
+            self._data.move_to_end(key)
+            self._counters["hits"] += 1
+            return True, value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def invalidate(self, user_ids):
+        """这些用户的数据变了：版本号 +1（管理员视图也一起失效）"""
+        with self._lock:
+            for uid in set(user_ids):
+                self._versions[uid] += 1
+            self._global_version += 1
+            self._counters["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._global_version += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                **self._counters,
+                "hit_rate": round(self._counters["hits"] / lookups, 3) if lookups else 0.0,
+            }
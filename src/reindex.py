@@ -0,0 +1,251 @@
+"""
+向量库重建工具
+把磁盘上已有的图片（exam_cutter 切出来的题、Tutor 页面上传的图）批量算 CLIP 向量写进向量库。
+
+- 子进程池负责读文件、算哈希、解码并缩到 CLIP 的输入尺寸，主进程只做批量编码和写库（模型只加载一份）
+- 进度记在 manifest 文件里，中断后再运行会从断点继续
+- 已经在库里的文档（比如数据库同步进来的题）只换向量，讲解和元数据保持不变
+- 页面开着也可以运行（比如定时任务）：只在写每个窗口的那一下拿向量库的文件锁，
+  页面进程下次查询时发现向量库被写过，会自己重新打开
+
+用法：
+    python src/reindex.py                 # 增量：只处理还没入库的图片
+    python src/reindex.py --rebuild       # 换了 CLIP 模型后全部重算
+"""
+import os
+import re
+import io
+import json
+import time
+import hashlib
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from embedding_cache import cache_key
+
+DEFAULT_DIRS = ["../data/cut_questions", "../data/full_page_book/images"]
+MANIFEST_PATH = os.getenv('REINDEX_MANIFEST', './reindex_manifest.json')
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png')
+CLIP_INPUT_SIZE = 224                       # CLIP 预处理会把短边缩到 224，子进程先缩好，进程间只传小图
+UPLOAD_NAME = re.compile(r"^User(\d+)_")    # Tutor 页面保存的文件名：User{用户ID}_{时间戳}.jpg
+
+
+def scan(dirs):
+    """列出目录下所有图片：[(路径, 大小, 修改时间)]，按路径排序，每次运行顺序一样"""
+    files = []
+    for d in dirs:
+        if not os.path.isdir(d):
+            print(f"⚠️ 目录不存在，跳过: {d}")
+            continue
+        for root, _, names in os.walk(d):
+            for name in names:
+                if name.lower().endswith(IMAGE_EXTS):
+                    path = os.path.join(root, name)
+                    st = os.stat(path)
+                    files.append((path, st.st_size, int(st.st_mtime)))
+    return sorted(files)
+
+
+def prepare(job):
+    """
+    在子进程里跑：读文件、算内容哈希和缓存键、解码并缩小。
+    返回 (路径, 内容哈希, 缓存键, 图片)，失败返回 None
+    """
+    path, model_name = job
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        with Image.open(io.BytesIO(data)) as img:
+            img = img.convert("RGB")
+        scale = CLIP_INPUT_SIZE / min(img.size)
+        if scale < 1:
+            img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                             Image.BICUBIC)
+        return path, hashlib.sha256(data).hexdigest(), cache_key(model_name, data), img
+    except Exception as e:
+        print(f"❌ 图片读取失败 {path}: {e}")
+        return None
+
+
+# ================= 断点记录 =================
+def load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"⚠️ 进度文件读取失败，从头开始: {e}")
+        return None
+
+
+def save_manifest(path, manifest):
+    """先写临时文件再改名，中途被打断也不会留下损坏的进度文件"""
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+# ================= 写库 =================
+def index_window(kb, prepared, rebuild, batch_size, stats):
+    """一个窗口的图片：查缓存、批量编码、写进向量库"""
+    from vector_store import get_model, make_doc_id
+
+    ok = [p for p in prepared if p is not None]
+    stats["failed"] += len(prepared) - len(ok)
+    if not ok:
+        return
+
+    docs = {}       # 文档 ID -> (路径, 缓存键, 图片, 用户 ID)；同一张图出现两次只算一次
+    existing = {}   # 已经在库里的文档 ID -> (文档, 元数据)
+    with kb.locked():
+        # 数据库同步进来的题按题目 ID 建文档，用图片路径找回来，这些图片不再另建一条纯图片文档
+        found = kb.collection.get(where={"image_path": {"$in": [p[0] for p in ok]}},
+                                  include=["documents", "metadatas"])
+        linked = {}   # 路径 -> [(文档 ID, 文档, 元数据)]
+        for doc_id, document, metadata in zip(found["ids"], found["documents"], found["metadatas"]):
+            if metadata and metadata.get("question_id") is not None:
+                linked.setdefault(metadata["image_path"], []).append((doc_id, document, metadata))
+
+        for path, content_hash, key, img in ok:
+            match = UPLOAD_NAME.match(os.path.basename(path))
+            user_id = int(match.group(1)) if match else None
+            if path in linked:
+                for doc_id, document, metadata in linked[path]:
+                    docs[doc_id] = (path, key, img, user_id)
+                    existing[doc_id] = (document, metadata)
+            else:
+                docs[make_doc_id(content_hash, user_id)] = (path, key, img, user_id)
+
+        loose = [doc_id for doc_id in docs if doc_id not in existing]
+        found = kb.collection.get(ids=loose, include=["documents", "metadatas"])
+        existing.update((doc_id, (document, metadata))
+                        for doc_id, document, metadata in zip(found["ids"], found["documents"], found["metadatas"]))
+    if not rebuild:
+        for doc_id in existing:
+            del docs[doc_id]
+        stats["skipped"] += len(existing)
+
+    ids = list(docs)
+    vectors = {}
+    misses = []
+    for doc_id in ids:
+        vector = kb.embedding_cache.get(docs[doc_id][1]) if kb.embedding_cache else None
+        if vector is None:
+            misses.append(doc_id)
+        else:
+            vectors[doc_id] = vector
+    for i in range(0, len(misses), batch_size):
+        chunk = misses[i:i + batch_size]
+        encoded = get_model().encode([docs[d][2] for d in chunk], batch_size=batch_size,
+                                     convert_to_numpy=True, show_progress_bar=False)
+        if kb.embedding_cache:
+            kb.embedding_cache.put_many([(docs[d][1], v) for d, v in zip(chunk, encoded)])
+        vectors.update(zip(chunk, encoded))
+        stats["encoded"] += len(chunk)
+
+    if not ids:
+        return
+    with kb.locked(write=True):
+        # 编码期间页面可能改过或删掉了这些题：讲解和元数据按锁里重新读到的写，删掉的题不再写回去
+        found = kb.collection.get(ids=ids, include=["documents", "metadatas"])
+        current = {doc_id: (document, metadata)
+                   for doc_id, document, metadata in zip(found["ids"], found["documents"], found["metadatas"])}
+        ids = [doc_id for doc_id in ids if doc_id in current or doc_id not in existing]
+        documents, metadatas = [], []
+        for doc_id in ids:
+            path, _, _, user_id = docs[doc_id]
+            if doc_id in current:
+                document, metadata = current[doc_id]
+            else:
+                document = ""
+                metadata = {"source": f"User{user_id}" if user_id is not None else "CutQuestion",
+                            "tags": "", "image_path": path}
+                if user_id is not None:
+                    metadata["user_id"] = user_id
+            documents.append(document or "")
+            metadatas.append(metadata)
+        if ids:
+            kb.collection.upsert(ids=ids, documents=documents,
+                                 embeddings=[vectors[d].tolist() for d in ids], metadatas=metadatas)
+    stats["indexed"] += len(ids)
+
+
+def main():
+    from vector_store import MathKnowledgeBase, StoreLockedError, CLIP_MODEL_NAME, EMBED_BATCH_SIZE
+
+    parser = argparse.ArgumentParser(description="MathMaster 向量库重建工具")
+    parser.add_argument("dirs", nargs="*", default=DEFAULT_DIRS, help="要扫描的图片目录")
+    parser.add_argument("--rebuild", action="store_true", help="已经在库里的图片也重新算向量（换模型后用）")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1), help="解码图片的进程数")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="每次 CLIP 编码多少张")
+    parser.add_argument("--manifest", default=MANIFEST_PATH, help="断点进度文件")
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.manifest)
+    rebuild = args.rebuild
+    if manifest and manifest["model"] != CLIP_MODEL_NAME:
+        print(f"🔁 模型从 {manifest['model']} 换成了 {CLIP_MODEL_NAME}，全部重新计算")
+        manifest, rebuild = None, True
+    elif manifest and rebuild and manifest["complete"]:
+        manifest = None
+    elif manifest and manifest["rebuild"] and not manifest["complete"]:
+        print("⏯️ 上次重建没有跑完，继续重建")
+        rebuild = True
+    if manifest is None:
+        manifest = {"model": CLIP_MODEL_NAME, "rebuild": rebuild, "complete": False, "done": {}}
+    manifest["complete"] = False
+
+    files = scan(args.dirs)
+    done = manifest["done"]
+    stamps = {path: [size, mtime] for path, size, mtime in files}
+    todo = [path for path, _, _ in files if done.get(path) != stamps[path]]
+    print(f"📂 共 {len(files)} 张图片，{len(files) - len(todo)} 张之前已完成，本次处理 {len(todo)} 张")
+
+    stats = {"indexed": 0, "skipped": 0, "failed": 0, "encoded": 0}
+    start = time.perf_counter()
+    if todo:
+        try:
+            kb = MathKnowledgeBase()
+            window = args.batch_size * 8
+            windows = [todo[i:i + window] for i in range(0, len(todo), window)]
+            processed = 0
+            with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+                def submit(paths):
+                    return pool.map(prepare, [(p, CLIP_MODEL_NAME) for p in paths],
+                                    chunksize=max(1, len(paths) // (args.workers * 4)))
+
+                pending = submit(windows[0])
+                for n, paths in enumerate(windows):
+                    prepared = list(pending)
+                    if n + 1 < len(windows):
+                        # 子进程先解码下一个窗口，主进程同时编码这一个
+                        pending = submit(windows[n + 1])
+                    index_window(kb, prepared, rebuild, args.batch_size, stats)
+
+                    ok = {p[0] for p in prepared if p is not None}
+                    for path in paths:
+                        if path in ok:
+                            done[path] = stamps[path]
+                    save_manifest(args.manifest, manifest)
+                    processed += len(paths)
+                    elapsed = time.perf_counter() - start
+                    print(f"⏳ {processed}/{len(todo)} 张, {processed / elapsed:.1f} 张/秒")
+            if kb.embedding_cache:
+                kb.embedding_cache.flush()
+        except StoreLockedError as e:
+            # 进度按窗口记在 manifest 里，之后重新运行会从断点继续
+            print(f"❌ {e}")
+            sys.exit(1)
+
+    manifest["complete"] = True
+    save_manifest(args.manifest, manifest)
+    seconds = time.perf_counter() - start
+    per_second = len(todo) / seconds if seconds > 0 else 0.0
+    print(f"🏁 完成: 写入 {stats['indexed']}, 已在库里跳过 {stats['skipped']}, 失败 {stats['failed']}, "
+          f"模型编码 {stats['encoded']} 张, 用时 {seconds:.1f}s ({per_second:.1f} 张/秒)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+错题全文检索模块
+对 Questions.Content 和 Tags 建索引，支持中英文分词和相关度排序。
+
+同一套 search() 接口有两种实现：
+- SqlServerFullTextIndex：SQL Server 全文索引 (CONTAINSTABLE)
+- SqliteFtsIndex：本地 SQLite FTS5，数据库不可用时的替身
+"""
+import re
+import sqlite3
+import threading
+
+FULLTEXT_CATALOG = "MathTutorFT"
+FULLTEXT_LANGUAGE = 2052   # 简体中文断词器，英文单词也能正常切分
+TAG_WEIGHT = 3.0           # 标签命中比正文命中更重要
+
+# rowid 就是 QuestionID
+FTS_TABLE_DDL = "CREATE VIRTUAL TABLE IF NOT EXISTS question_fts USING fts5(content, tags, user_id UNINDEXED)"
+
+_WORD_RE = re.compile(r"[a-z0-9]+|[\u3400-\u9fff]+")
+
+
+def tokenize(text):
+    """
+    建索引用的分词：英文/数字按单词切，中文同时切单字和相邻两字 (bigram)，
+    这样不需要额外的中文分词库也能搜到 "三角形"、"导数" 这样的词。
+    """
+    tokens = []
+    for match in _WORD_RE.finditer((text or "").lower()):
+        word = match.group()
+        if word.isascii():
+            tokens.append(word)
+        else:
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def tokenize_query(query):
+    """
+    查询用的分词：中文只用 bigram（单字时才用单字），英文单词做前缀匹配。
+    返回 [(token, 是否前缀匹配)]
+    """
+    terms = []
+    for match in _WORD_RE.finditer((query or "").lower()):
+        word = match.group()
+        if word.isascii():
+            terms.append((word, True))
+        elif len(word) == 1:
+            terms.append((word, False))
+        else:
+            terms.extend((word[i:i + 2], False) for i in range(len(word) - 1))
+    return terms
+
+
+def fts_document(content, tags):
+    """把正文和标签转成写入 FTS5 表的 (content, tags) 两列：分好词、用空格连起来"""
+    return " ".join(tokenize(content)), " ".join(tokenize(tags))
+
+
+def fts_match_expression(query):
+    """
+    把用户输入拼成 FTS5 MATCH 表达式：每个词加引号防注入，空格连接表示 AND，
+    英文词末尾加 * 表示前缀。没有可搜的词时返回空字符串。
+    """
+    return " ".join('"{}"{}'.format(tok, "*" if prefix else "") for tok, prefix in tokenize_query(query))
+
+
+class SqliteFtsIndex:
+    """
+    本地 SQLite FTS5 索引。rowid 就是 QuestionID，所以 upsert/delete 都是按主键操作。
+    默认建在内存里；传入文件路径或已有连接时可以持久化。
+    """
+
+    def __init__(self, path=":memory:", conn=None):
+        self._conn = conn or sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(FTS_TABLE_DDL)
+            self._conn.commit()
+
+    def upsert(self, question_id, user_id, content, tags):
+        with self._lock:
+            self._conn.execute("DELETE FROM question_fts WHERE rowid=?", (question_id,))
+            self._conn.execute(
+                "INSERT INTO question_fts (rowid, content, tags, user_id) VALUES (?, ?, ?, ?)",
+                (question_id, *fts_document(content, tags), user_id)
+            )
+            self._conn.commit()
+
+    def delete(self, question_ids):
+        with self._lock:
+            self._conn.executemany("DELETE FROM question_fts WHERE rowid=?", [(qid,) for qid in question_ids])
+            self._conn.commit()
+
+    def rebuild(self, items):
+        """用 [(question_id, user_id, content, tags)] 重建整个索引"""
+        with self._lock:
+            self._conn.execute("DELETE FROM question_fts")
+            self._conn.executemany(
+                "INSERT INTO question_fts (rowid, content, tags, user_id) VALUES (?, ?, ?, ?)",
+                [(qid, *fts_document(content, tags), uid) for qid, uid, content, tags in items]
+            )
+            self._conn.commit()
+
+    def search(self, query, user_id=None, limit=50):
+        """返回按相关度排序的 [(question_id, score)]，score 越大越相关"""
+        match = fts_match_expression(query)
+        if not match:
+            return []
+        sql = f"""
+            SELECT rowid, -bm25(question_fts, 1.0, {TAG_WEIGHT}) AS score
+            FROM question_fts
+            WHERE question_fts MATCH ?
+        """
+        params = [match]
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        sql += " ORDER BY score DESC LIMIT ?"
+        params.append(int(limit))
+        with self._lock:
+            return [(row[0], row[1]) for row in self._conn.execute(sql, params)]
+
+
+class SqlServerFullTextIndex:
+    """
+    SQL Server 全文索引：索引由数据库自动维护 (CHANGE_TRACKING AUTO)，
+    这里只负责建索引和拼 CONTAINSTABLE 查询。
+    get_connection 传 DBManager.get_connection，连接池/熔断器照常生效。
+    """
+
+    SETUP_SQL = [
+        f"""
+        IF NOT EXISTS (SELECT 1 FROM sys.fulltext_catalogs WHERE name = '{FULLTEXT_CATALOG}')
+            CREATE FULLTEXT CATALOG {FULLTEXT_CATALOG}
+        """,
+        f"""
+        IF NOT EXISTS (SELECT 1 FROM sys.fulltext_indexes WHERE object_id = OBJECT_ID('Questions'))
+        BEGIN
+            DECLARE @pk sysname = (SELECT name FROM sys.indexes
+                                   WHERE object_id = OBJECT_ID('Questions') AND is_primary_key = 1);
+            EXEC('CREATE FULLTEXT INDEX ON Questions (Content LANGUAGE {FULLTEXT_LANGUAGE}, Tags LANGUAGE {FULLTEXT_LANGUAGE}) '
+                 + 'KEY INDEX ' + @pk + ' ON {FULLTEXT_CATALOG} WITH CHANGE_TRACKING AUTO');
+        END
+        """,
+    ]
+
+    def __init__(self, get_connection):
+        self._get_connection = get_connection
+
+    def setup(self):
+        """建全文目录和索引。全文 DDL 不能放在事务里，所以临时切到自动提交"""
+        with self._get_connection() as conn:
+            conn.autocommit(True)
+            try:
+                cursor = conn.cursor()
+                for ddl in self.SETUP_SQL:
+                    cursor.execute(ddl)
+            finally:
+                conn.autocommit(False)
+
+    @staticmethod
+    def build_condition(query):
+        """把用户输入拼成 CONTAINS 条件：每个词加引号，英文词做前缀匹配，用 AND 连接"""
+        terms = []
+        for word in (query or "").split():
+            word = word.replace('"', '')
+            if not word:
+                continue
+            terms.append(f'"{word}*"' if word.isascii() else f'"{word}"')
+        return " AND ".join(terms)
+
+    def search(self, query, user_id=None, limit=50):
+        """返回按相关度排序的 [(question_id, score)]，score 越大越相关"""
+        condition = self.build_condition(query)
+        if not condition:
+            return []
+        sql = f"""
+            SELECT TOP ({int(limit)}) q.QuestionID, ft.[RANK]
+            FROM CONTAINSTABLE(Questions, (Content, Tags), %s, LANGUAGE {FULLTEXT_LANGUAGE}) ft
+            JOIN Questions q ON q.QuestionID = ft.[KEY]
+        """
+        params = [condition]
+        if user_id is not None:
+            sql += " WHERE q.UserID = %s"
+            params.append(user_id)
+        sql += " ORDER BY ft.[RANK] DESC"
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, tuple(params))
+            return [(row[0], row[1]) for row in cursor]
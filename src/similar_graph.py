@@ -0,0 +1,420 @@
+"""
+相似题图模块
+离线算好每道题的 k 个最相似的题，存成邻接表（SQLite）。页面上的"以前做错过的相似题"
+直接按题目 ID 查表，不用在渲染时做向量检索。
+
+- 只在同一个用户的题之间连边
+- 相似度和混合检索一样：图片、讲解文字的余弦相似度按 HYBRID_IMAGE_WEIGHT 加权
+- 全量重建是批处理任务（python src/similar_graph.py --rebuild），之后数据库里的存/改/删
+  通过写操作监听器交给后台线程增量更新，只重算受影响的那几行
+- 删题/改标签还有一个不用向量库的轻量监听器（app 启动时注册）：直接删掉节点、改掉标签，
+  没打开向量库时 My Progress 上的删改也能马上反映到图里
+- 查询用只读方式打开 SQLite 文件（mode=ro，不建表也不建文件），不加载向量库和 CLIP：
+  没装 chromadb 的环境也能查
+"""
+import os
+import queue
+import pathlib
+import sqlite3
+import threading
+import numpy as np
+from vector_store import HYBRID_IMAGE_WEIGHT
+
+GRAPH_PATH = os.getenv('SIMILAR_GRAPH_PATH', './similar_graph.db')
+GRAPH_K = int(os.getenv('SIMILAR_GRAPH_K', '10'))   # 每道题存多少个相似题
+SCORE_BLOCK = 1024                                  # 每次算多少行的相似度矩阵
+
+
+class SimilarQuestionGraph:
+    """
+    kb 为 None 时只能查询和 prune，重建和增量更新要传入 MathKnowledgeBase。
+    readonly=True 时按只读方式打开（页面查询用）：文件不存在就当空图，建好之后下次查询自动打开
+    """
+
+    def __init__(self, kb=None, path=GRAPH_PATH, k=GRAPH_K, image_weight=HYBRID_IMAGE_WEIGHT, readonly=False):
+        self.kb = kb
+        self.k = k
+        self.image_weight = image_weight
+        self.path = path
+        self.readonly = readonly
+        self._lock = threading.RLock()
+        self._db = None
+        if readonly:
+            return
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS nodes (
+                question_id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                image_path TEXT,
+                tags TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_nodes_user ON nodes(user_id);
+            CREATE INDEX IF NOT EXISTS idx_nodes_image ON nodes(image_path);
+            CREATE TABLE IF NOT EXISTS neighbors (
+                question_id INTEGER NOT NULL,
+                rank INTEGER NOT NULL,
+                neighbor_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (question_id, rank)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_neighbors_neighbor ON neighbors(neighbor_id);
+        """)
+
+    # ================= 查询（页面上用） =================
+    def _reader(self):
+        """查询用的连接；只读模式下图文件还没建出来时返回 None"""
+        if self._db is None and os.path.exists(self.path):
+            uri = pathlib.Path(self.path).resolve().as_uri() + "?mode=ro"
+            self._db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        return self._db
+
+    def related(self, question_id, limit=None, live_ids=None):
+        """相似题 [{"id", "score", "image_path", "tags"}]，按相似度从高到低；图里没有这道题返回 []"""
+        return self.related_many([question_id], limit, live_ids).get(question_id, [])
+
+    def related_many(self, question_ids, limit=None, live_ids=None):
+        """
+        一页题目的相似题一次查出来：{题目 ID: [...]}。
+        只返回图里还有节点的邻居；传入 live_ids（数据库里还在的题目 ID）时再按它过滤一遍，
+        删掉的题在增量更新补齐之前也不会出现，被过滤掉的由后面的邻居顶上
+        """
+        question_ids = list(question_ids)
+        limit = limit or self.k
+        if not question_ids:
+            return {}
+        marks = ", ".join("?" * len(question_ids))
+        with self._lock:
+            db = self._reader()
+            if db is None:
+                return {}
+            rows = db.execute(f"""
+                SELECT n.question_id, n.neighbor_id, n.score, q.image_path, q.tags
+                FROM neighbors n JOIN nodes q ON q.question_id = n.neighbor_id
+                WHERE n.question_id IN ({marks}) AND n.rank < ?
+                ORDER BY n.question_id, n.rank
+            """, (*question_ids, self.k)).fetchall()
+        result = {}
+        for qid, neighbor_id, score, image_path, tags in rows:
+            if live_ids is not None and neighbor_id not in live_ids:
+                continue
+            matches = result.setdefault(qid, [])
+            if len(matches) < limit:
+                matches.append({"id": neighbor_id, "score": score, "image_path": image_path, "tags": tags})
+        return result
+
+    def neighbor_ids(self, question_ids):
+        """这些题在图里的全部邻居 ID（页面上拿去和数据库核对哪些题还在）"""
+        question_ids = list(question_ids)
+        if not question_ids:
+            return set()
+        marks = ", ".join("?" * len(question_ids))
+        with self._lock:
+            db = self._reader()
+            if db is None:
+                return set()
+            return {n for (n,) in db.execute(
+                f"SELECT DISTINCT neighbor_id FROM neighbors WHERE question_id IN ({marks})", question_ids)}
+
+    def related_by_image(self, image_paths, limit=None):
+        """按图片路径查（刚上传、还不知道题目 ID 时用）：{图片路径: [...]}，图里没有的路径不返回"""
+        image_paths = list(image_paths)
+        if not image_paths:
+            return {}
+        marks = ", ".join("?" * len(image_paths))
+        with self._lock:
+            db = self._reader()
+            if db is None:
+                return {}
+            owners = dict(db.execute(
+                f"SELECT question_id, image_path FROM nodes WHERE image_path IN ({marks})", image_paths))
+        related = self.related_many(owners, limit)
+        return {path: related.get(qid, []) for qid, path in owners.items()}
+
+    def stats(self):
+        with self._lock:
+            db = self._reader()
+            if db is None:
+                return {"nodes": 0, "edges": 0, "k": self.k}
+            nodes = db.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+            edges = db.execute("SELECT COUNT(*) FROM neighbors").fetchone()[0]
+        return {"nodes": nodes, "edges": edges, "k": self.k}
+
+    # ================= 计算 =================
+    def _similarity(self, vectors, rows, cols):
+        """question_vectors 结果里 rows 行和 cols 行两两之间的融合相似度，形状 (len(rows), len(cols))"""
+        image = vectors["image"][rows] @ vectors["image"][cols].T
+        if vectors["text"] is None:
+            return image
+        text = vectors["text"][rows] @ vectors["text"][cols].T
+        both = vectors["has_text"][rows][:, None] & vectors["has_text"][cols][None, :]
+        return np.where(both, self.image_weight * image + (1 - self.image_weight) * text, image)
+
+    def _knn_rows(self, vectors, members, targets):
+        """
+        members: 同一个用户的全部行号；targets: 其中要算邻居的行号。
+        分块算 (块 × 全部) 相似度矩阵，去掉自己后取 top-k，返回 neighbors 表的行
+        """
+        question_ids = vectors["question_ids"]
+        k = min(self.k, len(members) - 1)
+        rows = []
+        if k <= 0:
+            return rows
+        for start in range(0, len(targets), SCORE_BLOCK):
+            block = targets[start:start + SCORE_BLOCK]
+            scores = self._similarity(vectors, block, members)
+            scores[block[:, None] == members[None, :]] = -np.inf
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            for r, row in enumerate(block):
+                order = top[r][np.argsort(-scores[r, top[r]])]
+                rows.extend((question_ids[row], rank, question_ids[members[c]], float(scores[r, c]))
+                            for rank, c in enumerate(order))
+        return rows
+
+    @staticmethod
+    def _node_rows(vectors, rows):
+        return [(vectors["question_ids"][i], vectors["metadatas"][i].get("user_id"),
+                 vectors["metadatas"][i].get("image_path"), vectors["metadatas"][i].get("tags")) for i in rows]
+
+    # ================= 全量重建 =================
+    def rebuild(self, report=True):
+        """从向量库取出全部题目的向量，按用户分组算 kNN，整张表替换掉"""
+        vectors = self.kb.question_vectors()
+        groups = {}
+        for i, metadata in enumerate(vectors["metadatas"]):
+            groups.setdefault(metadata.get("user_id"), []).append(i)
+
+        edges = []
+        for members in groups.values():
+            members = np.array(members)
+            edges.extend(self._knn_rows(vectors, members, members))
+        with self._lock:
+            self._db.execute("DELETE FROM nodes")
+            self._db.execute("DELETE FROM neighbors")
+            self._db.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?)",
+                                 self._node_rows(vectors, range(len(vectors["question_ids"]))))
+            self._db.executemany("INSERT INTO neighbors VALUES (?, ?, ?, ?)", edges)
+            self._db.commit()
+        if report:
+            print(f"🕸️ 相似题图重建完成: {len(vectors['question_ids'])} 道题, {len(groups)} 个用户, {len(edges)} 条边")
+        return {"nodes": len(vectors["question_ids"]), "edges": len(edges)}
+
+    # ================= 不用向量库的轻量更新 =================
+    def prune(self, event, payload):
+        """
+        删题：删掉这些题的节点和它们自己的邻居列表；改题：更新节点上的标签。
+        别的题邻居列表里指向已删题的行留着（查询时按节点表过滤掉），
+        由 sync_db_write 或下次重建重算——它们靠这些行找到受影响的题
+        """
+        with self._lock:
+            if event == "delete":
+                question_ids = list(payload)
+                for i in range(0, len(question_ids), 500):
+                    chunk = question_ids[i:i + 500]
+                    marks = ", ".join("?" * len(chunk))
+                    self._db.execute(f"DELETE FROM nodes WHERE question_id IN ({marks})", chunk)
+                    self._db.execute(f"DELETE FROM neighbors WHERE question_id IN ({marks})", chunk)
+            elif event == "update":
+                self._db.executemany("UPDATE nodes SET tags = ? WHERE question_id = ?",
+                                     [(tags, qid) for qid, _, tags in payload])
+            else:
+                return
+            self._db.commit()
+
+    # ================= 增量更新 =================
+    def sync_db_write(self, event, payload):
+        """按一次写操作增量更新（同步执行，页面上由 GraphUpdater 放到后台线程里调用）"""
+        if event == "save":
+            users = {}
+            for q in payload:
+                users.setdefault(q["user_id"], set()).add(q["question_id"])
+            for user_id, changed in users.items():
+                self.refresh_user(user_id, changed)
+        elif event == "update":
+            self.refresh([qid for qid, _, _ in payload])
+        elif event == "delete":
+            self.refresh(payload)
+
+    def refresh(self, question_ids):
+        """这些题新增/修改/删除过：找出它们所属的用户，逐个用户增量更新"""
+        question_ids = set(question_ids)
+        if not question_ids:
+            return
+        marks = ", ".join("?" * len(question_ids))
+        with self._lock:
+            # 删掉的题节点可能已经被 prune 删了，再从指向它的邻居行找所属用户（只在同一用户内连边）
+            users = {u for (u,) in self._db.execute(f"""
+                SELECT user_id FROM nodes WHERE question_id IN ({marks})
+                UNION
+                SELECT q.user_id FROM neighbors n JOIN nodes q ON q.question_id = n.question_id
+                WHERE n.neighbor_id IN ({marks})
+            """, list(question_ids) * 2)}
+        found = self.kb.question_vectors(where={"question_id": {"$in": list(question_ids)}})
+        users.update(m.get("user_id") for m in found["metadatas"])
+        for user_id in users:
+            self.refresh_user(user_id, question_ids)
+
+    def refresh_user(self, user_id, changed):
+        """
+        只重算受影响的邻居列表：改动过的题自己、邻居里有改动过或已删除的题的、
+        邻居还不满 k 个的、以及改动过的题比它现在第 k 个邻居更近的
+        """
+        if user_id is None:
+            return
+        vectors = self.kb.question_vectors(where={"user_id": user_id})
+        question_ids = vectors["question_ids"]
+        position = {qid: i for i, qid in enumerate(question_ids)}
+        members = np.arange(len(question_ids))
+        changed_rows = np.array([position[q] for q in changed if q in position], dtype=np.int64)
+        k = min(self.k, len(question_ids) - 1)
+
+        with self._lock:
+            known = {q for (q,) in self._db.execute("SELECT question_id FROM nodes WHERE user_id = ?", (user_id,))}
+            removed = known - set(question_ids)
+            touched = list(set(changed) | removed)
+            affected = set(changed_rows.tolist())
+            if touched:
+                marks = ", ".join("?" * len(touched))
+                for (q,) in self._db.execute(
+                        f"SELECT DISTINCT question_id FROM neighbors WHERE neighbor_id IN ({marks})", touched):
+                    if q in position:
+                        affected.add(position[q])
+            if len(changed_rows) and k > 0:
+                scores = self._similarity(vectors, members, changed_rows)
+                scores[members[:, None] == changed_rows[None, :]] = -np.inf
+                best = scores.max(axis=1)
+                floors = {q: (floor, count) for q, floor, count in self._db.execute("""
+                    SELECT n.question_id, MIN(n.score), COUNT(*)
+                    FROM neighbors n JOIN nodes q ON q.question_id = n.question_id
+                    WHERE q.user_id = ? GROUP BY n.question_id
+                """, (user_id,))}
+                for i, qid in enumerate(question_ids):
+                    floor, count = floors.get(qid, (None, 0))
+                    if count < k or best[i] > floor:
+                        affected.add(i)
+
+            targets = np.array(sorted(affected), dtype=np.int64)
+            edges = self._knn_rows(vectors, members, targets)
+            stale = list(removed) + [question_ids[i] for i in targets]
+            for i in range(0, len(stale), 500):
+                chunk = stale[i:i + 500]
+                marks = ", ".join("?" * len(chunk))
+                self._db.execute(f"DELETE FROM neighbors WHERE question_id IN ({marks})", chunk)
+            if removed:
+                marks = ", ".join("?" * len(removed))
+                self._db.execute(f"DELETE FROM nodes WHERE question_id IN ({marks})", list(removed))
+            self._db.executemany("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?)",
+                                 self._node_rows(vectors, changed_rows.tolist()))
+            self._db.executemany("INSERT INTO neighbors VALUES (?, ?, ?, ?)", edges)
+            self._db.commit()
+
+
+class GraphUpdater:
+    """
+    写操作监听器：只把事件放进队列，后台线程按顺序增量更新相似题图，存/改/删题的请求不用等 kNN 重算。
+    用自己的 SimilarQuestionGraph（单独的 SQLite 连接），重算时不挡住页面上的查询
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self._queue = queue.Queue()
+        self._idle = threading.Condition()
+        self._pending = 0
+        self._thread = threading.Thread(target=self._run, name="similar-graph-updater", daemon=True)
+        self._thread.start()
+
+    def __call__(self, event, payload):
+        with self._idle:
+            self._pending += 1
+        self._queue.put((event, payload))
+
+    def _run(self):
+        while True:
+            event, payload = self._queue.get()
+            try:
+                self.graph.sync_db_write(event, payload)
+            except Exception as e:
+                print(f"⚠️ 相似题图增量更新失败 ({event}): {e}")
+            finally:
+                with self._idle:
+                    self._pending -= 1
+                    self._idle.notify_all()
+
+    def wait(self, timeout=None):
+        """等队列里的更新都做完，超时返回 False"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+
+_graph = None
+_pruner = None
+_updater = None
+_graph_lock = threading.Lock()
+
+
+def get_similar_graph():
+    """获取进程级共享的相似题图，只读：以 mode=ro 打开 SQLite，不加载向量库，也不注册增量更新"""
+    global _graph
+    if _graph is None:
+        with _graph_lock:
+            if _graph is None:
+                _graph = SimilarQuestionGraph(readonly=True)
+    return _graph
+
+
+def prune_db_write(event, payload):
+    """
+    轻量的写操作监听器（app 启动时注册，见 register_graph_pruner）：删题/改标签直接改图里的行，
+    不用打开向量库。图文件还不存在时什么都不做
+    """
+    global _pruner
+    if event not in ("delete", "update") or not os.path.exists(GRAPH_PATH):
+        return
+    if _pruner is None:
+        with _graph_lock:
+            if _pruner is None:
+                _pruner = SimilarQuestionGraph()
+    _pruner.prune(event, payload)
+
+
+def register_graph_pruner():
+    """注册 prune_db_write（重复调用只注册一次）；要在 start_graph_updates 之前注册，先删节点再重算"""
+    from db_manager import add_write_listener
+    add_write_listener(prune_db_write)
+
+
+def start_graph_updates():
+    """
+    打开向量库并注册增量更新的监听器（进程内只注册一次）。
+    向量库的监听器先注册：存题时同步写好向量，图的更新排在后台队列里，读到的一定是新向量
+    """
+    global _updater
+    if _updater is None:
+        with _graph_lock:
+            if _updater is None:
+                from vector_store import get_knowledge_base
+                from db_manager import add_write_listener
+                updater = GraphUpdater(SimilarQuestionGraph(get_knowledge_base()))
+                add_write_listener(updater)
+                _updater = updater
+    return _updater
+
+
+def wait_for_updates(timeout=None):
+    """等后台把已经排队的增量更新做完；没开增量更新时直接返回 True"""
+    updater = _updater
+    return updater.wait(timeout) if updater is not None else True
+
+
+if __name__ == "__main__":
+    import argparse
+    from vector_store import MathKnowledgeBase
+
+    parser = argparse.ArgumentParser(description="MathMaster 相似题图维护工具")
+    parser.add_argument("--rebuild", action="store_true", help="从向量库全量重建相似题图")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        SimilarQuestionGraph(MathKnowledgeBase()).rebuild()
+    else:
+        parser.print_help()
@@ -0,0 +1,499 @@
+"""
+SQLite 存储后端
+和 DBManager 接口完全一样，数据存在本地文件里，不需要 SQL Server。
+设置环境变量 DB_BACKEND=sqlite 即可启用（见 db_manager.create_db_manager）。
+
+- WAL 模式：读写互不阻塞，Streamlit 多个会话同时访问没问题
+- 每个线程一条连接，sqlite3 自带的语句缓存相当于预编译语句
+- 第一次打开时自动建表建索引（含 FTS5 全文索引）
+"""
+import os
+import sqlite3
+import secrets
+import datetime
+import threading
+from db_manager import (
+    DBManager, CallStats, _StatsDelta, _cached, _timed, _chunks, _tag_rows, _row_to_item, _notify_write,
+    get_query_cache, HISTORY_PAGE_SIZE, SEARCH_LIMIT, GLOBAL_STATS_USER, REBUILD_STATS_SQL
+)
+from search_index import FTS_TABLE_DDL, TAG_WEIGHT, fts_document, fts_match_expression
+
+# ================= 配置区域 =================
+SQLITE_PATH = os.getenv('SQLITE_PATH', '../data/mathtutor.db')
+SQLITE_STATEMENT_CACHE = 256    # 每条连接缓存的预编译语句数
+MAX_SQLITE_PARAMS = 900         # 老版本 SQLite 单条语句最多 999 个参数
+# 新库的初始管理员账号：没配密码时随机生成一个，只在建库时打印一次
+BOOTSTRAP_USER = os.getenv('SQLITE_ADMIN_USER', 'admin')
+BOOTSTRAP_PASSWORD = os.getenv('SQLITE_ADMIN_PASSWORD', '')
+
+SCHEMA_SQL = f"""
+CREATE TABLE IF NOT EXISTS Users (
+    UserID INTEGER PRIMARY KEY,
+    Username TEXT NOT NULL UNIQUE,
+    Password TEXT NOT NULL,
+    Role TEXT NOT NULL DEFAULT 'student'
+);
+-- AUTOINCREMENT：删掉的 ID 不会被复用，向量库等外部引用不会串号
+CREATE TABLE IF NOT EXISTS Questions (
+    QuestionID INTEGER PRIMARY KEY AUTOINCREMENT,
+    UserID INTEGER NOT NULL,
+    Content TEXT,
+    ImagePath TEXT,
+    Tags TEXT,
+    CreatedDate TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS IX_Questions_User_Created ON Questions (UserID, CreatedDate DESC, QuestionID DESC);
+CREATE INDEX IF NOT EXISTS IX_Questions_Created ON Questions (CreatedDate DESC, QuestionID DESC);
+
+CREATE TABLE IF NOT EXISTS QuestionTags (
+    QuestionID INTEGER NOT NULL REFERENCES Questions (QuestionID) ON DELETE CASCADE,
+    UserID INTEGER NOT NULL,
+    Tag TEXT NOT NULL COLLATE NOCASE,
+    PRIMARY KEY (QuestionID, Tag)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS IX_QuestionTags_Tag_User ON QuestionTags (Tag, UserID);
+CREATE INDEX IF NOT EXISTS IX_QuestionTags_User_Tag ON QuestionTags (UserID, Tag);
+
+CREATE TABLE IF NOT EXISTS UserStats (
+    UserID INTEGER PRIMARY KEY,
+    TotalQuestions INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS UserTagStats (
+    UserID INTEGER NOT NULL,
+    Tag TEXT NOT NULL COLLATE NOCASE,
+    Cnt INTEGER NOT NULL,
+    PRIMARY KEY (UserID, Tag)
+) WITHOUT ROWID;
+
+{FTS_TABLE_DDL};
+"""
+
+MEMORY_URI = "file::memory:?cache=shared"   # SQLITE_PATH=:memory: 时用它：每个线程一条连接，要共享同一个内存库
+
+_schema_ready = set()       # 已经初始化过的数据库文件
+_schema_lock = threading.Lock()
+
+
+class _SqliteTransaction:
+    """`with pool.acquire() as conn:`，出错自动回滚；正常结束由调用方自己 commit"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        return self._conn.cursor()
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._conn.rollback()
+        return False
+
+
+class SqliteConnectionPool(CallStats):
+    """sqlite3 连接不能跨线程使用，所以每个线程一条长连接，用到进程结束"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def acquire(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, cached_statements=SQLITE_STATEMENT_CACHE,
+                                   uri=self.path.startswith("file:"))
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+            with self._lock:
+                self._created += 1
+        return _SqliteTransaction(conn)
+
+    def stats(self):
+        with self._lock:
+            created = self._created
+        return {"path": self.path, "connections": created, "calls": self.call_stats()}
+
+
+_pools = {}
+
+
+_memory_keepalive = None
+
+
+def _keep_memory_db():
+    """共享内存库的兜底连接，进程里只开一条"""
+    global _memory_keepalive
+    with _schema_lock:
+        if _memory_keepalive is None:
+            _memory_keepalive = sqlite3.connect(MEMORY_URI, uri=True, check_same_thread=False)
+        return _memory_keepalive
+
+
+def get_sqlite_pool(path):
+    """每个数据库文件一个进程级连接池"""
+    with _schema_lock:
+        if path not in _pools:
+            _pools[path] = SqliteConnectionPool(path)
+        return _pools[path]
+
+
+def _escape_like(text):
+    """转义 LIKE 通配符（配合 ESCAPE '\\'）"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _now():
+    # 精确到微秒，保证 (CreatedDate, QuestionID) 键集分页的顺序稳定
+    return datetime.datetime.now().isoformat(sep=' ', timespec='microseconds')
+
+
+class SqliteDBManager(DBManager):
+    backend = "sqlite"
+
+    def __init__(self, path=SQLITE_PATH):
+        if path == ':memory:':
+            path = MEMORY_URI
+        self.db_path = path
+        if path == MEMORY_URI:
+            # 最后一条连接关掉时共享内存库就没了，池子里的连接用到进程结束，这里再留一条兜底
+            _keep_memory_db()
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.pool = get_sqlite_pool(path)
+        self.cache = get_query_cache()
+        self._fallback_used = False
+        self.ensure_schema()
+
+    def get_connection(self):
+        return self.pool.acquire()
+
+    def breaker_status(self):
+        # 嵌入式数据库没有网络故障，熔断器恒为关闭
+        return {"state": "closed", "failures": 0, "opened_at": None, "last_error": "",
+                "connect_timeout": 0, "probe_interval": 0}
+
+    def fallback_stats(self):
+        # 没有降级存储：写操作直接进本地文件，不会积压
+        return {"records": 0, "pending_inserts": 0, "queued_ops": 0, "snapshot_path": None}
+
+    def replay_fallback_writes(self):
+        return 0
+
+    def ensure_schema(self):
+        with _schema_lock:
+            if self.db_path in _schema_ready:
+                return
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executescript(SCHEMA_SQL)
+                # 新库预置一个管理员账号，密码来自 SQLITE_ADMIN_PASSWORD 或随机生成（不用公开的默认密码）
+                cursor.execute("SELECT COUNT(*) FROM Users")
+                password = None
+                if cursor.fetchone()[0] == 0:
+                    password = BOOTSTRAP_PASSWORD or secrets.token_urlsafe(12)
+                    cursor.execute("INSERT INTO Users (Username, Password, Role) VALUES (?, ?, 'admin')",
+                                   (BOOTSTRAP_USER, password))
+                conn.commit()
+            if password and not BOOTSTRAP_PASSWORD:
+                print(f"🔑 新建的 SQLite 库已创建管理员账号 {BOOTSTRAP_USER}，初始密码: {password}（只显示这一次）")
+            self._ensure_stats()
+            _schema_ready.add(self.db_path)
+
+    def migrate_question_tags(self):
+        # SQLite 库从第一天起就同步写 QuestionTags，不需要回填
+        return
+
+    def _ensure_stats(self):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM UserStats WHERE UserID=?", (GLOBAL_STATS_USER,))
+            missing = cursor.fetchone() is None
+        if missing:
+            self.rebuild_stats()
+
+    def rebuild_stats(self):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            for sql in REBUILD_STATS_SQL:
+                cursor.execute(sql)
+            conn.commit()
+        self.cache.clear()
+        return True
+
+    @staticmethod
+    def _apply_stats(cursor, delta):
+        cursor.executemany("""
+            INSERT INTO UserStats (UserID, TotalQuestions) VALUES (?, ?)
+            ON CONFLICT (UserID) DO UPDATE SET TotalQuestions = TotalQuestions + excluded.TotalQuestions
+        """, delta.total_rows())
+        tag_rows = delta.tag_rows()
+        cursor.executemany("""
+            INSERT INTO UserTagStats (UserID, Tag, Cnt) VALUES (?, ?, ?)
+            ON CONFLICT (UserID, Tag) DO UPDATE SET Cnt = Cnt + excluded.Cnt
+        """, tag_rows)
+        if tag_rows:
+            cursor.execute("DELETE FROM UserTagStats WHERE Cnt <= 0")
+
+    # 1. 登录
+    @_timed
+    def login(self, username, password):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT UserID, Username, Role FROM Users WHERE Username=? AND Password=?",
+                           (username, password))
+            row = cursor.fetchone()
+        return {"id": row[0], "username": row[1], "role": row[2]} if row else None
+
+    # 2. 存题
+    @_timed
+    def save_question(self, user_id, filename, ai_content, image_path, tags):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO Questions (UserID, Content, ImagePath, Tags, CreatedDate) VALUES (?, ?, ?, ?, ?)",
+                (user_id, ai_content, image_path, tags, _now())
+            )
+            question_id = cursor.lastrowid
+            cursor.executemany("INSERT INTO QuestionTags (QuestionID, UserID, Tag) VALUES (?, ?, ?)",
+                               [(question_id, user_id, tag) for tag in _tag_rows(tags)])
+            cursor.execute("INSERT INTO question_fts (rowid, content, tags, user_id) VALUES (?, ?, ?, ?)",
+                           (question_id, *fts_document(ai_content, tags), user_id))
+            delta = _StatsDelta()
+            delta.add(user_id, tags, +1)
+            self._apply_stats(cursor, delta)
+            conn.commit()
+        self.cache.invalidate([user_id])
+        _notify_write("save", [{"question_id": question_id, "user_id": user_id, "content": ai_content,
+                                "image_path": image_path, "tags": tags}])
+        return True
+
+    # 3. 批量删除（一个事务）
+    @_timed
+    def delete_questions(self, question_ids):
+        question_ids = list(question_ids)
+        if not question_ids:
+            return True
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            delta, owners = _StatsDelta(), set()
+            for chunk in _chunks(question_ids, MAX_SQLITE_PARAMS):
+                marks = ", ".join("?" * len(chunk))
+                cursor.execute(f"DELETE FROM Questions WHERE QuestionID IN ({marks}) RETURNING UserID, Tags",
+                               chunk)
+                for user_id, tags in cursor.fetchall():
+                    delta.add(user_id, tags, -1)
+                    owners.add(user_id)
+                cursor.execute(f"DELETE FROM question_fts WHERE rowid IN ({marks})", chunk)
+            self._apply_stats(cursor, delta)
+            conn.commit()
+        self.cache.invalidate(owners)
+        _notify_write("delete", question_ids)
+        return True
+
+    # 4. 历史记录
+    @_timed
+    @_cached
+    def get_history(self, user_id, role):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if role == 'admin':
+                cursor.execute("""
+                    SELECT q.QuestionID, u.Username, q.Content, q.ImagePath, q.Tags, q.CreatedDate
+                    FROM Questions q JOIN Users u ON q.UserID = u.UserID
+                    ORDER BY q.CreatedDate DESC, q.QuestionID DESC
+                """)
+            else:
+                cursor.execute("""
+                    SELECT QuestionID, '我', Content, ImagePath, Tags, CreatedDate
+                    FROM Questions WHERE UserID=?
+                    ORDER BY CreatedDate DESC, QuestionID DESC
+                """, (user_id,))
+            return [_row_to_item(row) for row in cursor]
+
+    @_timed
+    @_cached
+    def get_history_page(self, user_id, role, search="", tag="", date_from=None, date_to=None,
+                         after=None, page_size=HISTORY_PAGE_SIZE, with_total=True):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            where, params = self._history_filters(user_id, role, search, tag, date_from, date_to)
+
+            total = None
+            if with_total:
+                cursor.execute(f"SELECT COUNT(*) FROM Questions q WHERE {' AND '.join(where)}", params)
+                total = cursor.fetchone()[0]
+
+            if after is not None:
+                where.append("(q.CreatedDate < ? OR (q.CreatedDate = ? AND q.QuestionID < ?))")
+                params += [after[0], after[0], after[1]]
+
+            select, source = self._history_source(role)
+            cursor.execute(f"""
+                SELECT {select} FROM {source}
+                WHERE {' AND '.join(where)}
+                ORDER BY q.CreatedDate DESC, q.QuestionID DESC
+                LIMIT ?
+            """, params + [int(page_size) + 1])
+
+            items, next_cursor, last_key = [], None, None
+            for row in cursor:
+                if len(items) == page_size:
+                    next_cursor = last_key
+                    break
+                items.append(_row_to_item(row))
+                last_key = (row[5], row[0])
+        return {"items": items, "total": total, "next_cursor": next_cursor}
+
+    def iter_questions(self, batch_size=500):
+        last_id = 0
+        while True:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT QuestionID, UserID, Content, ImagePath, Tags
+                    FROM Questions WHERE QuestionID > ? ORDER BY QuestionID LIMIT ?
+                """, (last_id, int(batch_size)))
+                rows = cursor.fetchall()
+            for qid, uid, content, image_path, tags in rows:
+                yield {"question_id": qid, "user_id": uid, "content": content,
+                       "image_path": image_path, "tags": tags or ""}
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    @_timed
+    def existing_question_ids(self, question_ids):
+        found = set()
+        question_ids = list(question_ids)
+        if not question_ids:
+            return found
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            for chunk in _chunks(question_ids, MAX_SQLITE_PARAMS):
+                marks = ", ".join("?" * len(chunk))
+                cursor.execute(f"SELECT QuestionID FROM Questions WHERE QuestionID IN ({marks})", chunk)
+                found.update(qid for (qid,) in cursor.fetchall())
+        return found
+
+    # 4.2 全文搜索：FTS5 的 bm25 排序和筛选条件在同一条查询里完成
+    @_timed
+    @_cached
+    def search(self, user_id, role, query, tag="", date_from=None, date_to=None, limit=SEARCH_LIMIT):
+        match = fts_match_expression(query)
+        if not match:
+            return []
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            where, params = self._history_filters(user_id, role, "", tag, date_from, date_to)
+            select, source = self._history_source(role)
+            cursor.execute(f"""
+                SELECT {select}
+                FROM question_fts f JOIN {source} ON q.QuestionID = f.rowid
+                WHERE question_fts MATCH ? AND {' AND '.join(where)}
+                ORDER BY bm25(question_fts, 1.0, {TAG_WEIGHT})
+                LIMIT ?
+            """, [match] + params + [int(limit)])
+            return [_row_to_item(row) for row in cursor]
+
+    @staticmethod
+    def _history_source(role):
+        if role == 'admin':
+            return ("q.QuestionID, u.Username, q.Content, q.ImagePath, q.Tags, q.CreatedDate",
+                    "Questions q JOIN Users u ON q.UserID = u.UserID")
+        return ("q.QuestionID, '我', q.Content, q.ImagePath, q.Tags, q.CreatedDate", "Questions q")
+
+    @staticmethod
+    def _history_filters(user_id, role, search, tag, date_from, date_to):
+        where, params = ["1=1"], []
+        if role != 'admin':
+            where.append("q.UserID=?")
+            params.append(user_id)
+        if search:
+            like = f"%{_escape_like(search)}%"
+            where.append("(q.Content LIKE ? ESCAPE '\\' OR q.Tags LIKE ? ESCAPE '\\')")
+            params += [like, like]
+        if tag:
+            where.append("EXISTS (SELECT 1 FROM QuestionTags t WHERE t.QuestionID = q.QuestionID AND t.Tag = ?)")
+            params.append(tag.strip())
+        if date_from:
+            where.append("q.CreatedDate >= ?")
+            params.append(date_from.strftime("%Y-%m-%d"))
+        if date_to:
+            where.append("q.CreatedDate < ?")
+            params.append((date_to + datetime.timedelta(days=1)).strftime("%Y-%m-%d"))
+        return where, params
+
+    # 4.3 标签统计
+    @_timed
+    @_cached
+    def get_tag_counts(self, user_id, role, limit=None):
+        stats_user = GLOBAL_STATS_USER if role == 'admin' else user_id
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT Tag, Cnt FROM UserTagStats WHERE UserID=? ORDER BY Cnt DESC, Tag LIMIT ?",
+                           (stats_user, int(limit) if limit else -1))
+            return [(row[0], row[1]) for row in cursor]
+
+    @_timed
+    @_cached
+    def get_dashboard_stats(self, user_id, role, top_n=5):
+        stats_user = GLOBAL_STATS_USER if role == 'admin' else user_id
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT s.TotalQuestions, (SELECT COUNT(*) FROM UserTagStats x WHERE x.UserID = s.UserID)
+                FROM UserStats s WHERE s.UserID = ?
+            """, (stats_user,))
+            row = cursor.fetchone()
+            cursor.execute("SELECT Tag, Cnt FROM UserTagStats WHERE UserID=? ORDER BY Cnt DESC, Tag LIMIT ?",
+                           (stats_user, int(top_n)))
+            top_tags = [(r[0], r[1]) for r in cursor]
+        return {"total_questions": row[0] if row else 0, "unique_topics": row[1] if row else 0,
+                "top_tags": top_tags}
+
+    # 5. 批量修改（一个事务）
+    @_timed
+    def update_questions(self, changes):
+        changes = list(changes)
+        if not changes:
+            return True
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            delta, owners = _StatsDelta(), set()
+            for question_id, content, tags in changes:
+                cursor.execute("SELECT UserID, Tags FROM Questions WHERE QuestionID=?", (question_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    continue
+                user_id, old_tags = row
+                cursor.execute("UPDATE Questions SET Content=?, Tags=? WHERE QuestionID=?",
+                               (content, tags, question_id))
+                cursor.execute("DELETE FROM QuestionTags WHERE QuestionID=?", (question_id,))
+                cursor.executemany("INSERT INTO QuestionTags (QuestionID, UserID, Tag) VALUES (?, ?, ?)",
+                                   [(question_id, user_id, tag) for tag in _tag_rows(tags)])
+                cursor.execute("UPDATE question_fts SET content=?, tags=? WHERE rowid=?",
+                               (*fts_document(content, tags), question_id))
+                delta.add(user_id, old_tags, -1, count_question=False)
+                delta.add(user_id, tags, +1, count_question=False)
+                owners.add(user_id)
+            self._apply_stats(cursor, delta)
+            conn.commit()
+        self.cache.invalidate(owners)
+        _notify_write("update", changes)
+        return True
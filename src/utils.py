@@ -1,6 +1,6 @@
 """
 工具函数模块
-提供 CSS 加载、文件处理等通用功能
+提供 CSS 加载、标签解析、文件处理等通用功能
 """
 import os
 import streamlit as st
@@ -44,3 +44,23 @@ def get_user_initials(username: str) -> str:
     if len(username) >= 2:
         return username[:2].upper()
     return username[0].upper() if username else "U"
+
+
+def split_tags(tags: str) -> list:
+    """
+    把逗号分隔的标签字符串拆成列表
+    
+    中英文逗号都算分隔符，去掉首尾空格和空标签，重复的只保留第一次出现的
+    
+    Args:
+        tags: 形如 "几何, 相似三角形，计算" 的标签字符串
+        
+    Returns:
+        标签列表，例如 ["几何", "相似三角形", "计算"]
+    """
+    result = []
+    for t in (tags or "").replace('，', ',').split(','):
+        t = t.strip()
+        if t and t not in result:
+            result.append(t)
+    return result
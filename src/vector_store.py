@@ -1,71 +1,907 @@
-import chromadb
-from sentence_transformers import SentenceTransformer
 from PIL import Image
+import io
 import os
+import gc
+import time
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from filelock import FileLock, Timeout
+from embedding_cache import EmbeddingCache, StoreLockedError
+from numpy_index import NumpyVectorIndex
+from utils import split_tags
 
 # ================= 模型加载区域 =================
-print("正在初始化视觉模型 (CLIP)...")
 # 🟢 回退到最稳定的 CLIP 模型
 # 这个模型兼容性最好，不需要 trust_remote_code，也不会报错
-model = SentenceTransformer('clip-ViT-B-32')
+CLIP_MODEL_NAME = os.getenv('CLIP_MODEL', 'clip-ViT-B-32')
+CLIP_IDLE_UNLOAD = float(os.getenv('CLIP_IDLE_UNLOAD', '0'))   # 空闲超过这么多秒就卸载模型，0 表示常驻
+# 讲解文字的文本向量模型：多语言版能处理中文；为空表示不建文本向量，混合检索只用图片
+CLIP_TEXT_MODEL_NAME = os.getenv('CLIP_TEXT_MODEL', 'clip-ViT-B-32-multilingual-v1')
+
+# 模型不在 import 时加载：第一次真正要算向量时才加载，每个进程只加载一次
+_model = None
+_text_model = None
+_model_lock = threading.Lock()
+_model_stats = {"loads": 0, "load_seconds": None, "warmup_seconds": None, "last_used": None, "unloads": 0}
+_idle_thread = None
+_warmup_started = False
+
+
+def get_model():
+    """获取 CLIP 模型（线程安全，第一次调用时加载）"""
+    global _model
+    model = _model
+    if model is None:
+        with _model_lock:
+            if _model is None:
+                print("正在初始化视觉模型 (CLIP)...")
+                start = time.perf_counter()
+                # sentence_transformers 会连带导入 torch，也放到这里，只 import 本模块的进程不用付这个代价
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(CLIP_MODEL_NAME)
+                seconds = time.perf_counter() - start
+                _model_stats["loads"] += 1
+                _model_stats["load_seconds"] = round(seconds, 3)
+                print(f"✅ CLIP 模型加载完成，用时 {seconds:.1f}s")
+                _start_idle_watch_locked()
+            model = _model
+    _model_stats["last_used"] = time.monotonic()
+    return model
+
+
+def get_text_model():
+    """获取文本向量模型（线程安全，第一次调用时加载）；没有配置时返回 None"""
+    global _text_model
+    if not CLIP_TEXT_MODEL_NAME:
+        return None
+    model = _text_model
+    if model is None:
+        with _model_lock:
+            if _text_model is None:
+                print("正在初始化文本向量模型...")
+                from sentence_transformers import SentenceTransformer
+                _text_model = SentenceTransformer(CLIP_TEXT_MODEL_NAME)
+                _start_idle_watch_locked()
+            model = _text_model
+    _model_stats["last_used"] = time.monotonic()
+    return model
+
+
+def warm_up(background=True):
+    """
+    预热：加载模型并跑一次推理（第一次推理要初始化算子，明显比之后慢）。
+    background=True 时在后台线程里做，不阻塞页面。
+    每个进程只预热一次：app.py 每次 rerun 都会调到这里，空闲卸载之后也不会被它重新加载回来
+    """
+    global _warmup_started
+    with _model_lock:
+        if _warmup_started:
+            return
+        _warmup_started = True
+
+    def run():
+        if _model_stats["warmup_seconds"] is not None and _model is not None:
+            return
+        try:
+            model = get_model()
+            start = time.perf_counter()
+            model.encode(Image.new("RGB", (224, 224), "white"))
+            _model_stats["warmup_seconds"] = round(time.perf_counter() - start, 3)
+        except Exception as e:
+            print(f"⚠️ CLIP 预热失败: {e}")
+
+    if background:
+        threading.Thread(target=run, name="clip-warmup", daemon=True).start()
+    else:
+        run()
+
+
+def unload_model():
+    """卸载模型释放内存；之后再用会自动重新加载"""
+    global _model, _text_model
+    with _model_lock:
+        if _model is None and _text_model is None:
+            return False
+        _model = _text_model = None
+        _model_stats["unloads"] += 1
+        _model_stats["warmup_seconds"] = None
+    gc.collect()
+    print("💤 CLIP 模型已卸载")
+    return True
+
+
+def _start_idle_watch_locked():
+    global _idle_thread
+    if CLIP_IDLE_UNLOAD <= 0 or (_idle_thread and _idle_thread.is_alive()):
+        return
+    _idle_thread = threading.Thread(target=_idle_watch, name="clip-idle-unload", daemon=True)
+    _idle_thread.start()
+
+
+def _idle_watch():
+    # 守护线程常驻，模型卸载后再次加载也继续盯着
+    while True:
+        time.sleep(min(CLIP_IDLE_UNLOAD, 60))
+        loaded = _model is not None or _text_model is not None
+        if loaded and time.monotonic() - _model_stats["last_used"] >= CLIP_IDLE_UNLOAD:
+            unload_model()
+
+
+def model_stats():
+    """模型加载/预热耗时、是否在内存里"""
+    idle = time.monotonic() - _model_stats["last_used"] if _model_stats["last_used"] else None
+    return {
+        "model": CLIP_MODEL_NAME,
+        "loaded": _model is not None,
+        "text_model": CLIP_TEXT_MODEL_NAME or None,
+        "text_loaded": _text_model is not None,
+        **{k: v for k, v in _model_stats.items() if k != "last_used"},
+        "idle_seconds": round(idle, 1) if idle is not None else None,
+        "idle_unload_after": CLIP_IDLE_UNLOAD or None,
+    }
 # ===============================================
 
+# ================= 批量入库配置 =================
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', '32'))                              # 每次 model.encode 多少张图
+EMBED_DECODE_WORKERS = int(os.getenv('EMBED_DECODE_WORKERS', str(min(8, os.cpu_count() or 1))))  # 解码图片的线程数
+CHROMA_WRITE_BATCH = int(os.getenv('CHROMA_WRITE_BATCH', '1000'))                        # 每次 collection.add 写多少条
+
+# ================= 向量库后端 =================
+# chroma: Chroma 持久化 HNSW 索引（默认）；numpy: 内存映射矩阵 + 暴力检索，几万条以内更省内存、启动更快
+VECTOR_BACKEND = os.getenv('VECTOR_BACKEND', 'chroma').lower()
+NUMPY_INDEX_DTYPE = os.getenv('NUMPY_INDEX_DTYPE', 'float16')   # float16 或 int8（再省一半内存，召回略降）
+STORE_LOCK_TIMEOUT = float(os.getenv('STORE_LOCK_TIMEOUT', '60'))   # 别的进程正在写一批时，最多等多少秒
+VECTOR_SYNC_QUEUE = os.getenv('VECTOR_SYNC_QUEUE', './vector_sync_queue.jsonl')   # 向量库打开之前的写操作记在这里
+
+# ================= 混合检索配置 =================
+HYBRID_IMAGE_WEIGHT = float(os.getenv('HYBRID_IMAGE_WEIGHT', '0.7'))   # 图片相似度的权重，文字是 1 - 它
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', '50'))          # 每种向量各取多少候选再精确重排
+
+# ================= 向量缓存配置 =================
+EMBED_CACHE_DIR = os.getenv('EMBED_CACHE_DIR', './embedding_cache')
+EMBED_CACHE_SIZE = int(os.getenv('EMBED_CACHE_SIZE', '50000'))   # 最多缓存多少张图的向量，0 表示不缓存
+
+_embedding_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """获取进程级共享的图片向量缓存（第一次调用时创建），关闭缓存时返回 None"""
+    global _embedding_cache
+    if EMBED_CACHE_SIZE <= 0:
+        return None
+    if _embedding_cache is None:
+        with _cache_lock:
+            if _embedding_cache is None:
+                _embedding_cache = EmbeddingCache(EMBED_CACHE_DIR, CLIP_MODEL_NAME, EMBED_CACHE_SIZE,
+                                                  lock_timeout=STORE_LOCK_TIMEOUT)
+    return _embedding_cache
+
+
+def make_doc_id(content_hash, user_id=None, question_id=None):
+    """
+    数据库里的题按题目 ID 建文档：同一个人存了两次同一张图是两道题，删掉一道不能带走另一道的向量。
+    不对应题目的图片（切出来的题、reindex 扫到的图）用归属用户 + 图片内容哈希，重复入库只会覆盖。
+    都不需要先查 count，多个进程同时写也不会撞号
+    """
+    if question_id is not None:
+        return f"q{question_id}"
+    owner = f"u{user_id}" if user_id is not None else "shared"
+    return f"{owner}-{content_hash[:32]}"
+
+
+TAG_KEY_PREFIX = "tag:"
+
+
+def tag_metadata(tags, previous=None):
+    """
+    把标签拆成一个个布尔元数据字段（"tag:导数": True），where 条件才能按单个标签过滤。
+    previous 是旧的元数据：旧标签改成 False，因为 Chroma 的 update 是合并，删不掉字段
+    """
+    flags = {key: False for key in (previous or {}) if key.startswith(TAG_KEY_PREFIX)}
+    flags.update({TAG_KEY_PREFIX + t: True for t in split_tags(tags)})
+    return flags
+
+
+def tag_where(tags, where=None):
+    """在 where 条件上再加一条"带有其中任一标签"；tags 可以是列表或逗号分隔的字符串"""
+    if isinstance(tags, str):
+        tags = split_tags(tags)
+    conditions = [{TAG_KEY_PREFIX + t: True} for t in (tags or [])]
+    if len(conditions) > 1:
+        conditions = [{"$or": conditions}]
+    if where:
+        conditions.insert(0, where)
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def _normalize(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+
 class MathKnowledgeBase:
+    """
+    多个进程（页面、reindex、--reconcile、相似题图重建）可以同时打开同一个向量库。
+    Chroma 和 NumPy 后端都在进程内存里缓存索引，所以每次读写都要先拿目录旁边的文件锁（见 locked），
+    只拿一次查询或一批写入的时间；写完把代数文件加一，别的进程下次拿锁时发现代数变了就重新打开。
+    等锁超过 STORE_LOCK_TIMEOUT 秒抛 StoreLockedError
+    """
+
     def __init__(self):
-        # 数据库路径
-        # 🟢 我们改回用 clip 命名的文件夹，方便区分
-        self.db_path = "./chroma_db_clip" 
-        self.client = chromadb.PersistentClient(path=self.db_path)
-        
-        # 创建集合
-        self.collection = self.client.get_or_create_collection(
-            name="math_questions_visual",
-            metadata={"hnsw:space": "cosine"}
-        )
+        self.db_path = "./numpy_index_clip" if VECTOR_BACKEND == 'numpy' else "./chroma_db_clip"
+        self._file_lock = FileLock(self.db_path + ".lock", timeout=STORE_LOCK_TIMEOUT)
+        self._generation_path = self.db_path + ".generation"
+        self._generation = None    # 打开时的代数，None 表示还没打开
+        self._state_lock = threading.RLock()
+        self.client = None
+        self.embedding_cache = get_embedding_cache()
+        with self.locked():
+            pass
+
+    def _read_generation(self):
+        try:
+            with open(self._generation_path, encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    @contextmanager
+    def locked(self, write=False):
+        """
+        拿着文件锁做一次读或一批写（可以嵌套）。别的进程写过就先重新打开；write=True 时退出时把代数加一。
+        算向量之类的慢活放在锁外面做，锁里只碰向量库
+        """
+        with self._state_lock:
+            try:
+                self._file_lock.acquire()
+            except Timeout:
+                raise StoreLockedError(f"向量库 {self.db_path} 被另一个进程占用超过 {STORE_LOCK_TIMEOUT:g} 秒") from None
+            try:
+                generation = self._read_generation()
+                if generation != self._generation:
+                    self._open()
+                    self._generation = generation
+                try:
+                    yield
+                finally:
+                    if write:
+                        self._generation = self._read_generation() + 1
+                        with open(self._generation_path + ".tmp", "w", encoding="utf-8") as f:
+                            f.write(str(self._generation))
+                        os.replace(self._generation_path + ".tmp", self._generation_path)
+            finally:
+                self._file_lock.release()
+
+    def _open(self):
+        if VECTOR_BACKEND == 'numpy':
+            # 接口和 Chroma 的 collection 一样，下面的代码不用区分后端
+            self.client = None
+            self.collection = NumpyVectorIndex(self.db_path, NUMPY_INDEX_DTYPE)
+            self.text_collection = (NumpyVectorIndex(self.db_path + "_text", NUMPY_INDEX_DTYPE)
+                                    if CLIP_TEXT_MODEL_NAME else None)
+        else:
+            import chromadb
+            if self.client is not None:
+                # 同一路径的 PersistentClient 在进程里是共享的，清掉之后才会从磁盘重新加载别的进程写入的索引
+                self.client.clear_system_cache()
+            # 🟢 我们改回用 clip 命名的文件夹（db_path），方便区分
+            self.client = chromadb.PersistentClient(path=self.db_path)
+            
+            # 创建集合
+            self.collection = self.client.get_or_create_collection(
+                name="math_questions_visual",
+                metadata={"hnsw:space": "cosine"}
+            )
+            # 讲解文字的文本向量单独一个集合，文档 ID 和元数据与图片集合一一对应
+            self.text_collection = self.client.get_or_create_collection(
+                name="math_questions_text",
+                metadata={"hnsw:space": "cosine"}
+            ) if CLIP_TEXT_MODEL_NAME else None
 
     def _get_image_embedding(self, image_path):
         """
         CLIP 模型非常简单，直接传图片就行，不需要前缀
+        同一张图片算过一次就直接从缓存里拿
         """
         try:
-            img = Image.open(image_path)
-            # CLIP 只要图片，不要任何花里胡哨的前缀
-            embedding = model.encode(img)
-            return embedding.tolist()
+            prepared = self._load_image(image_path)
+            if prepared is None:
+                return None
+            _, key, vector, img = prepared
+            if vector is None:
+                # CLIP 只要图片，不要任何花里胡哨的前缀
+                vector = get_model().encode(img)
+                if self.embedding_cache:
+                    self.embedding_cache.put(key, vector)
+            return vector.tolist()
         except Exception as e:
             print(f"❌ 向量化失败: {e}")
             return None
 
-    def add_question(self, text_content, image_path, tags="", source="User"):
+    def add_question(self, text_content, image_path, tags="", source="User", user_id=None, question_id=None):
         if not os.path.exists(image_path):
             return False
+        result = self.add_questions([{
+            "text_content": text_content,
+            "image_path": image_path,
+            "tags": tags,
+            "source": source,
+            "user_id": user_id,
+            "question_id": question_id,
+        }], report=False)
+        return result["added"] == 1
 
-        # 计算特征
-        visual_vector = self._get_image_embedding(image_path)
-        
-        if visual_vector:
-            doc_id = str(self.collection.count() + 1)
-            self.collection.add(
-                documents=[text_content],
-                embeddings=[visual_vector], 
-                metadatas=[{
-                    "source": source, 
-                    "tags": tags, 
-                    "image_path": image_path
-                }],
-                ids=[doc_id]
-            )
-            return True
-        return False
+    def _load_image(self, image_path):
+        """
+        读图片并查向量缓存，可以放在线程池里跑（PIL 解码时会释放 GIL）。
+        返回 (图片内容哈希, 缓存键, 缓存里的向量, 解码后的图片)：命中缓存时不解码，图片为 None；
+        读取失败返回 None。
+        """
+        try:
+            with open(image_path, "rb") as f:
+                data = f.read()
+            content_hash = hashlib.sha256(data).hexdigest()
+            key = None
+            if self.embedding_cache:
+                key = self.embedding_cache.key_for(data)
+                vector = self.embedding_cache.get(key)
+                if vector is not None:
+                    return content_hash, key, vector, None
+            with Image.open(io.BytesIO(data)) as img:
+                return content_hash, key, None, img.convert("RGB")
+        except Exception as e:
+            print(f"❌ 图片读取失败 {image_path}: {e}")
+            return None
+
+    def add_questions(self, items, batch_size=EMBED_BATCH_SIZE, workers=EMBED_DECODE_WORKERS,
+                      write_batch=CHROMA_WRITE_BATCH, report=True):
+        """
+        批量入库：线程池解码图片，按 batch_size 成批调用 model.encode，
+        攒够 write_batch 条再一次写进 Chroma。解码下一批和编码当前批是重叠进行的，
+        内存里最多同时有两批图片。向量缓存里已有的图片不解码、不过模型。
+        写入是 upsert：文档 ID 由题目 ID（没有时由图片内容和归属用户）决定，重复入库是幂等的。
+
+        Args:
+            items: [{"text_content", "image_path", "tags", "source", "user_id", "question_id"}]，
+                   除 text_content/image_path 外都可省略；question_id 是数据库里的题目 ID
+            report: 是否打印吞吐量
+
+        Returns:
+            {"added": 成功条数, "failed": 失败条数, "seconds": 耗时, "per_second": 每秒条数}
+        """
+        start = time.perf_counter()
+        items = list(items)
+        total = len(items)
+        items = [it for it in items if os.path.exists(it["image_path"])]
+        failed = total - len(items)
+        added = 0
+        # Chroma 单次写入有上限，超过会直接报错
+        max_batch = getattr(self.client, "get_max_batch_size", lambda: write_batch)()
+        write_batch = max(1, min(write_batch, max_batch))
+        pending = {}   # 文档 ID -> (文档, 向量, 元数据)；同一批里 ID 重复时后面的覆盖前面的
+        # 按图片内容哈希的旧文档 ID -> 题目 ID：这张图先被 reindex 当成普通图片入过库、
+        # 或者是这道题改成按题目 ID 建文档之前留下的，旧文档要删掉，免得检索出两条
+        loose = {}
+
+        def flush():
+            if not loose and not pending:
+                return
+            ids = list(pending)
+            text_vectors = self._encode_texts([pending[i][0] for i in ids])
+            with self.locked(write=True):
+                if loose:
+                    found = self.collection.get(ids=list(loose), include=["metadatas"])
+                    stale = [doc_id for doc_id, metadata in zip(found["ids"], found["metadatas"])
+                             if (metadata or {}).get("question_id") in (None, loose[doc_id])]
+                    if stale:
+                        self.collection.delete(ids=stale)
+                        if self.text_collection is not None:
+                            self.text_collection.delete(ids=stale)
+                if ids:
+                    self.collection.upsert(
+                        ids=ids,
+                        documents=[pending[i][0] for i in ids],
+                        embeddings=[pending[i][1] for i in ids],
+                        metadatas=[pending[i][2] for i in ids]
+                    )
+                    self._upsert_texts(ids, text_vectors, [pending[i][2] for i in ids])
+            loose.clear()
+            pending.clear()
+
+        batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            decoding = pool.map(self._load_image, [it["image_path"] for it in batches[0]]) if batches else None
+            for n, batch in enumerate(batches):
+                images = list(decoding)
+                if n + 1 < len(batches):
+                    # 先把下一批交给线程池解码，再编码这一批
+                    decoding = pool.map(self._load_image, [it["image_path"] for it in batches[n + 1]])
+
+                ok = [(it, prepared) for it, prepared in zip(batch, images) if prepared is not None]
+                failed += len(batch) - len(ok)
+                misses = [(key, img) for _, (_, key, vector, img) in ok if vector is None]
+                if misses:
+                    try:
+                        encoded = get_model().encode([img for _, img in misses], batch_size=batch_size,
+                                                     convert_to_numpy=True, show_progress_bar=False)
+                    except Exception as e:
+                        print(f"❌ 向量化失败: {e}")
+                        failed += len(ok)
+                        continue
+                    if self.embedding_cache:
+                        self.embedding_cache.put_many([(key, v) for (key, _), v in zip(misses, encoded)])
+                    encoded = iter(encoded)
+                vectors = [vector if vector is not None else next(encoded) for _, (_, _, vector, _) in ok]
 
-    def search_similar_image(self, query_image_path, top_k=1):
-        # 搜索
+                for (it, (content_hash, _, _, _)), vector in zip(ok, vectors):
+                    metadata = {
+                        "source": it.get("source", "User"),
+                        "tags": it.get("tags", ""),
+                        "image_path": it["image_path"],
+                        **tag_metadata(it.get("tags", "")),
+                    }
+                    # Chroma 的元数据不能是 None，没有的字段就不写
+                    for field in ("user_id", "question_id"):
+                        if it.get(field) is not None:
+                            metadata[field] = it[field]
+                    doc_id = make_doc_id(content_hash, it.get("user_id"), it.get("question_id"))
+                    pending[doc_id] = (it["text_content"], vector.tolist(), metadata)
+                    if it.get("question_id") is not None:
+                        loose[make_doc_id(content_hash, it.get("user_id"))] = it["question_id"]
+                    added += 1
+                    if len(pending) >= write_batch:
+                        flush()
+            flush()
+        if self.embedding_cache:
+            self.embedding_cache.flush()
+
+        seconds = time.perf_counter() - start
+        per_second = added / seconds if seconds > 0 else 0.0
+        if report:
+            print(f"📥 入库完成: {added} 条成功, {failed} 条失败, 用时 {seconds:.1f}s ({per_second:.1f} 张/秒)")
+        return {"added": added, "failed": failed, "seconds": round(seconds, 3), "per_second": round(per_second, 2)}
+
+    def _encode_texts(self, documents):
+        """给讲解文字算文本向量（在锁外面算）；没开文本向量或失败时返回 None，失败只打日志"""
+        if self.text_collection is None or not documents:
+            return None
+        try:
+            return get_text_model().encode([d or "" for d in documents], batch_size=EMBED_BATCH_SIZE,
+                                            convert_to_numpy=True, show_progress_bar=False)
+        except Exception as e:
+            print(f"⚠️ 文本向量计算失败: {e}")
+            return None
+
+    def _upsert_texts(self, ids, vectors, metadatas):
+        """把 _encode_texts 算好的文本向量写进文本集合；失败只打日志，不影响图片向量"""
+        if self.text_collection is None or vectors is None or not ids:
+            return
+        try:
+            self.text_collection.upsert(ids=list(ids), embeddings=vectors.tolist(), metadatas=list(metadatas))
+        except Exception as e:
+            print(f"⚠️ 文本向量写入失败: {e}")
+
+    def _embed_images(self, image_paths, workers=EMBED_DECODE_WORKERS):
+        """一批查询图片 -> 向量列表（没给路径或读取失败的位置是 None），缓存没命中的一次批量编码"""
+        todo = [i for i, path in enumerate(image_paths) if path]
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            prepared = dict(zip(todo, pool.map(self._load_image, [image_paths[i] for i in todo])))
+        vectors = [None] * len(image_paths)
+        misses = []
+        for i, got in prepared.items():
+            if got is not None:
+                if got[2] is None:
+                    misses.append(i)
+                else:
+                    vectors[i] = got[2]
+        if misses:
+            encoded = get_model().encode([prepared[i][3] for i in misses], batch_size=EMBED_BATCH_SIZE,
+                                         convert_to_numpy=True, show_progress_bar=False)
+            if self.embedding_cache:
+                self.embedding_cache.put_many([(prepared[i][1], v) for i, v in zip(misses, encoded)])
+            for i, v in zip(misses, encoded):
+                vectors[i] = v
+        return vectors
+
+    def search_hybrid(self, queries, top_k=5, where=None, tags=None,
+                      image_weight=HYBRID_IMAGE_WEIGHT, candidates=HYBRID_CANDIDATES):
+        """
+        图片 + 讲解文字混合检索，一次处理一批查询。
+        两种向量各做一次批量 query 取候选（where 条件在打分前过滤），
+        再取回所有候选的两种向量，按权重加权余弦相似度精确重排。
+
+        Args:
+            queries: [{"image_path": 图片路径, "text": 讲解或 OCR 文字}]，两项至少给一项
+            where: 元数据过滤条件，例如 {"user_id": 3}
+            tags: 只在带有其中任一标签的题里找，例如 ["导数"]
+            image_weight: 图片相似度的权重，文字是 1 - image_weight；
+                          查询或候选只有一种向量时只用那一种
+
+        Returns:
+            每条查询一个列表，按 score 从高到低：
+            [{"id", "score", "image_score", "text_score", "document", "metadata"}]，缺的那种分数是 None
+        """
+        queries = list(queries)
+        where = tag_where(tags, where)
+        n_results = max(top_k, candidates)
+
+        image_vectors = self._embed_images([q.get("image_path") for q in queries])
+        text_vectors = [None] * len(queries)
+        with_text = [i for i, q in enumerate(queries) if q.get("text")]
+        if self.text_collection is not None and with_text:
+            encoded = get_text_model().encode([queries[i]["text"] for i in with_text], batch_size=EMBED_BATCH_SIZE,
+                                              convert_to_numpy=True, show_progress_bar=False)
+            for i, v in zip(with_text, encoded):
+                text_vectors[i] = v
+
+        query_has_text = np.array([v is not None for v in text_vectors])
+        got, got_text = self._hybrid_candidates(image_vectors, text_vectors, n_results, where, query_has_text.any())
+        ids = got["ids"] if got else []
+        if not ids:
+            return [[] for _ in queries]
+        # 候选的两种向量和所有查询一起做矩阵乘法
+        image_matrix = _normalize(got["embeddings"])
+        query_has_image = np.array([v is not None for v in image_vectors])
+        query_images = np.zeros((len(queries), image_matrix.shape[1]), dtype=np.float32)
+        if query_has_image.any():
+            query_images[query_has_image] = _normalize([v for v in image_vectors if v is not None])
+        image_scores = image_matrix @ query_images.T                         # (候选数, 查询数)
+
+        doc_has_text = np.zeros(len(ids), dtype=bool)
+        text_scores = np.zeros_like(image_scores)
+        if got_text is not None:
+            position = {doc_id: n for n, doc_id in enumerate(ids)}
+            rows = [(position[d], e) for d, e in zip(got_text["ids"], got_text["embeddings"]) if d in position]
+            if rows:
+                slots = [n for n, _ in rows]
+                doc_has_text[slots] = True
+                query_texts = _normalize([v for v in text_vectors if v is not None])
+                text_scores[np.ix_(slots, np.flatnonzero(query_has_text))] = \
+                    _normalize([e for _, e in rows]) @ query_texts.T
+
+        # 每个 (候选, 查询) 只用两边都有的那几种向量，权重重新归一
+        image_w = np.broadcast_to(image_weight * query_has_image[None, :], image_scores.shape)
+        text_w = (1 - image_weight) * (doc_has_text[:, None] & query_has_text[None, :])
+        total = image_w + text_w
+        scores = (image_w * image_scores + text_w * text_scores) / np.maximum(total, 1e-12)
+        scores[total == 0] = -np.inf
+
+        results = []
+        k = min(top_k, len(ids))
+        for q in range(len(queries)):
+            matches = []
+            for n in np.argsort(-scores[:, q])[:k]:
+                if not np.isfinite(scores[n, q]):
+                    break
+                matches.append({
+                    "id": ids[n],
+                    "score": float(scores[n, q]),
+                    "image_score": float(image_scores[n, q]) if query_has_image[q] else None,
+                    "text_score": float(text_scores[n, q]) if text_w[n, q] else None,
+                    "document": got["documents"][n],
+                    "metadata": got["metadatas"][n],
+                })
+            results.append(matches)
+        return results
+
+    def _hybrid_candidates(self, image_vectors, text_vectors, n_results, where, with_text):
+        """
+        混合检索里碰向量库的部分，在一次读锁里做完：
+        第一步两个集合各一次批量查询，合并候选；第二步候选的两种向量一次取回。
+        返回 (图片集合的 get 结果, 文本集合的 get 结果)，没有候选时是 (None, None)
+        """
+        with self.locked():
+            candidate_ids = set()
+            for collection, vectors in ((self.collection, image_vectors), (self.text_collection, text_vectors)):
+                rows = [v for v in vectors if v is not None]
+                if collection is None or not rows:
+                    continue
+                found = collection.query(query_embeddings=_normalize(rows).tolist(), n_results=n_results,
+                                         where=where, include=["distances"])
+                for ids in found["ids"]:
+                    candidate_ids.update(ids)
+            if not candidate_ids:
+                return None, None
+            got = self.collection.get(ids=sorted(candidate_ids), include=["embeddings", "documents", "metadatas"])
+            got_text = None
+            if with_text and got["ids"]:
+                got_text = self.text_collection.get(ids=got["ids"], include=["embeddings"])
+            return got, got_text
+
+    def question_vectors(self, where=None, page_size=1000):
+        """
+        带 question_id 的文档的归一化向量，给批量计算用（比如相似题图）
+
+        Returns:
+            {"question_ids": [...], "metadatas": [...], "image": (n, d) 矩阵,
+             "text": (n, d') 矩阵（没有文本集合时为 None，缺文本向量的行是 0）, "has_text": (n,) 布尔数组}
+        """
+        doc_ids, question_ids, metadatas, image = [], [], [], []
+        rows, vectors = [], []
+        with self.locked():
+            offset = 0
+            while True:
+                got = self.collection.get(where=where, include=["embeddings", "metadatas"],
+                                          limit=page_size, offset=offset)
+                for doc_id, embedding, metadata in zip(got["ids"], got["embeddings"], got["metadatas"]):
+                    if metadata and metadata.get("question_id") is not None:
+                        doc_ids.append(doc_id)
+                        question_ids.append(metadata["question_id"])
+                        metadatas.append(metadata)
+                        image.append(embedding)
+                if len(got["ids"]) < page_size:
+                    break
+                offset += page_size
+
+            if self.text_collection is not None and doc_ids:
+                position = {doc_id: n for n, doc_id in enumerate(doc_ids)}
+                for i in range(0, len(doc_ids), page_size):
+                    got = self.text_collection.get(ids=doc_ids[i:i + page_size], include=["embeddings"])
+                    for doc_id, embedding in zip(got["ids"], got["embeddings"]):
+                        rows.append(position[doc_id])
+                        vectors.append(embedding)
+
+        text, has_text = None, np.zeros(len(doc_ids), dtype=bool)
+        if rows:
+            vectors = _normalize(vectors)
+            text = np.zeros((len(doc_ids), vectors.shape[1]), dtype=np.float32)
+            text[rows] = vectors
+            has_text[rows] = True
+        return {
+            "question_ids": question_ids,
+            "metadatas": metadatas,
+            "image": _normalize(image) if image else np.zeros((0, 0), dtype=np.float32),
+            "text": text,
+            "has_text": has_text,
+        }
+
+    def search_similar_image(self, query_image_path, top_k=1, where=None):
+        """
+        搜索
+        where: Chroma 元数据过滤条件，例如 {"user_id": 3} 只在这个用户的题里找
+        """
         query_vector = self._get_image_embedding(query_image_path)
         
         if query_vector:
-            results = self.collection.query(
-                query_embeddings=[query_vector], 
-                n_results=top_k
-            )
+            with self.locked():
+                results = self.collection.query(
+                    query_embeddings=[query_vector], 
+                    n_results=top_k,
+                    where=where
+                )
             return results
-        return None
\ No newline at end of file
+        return None
+
+    # ================= 和数据库保持同步 =================
+    def delete_questions(self, question_ids):
+        """删掉这些数据库题目对应的向量"""
+        question_ids = list(question_ids)
+        if question_ids:
+            with self.locked(write=True):
+                self.collection.delete(where={"question_id": {"$in": question_ids}})
+                if self.text_collection is not None:
+                    self.text_collection.delete(where={"question_id": {"$in": question_ids}})
+
+    def update_questions(self, changes):
+        """changes: [(question_id, new_content, new_tags)]；图片没变，只改文档和标签、重算文本向量"""
+        patch = {qid: (content, tags) for qid, content, tags in changes}
+        if not patch:
+            return
+        # 文本向量只跟新讲解有关，先在锁外面算好
+        order = list(patch)
+        encoded = self._encode_texts([patch[qid][0] for qid in order])
+        text_vectors = dict(zip(order, encoded)) if encoded is not None else None
+        with self.locked(write=True):
+            found = self.collection.get(where={"question_id": {"$in": order}}, include=["metadatas"])
+            if not found["ids"]:
+                return
+            documents, metadatas = [], []
+            for metadata in found["metadatas"]:
+                content, tags = patch[metadata["question_id"]]
+                documents.append(content)
+                metadatas.append(dict(metadata, tags=tags, **tag_metadata(tags, metadata)))
+            self.collection.update(ids=found["ids"], documents=documents, metadatas=metadatas)
+            if text_vectors is not None:
+                self._upsert_texts(found["ids"], np.array([text_vectors[m["question_id"]] for m in metadatas]),
+                                   metadatas)
+
+    def sync_db_write(self, event, payload):
+        """DBManager 的写操作监听器（见 db_manager.add_write_listener）"""
+        if event == "save":
+            self.add_questions([{
+                "text_content": q["content"],
+                "image_path": q["image_path"],
+                "tags": q["tags"],
+                "source": f"User{q['user_id']}",
+                "user_id": q["user_id"],
+                "question_id": q["question_id"],
+            } for q in payload], report=False)
+        elif event == "delete":
+            self.delete_questions(payload)
+        elif event == "update":
+            self.update_questions(payload)
+
+    def _indexed_questions(self, page_size=1000):
+        """Chroma 里所有带 question_id 的文档：{question_id: (文档 ID, 文档, 元数据)}"""
+        indexed, offset = {}, 0
+        while True:
+            got = self.collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+            for doc_id, document, metadata in zip(got["ids"], got["documents"], got["metadatas"]):
+                if metadata and metadata.get("question_id") is not None:
+                    indexed[metadata["question_id"]] = (doc_id, document, metadata)
+            if len(got["ids"]) < page_size:
+                return indexed
+            offset += page_size
+
+    def _text_indexed_ids(self, page_size=1000):
+        """文本集合里已有的文档 ID；没开文本向量时返回 None"""
+        if self.text_collection is None:
+            return None
+        ids, offset = set(), 0
+        while True:
+            got = self.text_collection.get(include=[], limit=page_size, offset=offset)
+            ids.update(got["ids"])
+            if len(got["ids"]) < page_size:
+                return ids
+            offset += page_size
+
+    def reconcile(self, rows, dry_run=False, report=True):
+        """
+        对比数据库和 Chroma，把向量库修到和数据库一致（增量：只给新题和换了图片的题算向量）。
+
+        Args:
+            rows: 数据库里的全部题目 [{"question_id", "user_id", "content", "image_path", "tags"}]
+            dry_run: 只统计差异，不写入
+
+        Returns:
+            {"added": 新算向量的条数, "updated": 只改了文档/标签（或补文本向量）的条数,
+             "deleted": 删掉的孤儿文档数, "unchanged": 没变的条数, "failed": 入库失败的条数}
+        """
+        start = time.perf_counter()
+        # 先取向量库快照再读数据库（rows 是生成器时）：页面在两者之间存的题已经在数据库里，不会被当成孤儿删掉
+        with self.locked():
+            indexed = self._indexed_questions()
+            text_ids = self._text_indexed_ids()
+        rows = {row["question_id"]: row for row in rows}
+
+        orphans = [doc_id for qid, (doc_id, _, _) in indexed.items() if qid not in rows]
+        to_embed, to_update, unchanged = [], [], 0
+        for qid, row in rows.items():
+            doc = indexed.get(qid)
+            if doc is None or doc[2].get("image_path") != row["image_path"]:
+                if doc is not None:
+                    orphans.append(doc[0])
+                to_embed.append(row)
+            elif (doc[1] != row["content"] or doc[2].get("tags") != row["tags"]
+                  # 早先入库的文档没有标签字段和文本向量，补上
+                  or tag_metadata(row["tags"]).items() - doc[2].items()
+                  or (text_ids is not None and doc[0] not in text_ids)):
+                to_update.append((qid, row["content"], row["tags"]))
+            else:
+                unchanged += 1
+
+        result = {"added": len(to_embed), "updated": len(to_update), "deleted": len(orphans),
+                  "unchanged": unchanged, "failed": 0}
+        if not dry_run:
+            if orphans:
+                with self.locked(write=True):
+                    self.collection.delete(ids=orphans)
+                    if self.text_collection is not None:
+                        self.text_collection.delete(ids=orphans)
+            self.update_questions(to_update)
+            if to_embed:
+                added = self.add_questions([{
+                    "text_content": row["content"],
+                    "image_path": row["image_path"],
+                    "tags": row["tags"],
+                    "source": f"User{row['user_id']}",
+                    "user_id": row["user_id"],
+                    "question_id": row["question_id"],
+                } for row in to_embed], report=False)
+                result["added"], result["failed"] = added["added"], added["failed"]
+        if report:
+            mode = "（试运行，未写入）" if dry_run else ""
+            print(f"🔄 向量库对账{mode}: 新增 {result['added']}, 更新 {result['updated']}, "
+                  f"删除 {result['deleted']}, 未变 {result['unchanged']}, 失败 {result['failed']}, "
+                  f"用时 {time.perf_counter() - start:.1f}s")
+        return result
+
+
+_knowledge_base = None
+_kb_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_sync_live = False   # 向量库已经打开、监听器直接同步了，不用再记进队列文件
+
+
+def get_knowledge_base():
+    """获取进程级共享的 MathKnowledgeBase（第一次调用时创建，先补上队列文件里还没同步的写操作）"""
+    global _knowledge_base
+    if _knowledge_base is None:
+        with _kb_lock:
+            if _knowledge_base is None:
+                kb = MathKnowledgeBase()
+                _drain_sync_queue(kb)
+                _knowledge_base = kb
+    return _knowledge_base
+
+
+def queue_db_write(event, payload):
+    """
+    轻量的写操作监听器（app 启动时注册，见 register_vector_sync）：向量库还没打开时，
+    把写操作追加到 VECTOR_SYNC_QUEUE，不加载 Chroma 和 CLIP；进程重启也不会丢，下次打开向量库时按顺序补上
+    """
+    with _sync_lock:
+        if _sync_live:
+            return
+        line = json.dumps({"event": event, "payload": payload}, ensure_ascii=False)
+        with open(VECTOR_SYNC_QUEUE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+def register_vector_sync():
+    """注册 queue_db_write（重复调用只注册一次）；要在第一次 get_knowledge_base 之前注册"""
+    from db_manager import add_write_listener
+    add_write_listener(queue_db_write)
+
+
+def _read_sync_queue(path):
+    """队列文件里的写操作，相邻的存题合成一批；最后一行没写完（进程写到一半被杀）时跳过"""
+    ops = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                op = json.loads(line)
+            except ValueError:
+                continue
+            if op["event"] == "save" and ops and ops[-1][0] == "save":
+                ops[-1][1].extend(op["payload"])
+            else:
+                ops.append((op["event"], op["payload"]))
+    return ops
+
+
+def _drain_sync_queue(kb):
+    """
+    按顺序补上队列文件里的写操作，补完再把 kb.sync_db_write 注册成监听器。
+    补的时候新来的写操作继续进队列文件，循环到文件为空为止；正在补的文件先改名成 .applying，
+    补到一半进程退出的话下次先补它（存/改/删重复执行结果一样）
+    """
+    global _sync_live
+    from db_manager import add_write_listener
+    applying = VECTOR_SYNC_QUEUE + ".applying"
+    while True:
+        if not os.path.exists(applying):
+            with _sync_lock:
+                if not os.path.exists(VECTOR_SYNC_QUEUE):
+                    # 之后数据库里的存/改/删都直接同步到向量库
+                    add_write_listener(kb.sync_db_write)
+                    _sync_live = True
+                    return
+                os.replace(VECTOR_SYNC_QUEUE, applying)
+        ops = _read_sync_queue(applying)
+        print(f"🔄 补上向量库打开之前的 {sum(len(p) for _, p in ops)} 条写操作")
+        for event, payload in ops:
+            kb.sync_db_write(event, payload)
+        os.remove(applying)
+
+
+if __name__ == "__main__":
+    import argparse
+    from db_manager import create_db_manager
+
+    parser = argparse.ArgumentParser(description="MathMaster 向量库维护工具")
+    parser.add_argument("--reconcile", action="store_true", help="对比数据库和向量库，增量修复差异")
+    parser.add_argument("--dry-run", action="store_true", help="只统计差异，不写入")
+    args = parser.parse_args()
+
+    if args.reconcile:
+        MathKnowledgeBase().reconcile(create_db_manager().iter_questions(), dry_run=args.dry_run)
+    else:
+        parser.print_help()
@@ -3,9 +3,8 @@ Dashboard 页面视图
 显示学习统计、图表和热门话题
 """
 import streamlit as st
-from db_manager import DBManager
+from db_manager import create_db_manager
 from streamlit_echarts import st_echarts
-from collections import Counter
 from utils import get_user_initials
 
 
@@ -26,18 +25,13 @@ def render_dashboard_page(user):
         st.markdown("<br>", unsafe_allow_html=True)
         
         # 功能卡片区域
-        db = DBManager()
-        all_history = db.get_history(user['id'], user['role'])
+        db = create_db_manager()
         
-        # 统计数据
-        total_questions = len(all_history)
-        all_tags = []
-        for item in all_history:
-            for t in item['tags'].replace('，', ',').split(','):
-                if t.strip(): 
-                    all_tags.append(t.strip())
-        unique_topics = len(set(all_tags))
-        top_tags = Counter(all_tags).most_common(5) if all_tags else []
+        # 统计数据（直接查标签表，不再把全部历史拉回来解析）
+        stats = db.get_dashboard_stats(user['id'], user['role'], top_n=5)
+        total_questions = stats['total_questions']
+        unique_topics = stats['unique_topics']
+        top_tags = stats['top_tags']
         
         # 创建卡片 - 使用 Morandi 配色
         col_card1, col_card2, col_card3, col_card4 = st.columns(4)
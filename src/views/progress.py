@@ -6,7 +6,7 @@ import streamlit as st
 import os
 import time
 import streamlit_antd_components as sac
-from db_manager import DBManager
+from db_manager import create_db_manager
 from docx import Document
 from docx.shared import Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
@@ -33,12 +33,30 @@ def generate_word_exam(questions, exam_title="错题复习试卷"):
     return bio
 
 
+def get_related_questions(db, question_ids, limit=3):
+    """
+    这一页题目的相似题，查预先算好的相似题图（不做向量检索）；图不可用时返回空。
+    邻居先和数据库核对一遍，已经删掉的题不显示
+    """
+    try:
+        from similar_graph import get_similar_graph
+        graph = get_similar_graph()
+        try:
+            live_ids = db.existing_question_ids(graph.neighbor_ids(question_ids))
+        except Exception as e:
+            print(f"⚠️ 核对相似题是否还在失败，按图里的节点显示: {e}")
+            live_ids = None
+        return graph.related_many(question_ids, limit, live_ids)
+    except Exception as e:
+        print(f"⚠️ 相似题图不可用: {e}")
+        return {}
+
+
 def render_progress_page(user):
     """渲染 My Progress 页面"""
     st.markdown("### 📒 My Progress")
     
-    db = DBManager()
-    full_history = db.get_history(user['id'], user['role'])
+    db = create_db_manager()
     
     default_search = st.session_state.get('search_query', "")
     if default_search: 
@@ -56,30 +74,61 @@ def render_progress_page(user):
         if st.button("🔄 Refresh", use_container_width=True): 
             st.rerun()
     
-    history = [item for item in full_history 
-               if search_term.lower() in item['tags'].lower() or search_term.lower() in item['ai_content'].lower()] \
-               if search_term else full_history
+    c_tag, c_date = st.columns([1, 1])
+    with c_tag:
+        tag_filter = st.text_input("🏷️ Tag", key="tag_filter")
+    with c_date:
+        date_range = st.date_input("📅 Date range", value=(), key="date_filter")
+    date_from = date_range[0] if len(date_range) > 0 else None
+    date_to = date_range[1] if len(date_range) > 1 else date_from
+    
+    # 筛选条件变了就回到第一页；cursors[i] 是第 i 页的起点游标
+    filters = (search_term, tag_filter, date_from, date_to)
+    if st.session_state.get('history_filters') != filters:
+        st.session_state['history_filters'] = filters
+        st.session_state['history_cursors'] = [None]
+    cursors = st.session_state['history_cursors']
+    
+    if search_term:
+        # 有搜索词：走全文索引，按相关度排序，不分页
+        history = db.search(user['id'], user['role'], search_term, tag_filter, date_from, date_to)
+        page = {"items": history, "total": len(history), "next_cursor": None}
+    else:
+        page = db.get_history_page(user['id'], user['role'], search_term, tag_filter, date_from, date_to,
+                                   after=cursors[-1])
+        history = page['items']
     
     with c_ex:
         st.markdown("<br>", unsafe_allow_html=True)
-        if history:
-            doc_io = generate_word_exam(history, f"MathMaster - {search_term if search_term else 'All'} Review")
-            st.download_button(
-                "📥 Export", 
-                data=doc_io, 
-                file_name=f"错题卷_{int(time.time())}.docx", 
-                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document", 
-                type="primary", 
-                use_container_width=True
-            )
+        if page['total']:
+            # 导出要遍历全部匹配的题，只在点击时才生成
+            if st.button("📥 Export", use_container_width=True):
+                questions = history if search_term else \
+                    db.iter_history(user['id'], user['role'], search_term, tag_filter, date_from, date_to)
+                st.session_state['export_doc'] = generate_word_exam(
+                    questions, f"MathMaster - {search_term if search_term else 'All'} Review"
+                )
+            if st.session_state.get('export_doc'):
+                st.download_button(
+                    "💾 Download", 
+                    data=st.session_state.pop('export_doc'), 
+                    file_name=f"错题卷_{int(time.time())}.docx", 
+                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document", 
+                    type="primary", 
+                    use_container_width=True
+                )
     
     st.markdown("</div>", unsafe_allow_html=True)
     
     if not history:
         sac.result(label='No questions yet', status='empty')
     else:
-        st.caption(f"Total: {len(history)} questions")
+        if search_term:
+            st.caption(f"Top {len(history)} matches by relevance")
+        else:
+            st.caption(f"Total: {page['total']} questions · Page {len(cursors)}")
         
+        related = get_related_questions(db, [item['id'] for item in history])
         selected_ids = []
         for item in history:
             with st.expander(f"🏷️ {item['tags']} | 📅 {item['date']} | 🆔 {item['id']}"):
@@ -107,12 +156,29 @@ def render_progress_page(user):
                         db.update_question(item['id'], n_con, n_tags)
                         st.rerun()
                 
+                if related.get(item['id']):
+                    st.caption("🔗 Similar questions you got wrong before")
+                    cols = st.columns(len(related[item['id']]))
+                    for col, match in zip(cols, related[item['id']]):
+                        if os.path.exists(match['image_path'] or ""):
+                            col.image(match['image_path'], use_container_width=True)
+                        col.caption(f"🆔 {match['id']} · {match['score']:.2f} · {match['tags']}")
+                
                 if st.checkbox("Select", key=f"chk_{item['id']}"):
                     selected_ids.append(item['id'])
         
         if selected_ids:
             st.warning(f"Selected {len(selected_ids)} questions")
             if st.button(f"🗑️ Batch Delete ({len(selected_ids)})", type="primary"):
-                for qid in selected_ids: 
-                    db.delete_question(qid)
+                db.delete_questions(selected_ids)
                 st.rerun()
+        
+        # 翻页
+        c_prev, _, c_next = st.columns([1, 4, 1])
+        if len(cursors) > 1 and c_prev.button("⬅️ Prev", use_container_width=True):
+            cursors.pop()
+            st.rerun()
+        if page['next_cursor'] is not None and c_next.button("Next ➡️", use_container_width=True):
+            cursors.append(page['next_cursor'])
+            st.rerun()
+
@@ -3,6 +3,8 @@ Settings 页面视图
 显示账户信息和设置选项
 """
 import streamlit as st
+import datetime
+from db_manager import create_db_manager
 
 
 def render_settings_page(user):
@@ -20,6 +22,42 @@ def render_settings_page(user):
     
     st.markdown("<br>", unsafe_allow_html=True)
     
+    # 管理员可以看到数据库熔断器 / 连接池状态
+    if user['role'] == 'admin':
+        render_db_health(create_db_manager())
+        st.markdown("<br>", unsafe_allow_html=True)
+    
     if st.button("🚪 Logout", type="primary", use_container_width=True):
         st.session_state['user_info'] = None
         st.rerun()
+
+
+
+def render_db_health(db):
+    """渲染数据库健康状态（仅管理员可见）"""
+    st.markdown("#### 🩺 Database Health")
+    st.caption(f"Storage backend: {db.backend}")
+    breaker = db.breaker_status()
+    state_label = {
+        "closed": "🟢 Closed (database online)",
+        "open": "🔴 Open (demo fallback)",
+        "half_open": "🟡 Half-open (trial request)",
+    }.get(breaker['state'], breaker['state'])
+    
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Circuit Breaker", state_label)
+    c2.metric("Consecutive Failures", breaker['failures'])
+    c3.metric("Connect Timeout", f"{breaker['connect_timeout']}s")
+    if breaker['opened_at']:
+        opened = datetime.datetime.fromtimestamp(breaker['opened_at']).strftime("%H:%M:%S")
+        st.caption(f"Opened at {opened}, probing every {breaker['probe_interval']:.0f}s")
+    if breaker['last_error']:
+        st.caption(f"Last error: {breaker['last_error']}")
+    
+    with st.expander("Connections"):
+        st.json(db.pool_stats())
+    with st.expander("Query Cache"):
+        st.json(db.cache_stats())
+    if db.backend == "mssql":
+        with st.expander("Fallback Store"):
+            st.json(db.fallback_stats())
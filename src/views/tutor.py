@@ -5,12 +5,14 @@ Math Tutor 页面视图
 import streamlit as st
 import os
 import time
+import io
 import concurrent.futures
 import threading
 from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import google.generativeai as genai
 import re
-from db_manager import DBManager
+from db_manager import create_db_manager
+from utils import split_tags
 
 
 # 全局配置
@@ -19,19 +21,165 @@ IMG_DIR = os.path.join(DATA_DIR, "images")
 os.makedirs(IMG_DIR, exist_ok=True)
 MAX_WORKERS = 1
 
+# 近似重复检测：和已有错题几乎一样的图片直接复用之前的讲解，不再调用 Gemini
+DEDUP_SCOPE = os.getenv('DEDUP_SCOPE', 'off').lower()          # off / user（只比对自己的题）/ class（比对全班的题）
+DEDUP_THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', '0.97'))  # 余弦相似度达到多少算同一道题
+DEDUP_CANDIDATES = 5   # 多取几个候选：最像的那条可能是重建索引时只有图片、还没有讲解的记录
 
-def process_single_file(file_obj, user_tags, hint, user_id, model, ctx):
-    """处理单个上传的文件"""
+_dedup_stats = {"checked": 0, "reused": 0}
+_dedup_lock = threading.Lock()
+
+
+def find_duplicate(image_path, user_id, scope):
+    """
+    在知识库里找和这张图几乎一样的题
+    
+    Returns:
+        (讲解, 标签, 相似度)，没找到返回 None
+    """
+    if scope == 'off':
+        return None
+    try:
+        from vector_store import get_knowledge_base
+        where = {"user_id": user_id} if scope == 'user' else None
+        results = get_knowledge_base().search_similar_image(image_path, top_k=DEDUP_CANDIDATES, where=where)
+    except Exception as e:
+        print(f"⚠️ 近似重复检测失败，直接调用 AI: {e}")
+        return None
+
+    with _dedup_lock:
+        _dedup_stats["checked"] += 1
+    if not results or not results["ids"] or not results["ids"][0]:
+        return None
+    hits = zip(results["distances"][0], results["documents"][0], results["metadatas"][0])
+    for distance, document, metadata in hits:
+        # 集合用的是 cosine 距离：相似度 = 1 - 距离；结果按距离升序，低于阈值后面的只会更不像
+        similarity = 1 - distance
+        if similarity < DEDUP_THRESHOLD:
+            return None
+        # 没有讲解或不对应任何题目的记录（比如 reindex 补进来的纯图片向量）不能拿来复用
+        if not document or (metadata or {}).get("question_id") is None:
+            continue
+        with _dedup_lock:
+            _dedup_stats["reused"] += 1
+        return document, metadata.get("tags", ""), similarity
+    return None
+
+
+GRAPH_WAIT_SECONDS = 5   # 查相似错题前，最多等后台把刚存的题增量更新进相似题图多久
+
+
+def find_similar_mistakes(uploads, user_id, top_k=3):
+    """
+    一批刚上传的题找出各自相似的历史错题：先查预先算好的相似题图，
+    图里还没有的再一次混合检索（图片 + 讲解文字）补上
+    
+    Args:
+        uploads: [(图片路径, 讲解)]
+        
+    Returns:
+        和 uploads 一一对应的列表，每项 [{"score", "image_path", "tags"}]，失败返回 None
+    """
+    paths = [path for path, _ in uploads]
+    found = {}
+    try:
+        from similar_graph import get_similar_graph, wait_for_updates
+        # 后台还没把这一批题更新进图的话，最多等一会儿；还没进图的题下面走向量检索
+        wait_for_updates(GRAPH_WAIT_SECONDS)
+        for path, matches in get_similar_graph().related_by_image(paths, top_k + len(paths)).items():
+            # 同一批上传的题互相之间不算
+            found[path] = [m for m in matches if m['image_path'] not in paths][:top_k]
+    except Exception as e:
+        print(f"⚠️ 相似题图不可用，改用向量检索: {e}")
+
+    missing = [(path, content) for path, content in uploads if path not in found]
+    if missing:
+        try:
+            from vector_store import get_knowledge_base
+            # 知识库打开着的话，刚上传的题已经同步进向量库了，按图片路径排除掉
+            where = {"$and": [{"user_id": user_id}, {"image_path": {"$nin": paths}}]}
+            results = get_knowledge_base().search_hybrid(
+                [{"image_path": path, "text": content} for path, content in missing], top_k=top_k, where=where)
+        except Exception as e:
+            print(f"⚠️ 相似错题检索失败: {e}")
+            return None
+        for (path, _), matches in zip(missing, results):
+            found[path] = [{"score": m["score"], "image_path": m["metadata"].get("image_path", ""),
+                            "tags": m["metadata"].get("tags", "")} for m in matches]
+    return [found[path] for path in paths]
+
+
+def iter_upload_images(uploaded_files, on_error=None):
+    """
+    把上传的文件逐个展开成要讲解的图片：图片原样返回，PDF 试卷在内存里切成小题逐道返回
+    （BytesIO，带 .name，和上传的文件对象一样交给 process_single_file）
+    
+    Args:
+        on_error: 某个 PDF 切题失败时调用 on_error(文件名, 异常)，其余文件照常处理
+    """
+    for f in uploaded_files:
+        if not f.name.lower().endswith('.pdf'):
+            yield f
+            continue
+        try:
+            from exam_cutter import iter_questions
+            for q in iter_questions(f.getvalue(), f.name, encode=".jpg"):
+                crop = io.BytesIO(q["image"])
+                crop.name = q["name"]
+                yield crop
+        except Exception as e:
+            print(f"❌ PDF 切题失败 {f.name}: {e}")
+            if on_error:
+                on_error(f.name, e)
+
+
+def get_dedup_stats():
+    """进程启动以来做了多少次重复检测、省掉了多少次 AI 调用"""
+    with _dedup_lock:
+        return dict(_dedup_stats)
+
+
+def process_single_file(file_obj, user_tags, hint, user_id, model, ctx, dedup_scope='off'):
+    """
+    处理单个上传的文件
+    
+    Returns:
+        (是否成功, 文件名, 讲解或错误信息, 图片保存路径, 是否复用了已有讲解)
+    """
     if ctx: 
         add_script_run_ctx(threading.current_thread(), ctx)
     time.sleep(0.5) 
     fname = file_obj.name
-    
+    timestamp = str(int(time.time() * 1000))
+    save_name = f"User{user_id}_{timestamp}.jpg"
+    save_path = os.path.join(IMG_DIR, save_name)
+    saved = False   # 题目存进数据库之后图片才算有主，否则任何失败都要把写下的图片删掉
+
+    def write_image():
+        file_obj.seek(0)
+        with open(save_path, "wb") as f:
+            f.write(file_obj.read())
+
     try:
         if not model:
-            return False, fname, "AI 模型未初始化，请检查 GOOGLE_API_KEY 配置", ""
+            return False, fname, "AI 模型未初始化，请检查 GOOGLE_API_KEY 配置", "", False
+
+        # 重复检测要用文件路径算向量，只有开了检测才提前把图片写下来
+        if dedup_scope != 'off':
+            write_image()
+
+        db = create_db_manager()
+        duplicate = find_duplicate(save_path, user_id, dedup_scope)
+        if duplicate:
+            ai_content, stored_tags, similarity = duplicate
+            print(f"♻️ {fname} 与已有题目相似度 {similarity:.3f}，复用已有讲解")
+            final_tags = ", ".join(split_tags(f"{user_tags}, {stored_tags}"))
+            db.save_question(user_id, fname, ai_content, save_path, final_tags)
+            saved = True
+            return True, fname, ai_content, save_path, True
             
         from PIL import Image
+        file_obj.seek(0)
         image = Image.open(file_obj)
         prompt = f"""
         你是一名亲切的小学数学老师。请对这张错题进行温柔、详细的讲解。
@@ -63,7 +211,7 @@ def process_single_file(file_obj, user_tags, hint, user_id, model, ctx):
                 time.sleep(2)
 
         if not ai_content:
-            return False, fname, f"AI 连接失败: {last_error}", ""
+            return False, fname, f"AI 连接失败: {last_error}", "", False
 
         # 提取标签
         final_tags = user_tags
@@ -72,24 +220,20 @@ def process_single_file(file_obj, user_tags, hint, user_id, model, ctx):
             ai_extracted_tags = match.group(1).strip()
             ai_extracted_tags = ai_extracted_tags.replace("。", "").replace(".", "").strip()
             if ai_extracted_tags:
-                final_tags = f"{user_tags}, {ai_extracted_tags}"
-                tag_list = [t.strip() for t in final_tags.replace("，", ",").split(",") if t.strip()]
-                final_tags = ", ".join(list(set(tag_list)))
+                final_tags = ", ".join(split_tags(f"{user_tags}, {ai_extracted_tags}"))
 
-        timestamp = str(int(time.time() * 1000))
-        save_name = f"User{user_id}_{timestamp}.jpg"
-        save_path = os.path.join(IMG_DIR, save_name)
-        
-        file_obj.seek(0)
-        with open(save_path, "wb") as f:
-            f.write(file_obj.read())
-            
-        db = DBManager()
+        # save_question 会通过写操作监听器把这道题同步进向量库（知识库还没打开时先记进同步队列）
+        if not os.path.exists(save_path):
+            write_image()
         db.save_question(user_id, fname, ai_content, save_path, final_tags)
-        return True, fname, ai_content, save_path
+        saved = True
+        return True, fname, ai_content, save_path, False
         
     except Exception as e:
-        return False, fname, f"系统错误: {str(e)}", ""
+        return False, fname, f"系统错误: {str(e)}", "", False
+    finally:
+        if not saved and os.path.exists(save_path):
+            os.remove(save_path)
 
 
 def render_tutor_page(user, model):
@@ -103,14 +247,19 @@ def render_tutor_page(user, model):
     c1, c2 = st.columns([2, 1])
     with c1: 
         uploaded_files = st.file_uploader(
-            "📥 Upload homework images", 
+            "📥 Upload homework images or exam PDFs", 
             accept_multiple_files=True, 
-            type=['jpg', 'png'],
-            help="Upload images of your math problems"
+            type=['jpg', 'png', 'pdf'],
+            help="Upload images of your math problems; PDF exams are cut into single questions automatically"
         )
     with c2: 
         tags = st.text_input("🏷️ Tags", value="期末复习", help="Add tags for this session")
         hint = st.text_input("💡 Hint", placeholder="What do you need help with?", help="Tell us what you're struggling with")
+        reuse = st.checkbox("♻️ Reuse analysis for near-duplicates", value=DEDUP_SCOPE != 'off',
+                            help="Skip the AI call when a visually identical question already has an explanation")
+        show_similar = st.checkbox("🔗 Show similar past mistakes", value=False,
+                                   help="Look up your earlier questions that look or read alike")
+    dedup_scope = (DEDUP_SCOPE if DEDUP_SCOPE != 'off' else 'user') if reuse else 'off'
     
     st.markdown("</div>", unsafe_allow_html=True)
     
@@ -121,30 +270,80 @@ def render_tutor_page(user, model):
                 st.error("⚠️ AI model not initialized. Please check GOOGLE_API_KEY in .env file!")
                 return
                 
+            if show_similar:
+                # 先开增量更新：这一批题存库后在后台更新进相似题图，结束后直接查表
+                try:
+                    from similar_graph import start_graph_updates
+                    start_graph_updates()
+                except Exception as e:
+                    print(f"⚠️ 相似题图增量更新不可用: {e}")
             ctx = get_script_run_ctx()
             progress = st.progress(0)
             status = st.status("🔮 AI teacher is thinking...", expanded=True)
             
+            completed = 0
+            total = 0
+            reused = 0
+            done = []
+
+            def show(future):
+                nonlocal completed, reused
+                ok, fname, content, path, from_cache = future.result()
+                completed += 1
+                reused += from_cache
+                progress.progress(completed / total)
+                if ok:
+                    done.append((fname, path, content))
+                    status.write(f"♻️ {fname} matched an existing question" if from_cache
+                                 else f"✅ {fname} completed")
+                    with st.expander(f"📖 View Analysis: {fname}"):
+                        col_img, col_content = st.columns([1, 2])
+                        with col_img:
+                            st.image(path, use_container_width=True)
+                        with col_content:
+                            st.markdown(content)
+                else:
+                    status.error(f"❌ {fname} failed: {content}")
+                    st.error(f"⚠️ Error details: {content}")
+
             with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                futures = []
-                for f in uploaded_files:
-                    futures.append(executor.submit(process_single_file, f, tags, hint, user['id'], model, ctx))
-                
-                completed = 0
-                for future in concurrent.futures.as_completed(futures):
-                    ok, fname, content, path = future.result()
-                    completed += 1
-                    progress.progress(completed / len(uploaded_files))
-                    if ok:
-                        status.write(f"✅ {fname} completed")
-                        with st.expander(f"📖 View Analysis: {fname}"):
-                            col_img, col_content = st.columns([1, 2])
-                            with col_img:
-                                st.image(path, use_container_width=True)
-                            with col_content:
-                                st.markdown(content)
-                    else:
-                        status.error(f"❌ {fname} failed: {content}")
-                        st.error(f"⚠️ Error details: {content}")
+                # PDF 边切边提交：排队的题最多 MAX_WORKERS * 2 道，切好的题不用全部攒在内存里
+                running = set()
+
+                def cut_failed(name, e):
+                    status.error(f"❌ {name} could not be cut into questions: {e}")
+
+                for f in iter_upload_images(uploaded_files, cut_failed):
+                    if len(running) >= MAX_WORKERS * 2:
+                        finished, running = concurrent.futures.wait(
+                            running, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in finished:
+                            show(future)
+                    total += 1
+                    running.add(executor.submit(process_single_file, f, tags, hint, user['id'], model, ctx,
+                                                dedup_scope))
+                for future in concurrent.futures.as_completed(running):
+                    show(future)
             
             status.update(label="🎉 Processing complete", state="complete")
+            if dedup_scope != 'off':
+                stats = get_dedup_stats()
+                st.caption(f"♻️ {reused} of {total} images reused an existing analysis "
+                           f"({stats['reused']} AI calls avoided since startup)")
+
+            if show_similar and done:
+                similar = find_similar_mistakes([(path, content) for _, path, content in done], user['id'])
+                if similar is None:
+                    st.warning("⚠️ Similar-question lookup is unavailable right now")
+                elif any(similar):
+                    st.markdown("#### 🔗 Similar Past Mistakes")
+                    for (fname, _, _), matches in zip(done, similar):
+                        if not matches:
+                            continue
+                        st.markdown(f"**{fname}**")
+                        cols = st.columns(len(matches))
+                        for col, match in zip(cols, matches):
+                            with col:
+                                if os.path.exists(match["image_path"] or ""):
+                                    st.image(match["image_path"], use_container_width=True)
+                                st.caption(f"{match['score']:.2f} · {match['tags']}")